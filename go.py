@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 from lib import activate_venv
-from lib.veevutils import banner, get_slides_in_folder, index_file_rename
+from lib.veevutils import banner, get_slides_in_folder, index_file_rename, get_cache_dir, is_inside, CACHE_DIRNAME, LINK_MODES
 from lib import build
 
 from painter import paint
 from progressbar import ProgressBar, Percentage, Bar
 
 import argparse
+import glob
 import textwrap
 import sys
 import json
@@ -14,10 +15,14 @@ import shutil
 import subprocess
 import os
 import inspect
+import time
+import importlib
 import concurrent.futures
 import functools
 import networkx
 
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib")
+if LIB_DIR not in sys.path: sys.path.append(LIB_DIR) # lib tools import each other by bare module name
 
 def execute(command):
 	popen = subprocess.Popen(command, bufsize=0, stdout=subprocess.PIPE, universal_newlines=True)
@@ -31,6 +36,24 @@ def execute(command):
 		raise subprocess.CalledProcessError(returncode, command)
 
 
+def load_tool(name):
+	# importing is cached in sys.modules, so every action after the first one shares
+	# the already loaded tool (and its bs4/lxml/selenium/... imports)
+	return importlib.import_module(name)
+
+def run_tool(env, name, args, in_process=None):
+	if env.get('IN_PROCESS', True) and in_process is not None:
+		try:
+			tool = load_tool(name)
+		except ImportError as e:
+			print(paint.yellow("Could not load %s in-process (%s), falling back to a subprocess" % (name, e)))
+		else:
+			return in_process(tool)
+
+	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", name + ".py")
+	for out in execute(["python3", cmd] + args):
+		print(out)
+
 def action(banner=""):
 	def text_wrapper(f):
 		def ann():
@@ -48,12 +71,22 @@ def action(banner=""):
 def parse_config(config_file="VELVEEVA-config.json"):
 	return json.load(open(config_file))
 
+def clear_temp(temp_dir):
+	# caches outlive builds, everything else in the temp folder is a leftover
+	if not os.path.exists(temp_dir): return
+
+	for name in os.listdir(temp_dir):
+		if name == CACHE_DIRNAME: continue
+
+		path = os.path.join(temp_dir, name)
+		if os.path.isdir(path) and not os.path.islink(path):
+			shutil.rmtree(path)
+		else:
+			os.remove(path)
+
 def clean(root, config, verbose=False):
 	folders = config["MAIN"]
-	try:
-		shutil.rmtree(folders["temp_dir"])
-	except FileNotFoundError:
-		pass
+	clear_temp(os.path.join(root, folders["temp_dir"]))
 
 def scaffold(root, config, verbose=False):
 	folders = config["MAIN"]
@@ -76,45 +109,184 @@ def nuke(root, config, verbose=False):
 	folders = config["MAIN"]
 	try:
 		shutil.rmtree(os.path.join(root,folders["output_dir"]))
-		shutil.rmtree(os.path.join(root,folders["temp_dir"]))
 	except Exception as e:
 		pass
+	clear_temp(os.path.join(root, folders["temp_dir"]))
+
+def copy_locals(root_dir, src, dest, verbose=False, only=None, link="copy", batch_size=None, workers=None):
+	transfer = load_tool("transfer")
+	if batch_size is None: batch_size = transfer.DEFAULT_BATCH_SIZE
+	if workers is None: workers = transfer.DEFAULT_WORKERS
 
-def copy_locals(root_dir, src, dest, verbose=False):
 	slides = next(os.walk(os.path.join(root_dir,src)))[1] # (root, dirs, files)
-	
-	with concurrent.futures.ProcessPoolExecutor() as executor:
-		futures = {}
+	if only is not None: slides = [slide for slide in slides if slide in only]
 
-		for slide in slides:
-			# copy everything except for html files that match the parent folder name
-			for root, dirs, files in os.walk(os.path.join(root_dir,src,slide)):
-				
-				full_base = os.path.abspath(os.path.join(root_dir,src))
-				full_current = os.path.abspath(root)
+	pairs = []
+	for slide in slides:
+		# copy everything except for html files that match the parent folder name
+		for root, dirs, files in os.walk(os.path.join(root_dir,src,slide)):
 
-				prefix = os.path.commonprefix([full_base, full_current])
-				current_relative_folder = os.path.relpath(root,prefix)
+			full_base = os.path.abspath(os.path.join(root_dir,src))
+			full_current = os.path.abspath(root)
 
-				for file in files:
-					if not os.path.splitext(os.path.basename(file))[0] == current_relative_folder:
-						s = os.path.abspath(os.path.join(root,file))
+			prefix = os.path.commonprefix([full_base, full_current])
+			current_relative_folder = os.path.relpath(root,prefix)
 
-						needs_rename = index_file_rename(s)
-						adjusted_filename = file
-						if needs_rename is not None:
-							adjusted_filename = needs_rename.new
+			for file in files:
+				if not os.path.splitext(os.path.basename(file))[0] == current_relative_folder:
+					s = os.path.abspath(os.path.join(root,file))
 
-						dest_dir = os.path.abspath(os.path.join(root_dir,dest,current_relative_folder))
-						d = os.path.join(dest_dir, adjusted_filename)
+					needs_rename = index_file_rename(s)
+					adjusted_filename = file
+					if needs_rename is not None:
+						adjusted_filename = needs_rename.new
 
-						if not os.path.exists(dest_dir): os.makedirs(dest_dir)
-						futures[executor.submit(shutil.copy,s,d)] = s+d
-		for future in concurrent.futures.as_completed(futures):
-			try:
-				data = future.result()
-			except Exception as e:
-				raise e
+					dest_dir = os.path.abspath(os.path.join(root_dir,dest,current_relative_folder))
+					pairs.append((s, os.path.join(dest_dir, adjusted_filename)))
+
+	stats = transfer.transfer(pairs, link=link, batch_size=batch_size, workers=workers, verbose=verbose)
+	if verbose: print(paint.gray(transfer.describe(stats)))
+	return stats
+
+def transfer_options(env):
+	# batch size/worker overrides for assets.inject_*, leaving the defaults alone otherwise
+	options = {}
+	if env.get('TRANSFER_BATCH') is not None: options['batch_size'] = env['TRANSFER_BATCH']
+	if env.get('TRANSFER_WORKERS') is not None: options['workers'] = env['TRANSFER_WORKERS']
+	return options
+
+def transfer_args(env):
+	args = []
+	if env.get('TRANSFER_BATCH') is not None: args = args + ["--batch-size", str(env['TRANSFER_BATCH'])]
+	if env.get('TRANSFER_WORKERS') is not None: args = args + ["--workers", str(env['TRANSFER_WORKERS'])]
+	return args
+
+### incremental builds ###
+def stage_slides(env, stage):
+	# slides an incremental build still has to run a stage for (None means all of them)
+	return env.get('SLIDES', {}).get(stage, None)
+
+def stage_output(env, stage, slide):
+	build_dir = os.path.join(env['ROOT_DIR'], env['DEST_DIR'])
+
+	if stage == "package": return os.path.join(build_dir, env['ZIPS_DIR'], slide + ".zip")
+	if stage == "controls": return os.path.join(build_dir, env['CTLS_DIR'], slide + ".ctl")
+	return os.path.join(build_dir, slide)
+
+def hash_slide_inputs(env, slides):
+	manifest = load_tool("manifest")
+
+	root = env['ROOT_DIR']
+	src = os.path.join(root, env['SOURCE_DIR'])
+	templates_dir = os.path.join(root, env['TEMPLATES_DIR'])
+	partials_dir = os.path.join(root, env['PARTIALS_DIR'])
+
+	# every slide pulls in all of the globals, and the config (screenshot sizes, etc.)
+	shared = manifest.hash_paths([os.path.join(root, env['GLOBALS_DIR'])], relative_to=root)
+	shared.update(json.dumps(env['config'], sort_keys=True).encode('utf-8'))
+
+	try:
+		templates = load_tool("templates")
+	except ImportError:
+		# can't tell which templates and partials a slide uses, so depend on all of them
+		templates = None
+		manifest.hash_paths([templates_dir, partials_dir], shared, relative_to=root)
+
+	# a slide's own sources and the templates/partials it renders with are hashed apart, so a template
+	# change only reruns the templates stage onwards, and stages_after_render can skip the rest
+	if templates is not None:
+		# the same saved graph templates.py --changed and the watch loop use
+		graph = templates.DependencyGraph(src, templates_dir, partials_dir, templates.dependency_graph_path(root, env['config'])).refresh()
+		graph.save()
+
+	inputs = {}
+	for slide in slides:
+		digest = shared.copy()
+		slide_path = os.path.join(src, slide)
+		manifest.hash_tree(slide_path, digest)
+		inputs[slide] = {"source": digest.hexdigest()}
+
+		if templates is not None:
+			manifest.hash_paths(graph.slide_dependencies(slide), digest, relative_to=root)
+
+		inputs[slide]["rendered"] = digest.hexdigest()
+
+	return inputs
+
+def stage_inputs(inputs, stage):
+	# what a slide's stage output depends on: just its own sources until it gets rendered
+	return inputs["source"] if SLIDE_STAGES.index(stage) < SLIDE_STAGES.index("templates") else inputs["rendered"]
+
+def plan_incremental(build_plan, env):
+	manifest = load_tool("manifest")
+
+	planned = [func for step in build_plan for chain in step for func in chain]
+	stages = [STAGE_NAMES[func] for func in planned if func in STAGE_NAMES]
+	stages = [stage for stage in SLIDE_STAGES if stage in stages]
+
+	slides = next(os.walk(os.path.join(env['ROOT_DIR'], env['SOURCE_DIR'])))[1]
+	inputs = hash_slide_inputs(env, slides)
+	built = manifest.BuildManifest(os.path.join(env['ROOT_DIR'], env['TEMP_DIR'], manifest.MANIFEST_FILENAME))
+
+	# a slide that gets rebuilt in one stage has to go through all of the later ones too
+	subsets = {}
+	dirty = set()
+	render_only = set() # slides with nothing to rebuild before their templates
+	for stage in stages:
+		now_dirty = set([slide for slide in slides
+			if built.is_dirty(stage, slide, stage_inputs(inputs[slide], stage), stage_output(env, stage, slide))])
+		if stage == "templates": render_only = now_dirty - dirty
+		dirty = dirty | now_dirty
+		subsets[stage] = sorted(dirty)
+
+	env['MANIFEST'] = built
+	env['SLIDE_INPUTS'] = inputs
+	env['SLIDE_STAGES'] = stages
+	env['SLIDES'] = subsets
+	env['RENDER_ONLY'] = render_only
+
+def stages_after_render(env, changed):
+	# slides that were only re-rendered for a template or partial change, and came out the same as
+	# last time, keep their screenshots, zips and ctls (as long as nothing else touched those)
+	if env.get('MANIFEST') is None: return
+
+	built = env['MANIFEST']
+	unchanged = env['RENDER_ONLY'] - set(changed)
+
+	for stage in SLIDE_STAGES[SLIDE_STAGES.index("templates") + 1:]:
+		if stage not in env['SLIDES']: continue
+		env['SLIDES'][stage] = [slide for slide in env['SLIDES'][stage]
+			if slide not in unchanged or not built.is_intact(stage, slide, stage_output(env, stage, slide))]
+
+def nuke_stale(env):
+	built = env['MANIFEST']
+
+	removed = [slide for slide in list(built.slides.keys()) if slide not in env['SLIDE_INPUTS']]
+	for slide in removed:
+		built.forget(slide)
+
+	# slides that get re-copied are rebuilt from scratch, so nothing stale is left behind
+	for slide in removed + (stage_slides(env, "locals") or []):
+		for stage in ["locals", "package", "controls"]:
+			path = stage_output(env, stage, slide)
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			elif os.path.exists(path):
+				os.remove(path)
+
+def record_incremental(env, completed):
+	# only stages that ran to the end are recorded, so a failed build picks up where it stopped
+	built = env['MANIFEST']
+	failed = env.get('FAILED_SLIDES', set())
+
+	for slide, inputs in env['SLIDE_INPUTS'].items():
+		for stage in env['SLIDE_STAGES']:
+			if stage == "screenshots" and slide in failed:
+				built.forget(slide, stage) # not built yet, whatever was recorded before
+			elif stage in completed:
+				built.record(stage, slide, stage_inputs(inputs, stage), stage_output(env, stage, slide))
+
+	built.save()
 
 def create_environment(config):
 	ENV = {}
@@ -126,6 +298,7 @@ def create_environment(config):
 	ENV['PARTIALS_DIR']		= config['MAIN']['partials_dir']
 	ENV['TEMPLATES_DIR']	= config['MAIN']['templates_dir']
 	ENV['ZIPS_DIR']			= config['MAIN']['zips_dir']
+	ENV['TEMP_DIR']			= config['MAIN']['temp_dir']
 
 	### CTL File Info ###
 	ENV['CTLS_DIR']			= config['MAIN']['ctls_dir']
@@ -133,6 +306,7 @@ def create_environment(config):
 	ENV['VEEVA_PASSWORD']	= config['VEEVA']['password']
 	ENV['VEEVA_SERVER']		= config['VEEVA']['server']
 	ENV['VEEVA_EMAIL']		= config['VEEVA'].get('email', None)
+	ENV['VEEVA_PORT']		= config['VEEVA'].get('port', 21)
 
 	ENV['ROOT_DIR']			= os.getcwd()
 	ENV['CONFIG_FILE_NAME']	= "VELVEEVA-config.json"
@@ -176,17 +350,30 @@ def create_parser():
 	parser.add_argument("--locals",			action="store_true", help="Inline locals")
 	parser.add_argument("--render-slides", 	action="store_true", help="Render/Copy slides into dest")
 	parser.add_argument("--publishonly", 	action="store_true", help="FTP upload slide and control files (no other steps)")
+	parser.add_argument("--incremental",	action="store_true", help="Only rebuild slides whose sources, globals, templates or partials changed")
+	parser.add_argument("--watch",			action="store_true", help="Keep running and rebuild only the slides affected by each change to src, globals, templates or partials (use with --dev for a fresh start)")
+	parser.add_argument("--link",			choices=LINK_MODES, default="copy", help="Hardlink or reflink (copy-on-write) sources and globals into the build instead of copying them, falling back to copies where the filesystem can't (auto tries reflink, then hardlink). Build files are unlinked before VELVEEVA edits them, but hooks that edit build files in place would edit the sources too with hardlinks")
+	parser.add_argument("--transfer-batch",	type=int, default=None, help="Files per copy task when putting sources and globals into the build")
+	parser.add_argument("--transfer-workers",	type=int, default=None, help="Threads copying sources and globals into the build")
+	parser.add_argument("--ftp-connections",	type=int, default=None, help="Zips uploaded to the FTP server at once when publishing (each slide's control file still goes up after its zip)")
+	parser.add_argument("--ftp-block-size",	type=int, default=None, help="Bytes sent per FTP write when publishing")
+	parser.add_argument("--dry-run",		action="store_true", help="With --publish/--publishonly, list the slides that would be uploaded (new or changed since the last publish to that server) without uploading anything")
+	parser.add_argument("--subprocess",		action="store_true", help="Run each tool in its own python3 process instead of in-process")
 
 	return parser
 
 @action("🔥  %s" % paint.gray("Nuking old builds..."))
 def ACTION_nuke(env, i):
 	# env['progress'].update(i)
-	nuke(env['ROOT_DIR'], env['config'])
+	if env.get('MANIFEST') is not None:
+		nuke_stale(env)
+	else:
+		nuke(env['ROOT_DIR'], env['config'])
 
 @action("🛀  %s" % paint.gray("Cleaning leftovers.."))
 def ACTION_clean(env, i):
-	clean(env['ROOT_DIR'], env['config'])
+	# incremental builds keep their manifest in the temp folder
+	if env.get('MANIFEST') is None: clean(env['ROOT_DIR'], env['config'])
 
 @action("🗄  %s" % paint.gray("Creating directories..."))
 def ACTION_scaffold(env, i):
@@ -196,138 +383,275 @@ def ACTION_scaffold(env, i):
 @action("💉  %s " % paint.gray("Inlining partials and globals..."))
 def ACTION_inline_local(env, i):
 	# env['progress'].update(i)
-	copy_locals(env['ROOT_DIR'], env['SOURCE_DIR'], env['DEST_DIR'])
+	copy_locals(env['ROOT_DIR'], env['SOURCE_DIR'], env['DEST_DIR'], only=stage_slides(env, "locals"), link=env['LINK'],
+		batch_size=env['TRANSFER_BATCH'], workers=env['TRANSFER_WORKERS'])
 
 @action()
 def ACTION_inline_global(env, i):
 	# env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "assets.py")
-	for out in execute(["python3", cmd, "--root", env['ROOT_DIR'], env['GLOBALS_DIR'], env['DEST_DIR']]):
-		print(out)
+	only = stage_slides(env, "globals")
+
+	def inject(assets):
+		if only is None:
+			assets.inject_folder(env['ROOT_DIR'], env['GLOBALS_DIR'], env['DEST_DIR'], link=env['LINK'], **transfer_options(env))
+		elif len(only) > 0:
+			assets.inject_async(env['ROOT_DIR'], env['GLOBALS_DIR'], [os.path.join(env['DEST_DIR'], s) for s in only], link=env['LINK'],
+				**transfer_options(env))
+
+	run_tool(env, "assets", ["--root", env['ROOT_DIR'], "--link", env['LINK']] + transfer_args(env) + [env['GLOBALS_DIR'], env['DEST_DIR']], inject)
 
 @action("🗄  %s " % paint.gray("Creating shared Veeva assets..."))
 def ACTION_share_assets(env, i):
 	# MUST BE LAST LINKING SCRIPT RUN D:
 
 	# relink asset refs to use '../shared/' veeva notation
-	relink_cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "relink.py")
-	for out in execute(["python3", relink_cmd
-					   , "--root", env['ROOT_DIR']
-					   , "--share-assets", env['DEST_DIR'] ]):
-		print(out)
+	def relink_shared(relink):
+		relink.parse_folder(os.path.join(env['ROOT_DIR'], env['DEST_DIR']),
+			actions=[relink.pipeline("share_assets", env['GLOBALS_DIR'])], parallel=True)
+
+	run_tool(env, "relink", ["--root", env['ROOT_DIR'], "--share-assets", env['DEST_DIR']], relink_shared)
 
 	# copy globals into build
-	copy_cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "assets.py")
-	for out in execute(["python3", copy_cmd, 
-						"--use-shared",
-						"--root", env['ROOT_DIR'], 
-						env['GLOBALS_DIR'], 
-						os.path.join(env['DEST_DIR'], env['GLOBALS_DIR']) ]):
-		print(out)
+	shared_dest = os.path.join(env['DEST_DIR'], env['GLOBALS_DIR'])
+	run_tool(env, "assets", ["--use-shared", "--root", env['ROOT_DIR'], "--link", env['LINK']] + transfer_args(env) + [env['GLOBALS_DIR'], shared_dest],
+		lambda assets: assets.inject_folder(env['ROOT_DIR'], env['GLOBALS_DIR'], shared_dest, root_only=True, link=env['LINK'], **transfer_options(env)))
 
 @action("💅  %s " % paint.gray("Compiling SASS..."))
 def ACTION_render_sass(env, i):
 	# env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "styles.py")
+	only = stage_slides(env, "sass")
+	build_dir = os.path.join(env['ROOT_DIR'], env['DEST_DIR'])
 
-	for out in execute(["python3", cmd, "--root", env['ROOT_DIR'], env['DEST_DIR'], "--remove"]):
-		print(out)
+	def compile_sass(styles):
+		folders = [build_dir] if only is None else [os.path.join(build_dir, s) for s in only]
+		for folder in folders:
+			styles.compile_sass(folder, remove_source=True, parallel=True)
+
+	run_tool(env, "styles", ["--root", env['ROOT_DIR'], env['DEST_DIR'], "--remove"], compile_sass)
 
 @action("📝  %s " % paint.gray("Rendering slides..."))
 def ACTION_render_templates(env, i):
 	# env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "templates.py")
+	src = os.path.join(env['ROOT_DIR'], env['SOURCE_DIR'])
+	dest = os.path.join(env['ROOT_DIR'], env['DEST_DIR'])
+	templates = os.path.join(env['ROOT_DIR'], env['TEMPLATES_DIR'])
+	partials = os.path.join(env['ROOT_DIR'], env['PARTIALS_DIR'])
 
-	for out in execute(["python3", cmd, 
-		os.path.join(env['ROOT_DIR'], env['SOURCE_DIR']), os.path.join(env['ROOT_DIR'],env['DEST_DIR']),
-		os.path.join(env['ROOT_DIR'], env['TEMPLATES_DIR']),
-		os.path.join(env['ROOT_DIR'], env['PARTIALS_DIR'])]):
-		print(out)
+	result = run_tool(env, "templates", ["--root", env['ROOT_DIR'], src, dest, templates, partials],
+		lambda t: t.render_slides_async(src, dest, templates, partials, verbose=False, only=stage_slides(env, "templates"),
+			cache_dir=get_cache_dir(env['ROOT_DIR'], env['config'], t.COMPILE_CACHE)))
+
+	if result is not None: stages_after_render(env, result["changed"])
 
 @action("📸  %s " % paint.gray("Taking screenshots..."))
 def ACTION_take_screenshots(env, i):
 	# env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "screenshots.py")
 	root = env['ROOT_DIR']
 	folder = env['DEST_DIR']
 	config = env['CONFIG_FILE_NAME']
 
-	for out in execute(["python3", cmd, "--shared-assets", "--root", root, folder, config]):
-		print(out)
+	result = run_tool(env, "screenshots", ["--shared-assets", "--root", root, folder, config],
+		lambda screenshots: screenshots.take_screenshots(os.path.join(root, folder), os.path.join(root, config), root,
+			shared_assets=True, only=stage_slides(env, "screenshots")))
+
+	# the subprocess exits non-zero on failures, in-process they come back as a list
+	if result is not None and len(result[1]) > 0:
+		failed = sorted(set([os.path.basename(os.path.dirname(url)) for url, tries, error in result[1]]))
+		env['FAILED_SLIDES'] = set(env.get('FAILED_SLIDES', set())) | set(failed)
+		raise Exception("Screenshots failed for %s" % ", ".join(failed))
 
 @action("📬  %s " % paint.gray("Packaging slides..."))
 def ACTION_package_slides(env, i):
 	# env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "package.py")
 	root = env['ROOT_DIR']
 	source = env['DEST_DIR']
 	zips = os.path.join(env['DEST_DIR'],env['ZIPS_DIR'])
 
-	for out in execute(["python3", cmd, "--root", root, source, zips]):
-		print(out)
+	only = stage_slides(env, "package")
+
+	def zip_slides(package):
+		slides = package.find_slide_folders(root, source)
+		if len(slides) < 1: raise IOError("No slides found!")
+		if only is not None: slides = [slide for slide in slides if os.path.basename(slide) in only]
+		stats = package.zip_slides_async(root, slides, zips, policy=package.load_policy(env['config']),
+			cache_dir=get_cache_dir(root, env['config'], "zip-entries"))
+		package.report_stats(stats, per_slide=False)
+
+	run_tool(env, "package", ["--root", root, source, zips], zip_slides)
 
 @action("⚒  %s " % paint.gray("Generating .ctl files..."))
 def ACTION_generate_ctls(env, i):
 	# env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "ctls.py")
+	zips = os.path.abspath(os.path.join(env['DEST_DIR'],env['ZIPS_DIR']))
+	ctls = os.path.abspath(os.path.join(env['DEST_DIR'],env['CTLS_DIR']))
 
-	flags = ["python3"
-				, cmd
-				, "--novalidate"
+	flags = ["--novalidate"
 				, "--root", env['ROOT_DIR']
 				, "--u", env['VEEVA_USERNAME']
 				, "--pwd", env['VEEVA_PASSWORD']
-				, os.path.abspath(os.path.join(env['DEST_DIR'],env['ZIPS_DIR']))
-				, os.path.abspath(os.path.join(env['DEST_DIR'],env['CTLS_DIR']))
+				, zips
+				, ctls
 			]
 
 	if env.get('VEEVA_EMAIL', None) is not None: flags = flags + ["--email", env['VEEVA_EMAIL']]
 
-	for out in execute(flags):
-		print(out)
+	run_tool(env, "ctls", flags,
+		lambda c: c.parseFolder(zips, out=ctls, root=env['ROOT_DIR'],
+			username=env['VEEVA_USERNAME'], password=env['VEEVA_PASSWORD'], email=env.get('VEEVA_EMAIL', None),
+			novalidate=True, htmlonly=False, only=stage_slides(env, "controls"),
+			cache_dir=get_cache_dir(env['ROOT_DIR'], env['config'], "ctls")))
 
 @action("🚀  %s " % paint.gray("Publishing to Veeva FTP server..."))
 def ACTION_ftp_upload(env, i):
 	# env['progress'].update(i)
-	
-	cmd = os.path.join(env['VELVEEVA_DIR'], "lib", "publish.py")
-	for out in execute(["python3", cmd
-		, "--novalidate"
-		, "--zip", os.path.abspath(os.path.join(env['ROOT_DIR'],env['DEST_DIR'],env['ZIPS_DIR']))
-		, "--ctl", os.path.abspath(os.path.join(env['ROOT_DIR'],env['DEST_DIR'],env['CTLS_DIR']))
+	zip_path = os.path.abspath(os.path.join(env['ROOT_DIR'],env['DEST_DIR'],env['ZIPS_DIR']))
+	ctl_path = os.path.abspath(os.path.join(env['ROOT_DIR'],env['DEST_DIR'],env['CTLS_DIR']))
+
+	options = {'port': env['VEEVA_PORT']}
+	if env.get('FTP_CONNECTIONS') is not None: options['connections'] = env['FTP_CONNECTIONS']
+	if env.get('FTP_BLOCK_SIZE') is not None: options['block_size'] = env['FTP_BLOCK_SIZE']
+
+	def publish(p):
+		zips, ctls = p.match_zips_to_ctls(zip_path, ctl_path, novalidate=True)
+		started = time.time()
+		stats = p.ftp_publish(zips=zips, ctls=ctls, username=env['VEEVA_USERNAME'], password=env['VEEVA_PASSWORD'],
+			server=env['VEEVA_SERVER'], manifest=p.default_manifest_path(env['ROOT_DIR']), dry_run=env['DRY_RUN'], **options)
+		if not env['DRY_RUN']: p.report_stats(stats, time.time() - started, per_file=False)
+
+	run_tool(env, "publish", ["--novalidate"
+		, "--root", env['ROOT_DIR']
+		, "--zip", zip_path
+		, "--ctl", ctl_path
 		, "--host", env['VEEVA_SERVER']
 		, "--u", env['VEEVA_USERNAME']
-		, "--pwd", env['VEEVA_PASSWORD'] ]):
-		print(out)	
+		, "--pwd", env['VEEVA_PASSWORD'] ]
+		+ sum([["--" + key.replace("_", "-"), str(value)] for key, value in sorted(options.items())], [])
+		+ (["--dry-run"] if env['DRY_RUN'] else []), publish)
+
+def relink_build(env, pipeline):
+	def relink_folder(relink):
+		relink.parse_folder(os.path.join(env['ROOT_DIR'], env['DEST_DIR']),
+			actions=[relink.pipeline(pipeline)], parallel=True)
+	return relink_folder
 
 @action("📼  %s " % paint.gray("Converting relative links to Veeva links..."))
 def ACTION_rel_2_veev(env, i):
 	# env['progress'].update(i)
-
-	cmd = os.path.join(env['VELVEEVA_DIR'],"lib","relink.py")
-	for out in execute(["python3", cmd 
-		, "--root", env['ROOT_DIR']
-		, "--rel2veev", env['DEST_DIR'] ]):
-		print(out)
+	run_tool(env, "relink", ["--root", env['ROOT_DIR'], "--rel2veev", env['DEST_DIR'] ],
+		relink_build(env, "rel2veev"))
 
 @action("⚖️  %s " % paint.gray("Converting Veeva links to Relative links..."))
 def ACTION_veev_2_rel(env, i):
 	# env['progress'].update(i)
-
-	cmd = os.path.join(env['VELVEEVA_DIR'],"lib","relink.py")
-	for out in execute(["python3", cmd 
-		, "--root", env['ROOT_DIR']
-		, "--veev2rel", env['DEST_DIR'] ]):
-		print(out)
+	run_tool(env, "relink", ["--root", env['ROOT_DIR'], "--veev2rel", env['DEST_DIR'] ],
+		relink_build(env, "veev2rel"))
 
 @action("➿  %s " % paint.gray("Integrating assets and links..."))
 def ACTION_integrate_all(env, i):
 	#env['progress'].update(i)
-	cmd = os.path.join(env['VELVEEVA_DIR'],"lib","relink.py")
-	for out in execute(["python3", cmd
-		, "--root", env['ROOT_DIR']
-		, "--integrate-all", env['DEST_DIR'] ]):
-		print(out)
+	run_tool(env, "relink", ["--root", env['ROOT_DIR'], "--integrate-all", env['DEST_DIR'] ],
+		relink_build(env, "integrate_all"))
+
+### watch mode ###
+def rebuild_slides(env, plan, templates, partials):
+	assets = load_tool("assets")
+	styles = load_tool("styles")
+	relink = load_tool("relink")
+	render = load_tool("templates")
+
+	root = env['ROOT_DIR']
+	src = os.path.join(root, env['SOURCE_DIR'])
+	build_dir = os.path.join(root, env['DEST_DIR'])
+
+	def existing(stage):
+		return sorted([slide for slide in plan[stage] if os.path.isdir(os.path.join(src, slide))])
+
+	for slide in plan["locals"]:
+		if os.path.exists(os.path.join(build_dir, slide)): shutil.rmtree(os.path.join(build_dir, slide))
+	if len(existing("locals")) > 0:
+		copy_locals(root, env['SOURCE_DIR'], env['DEST_DIR'], only=existing("locals"), link=env['LINK'],
+			batch_size=env['TRANSFER_BATCH'], workers=env['TRANSFER_WORKERS'])
+
+	if len(existing("globals")) > 0:
+		assets.inject(root, env['GLOBALS_DIR'], [os.path.join(env['DEST_DIR'], slide) for slide in existing("globals")], link=env['LINK'])
+
+	for slide in existing("sass"):
+		styles.compile_sass(os.path.join(build_dir, slide), remove_source=True)
+
+	relinked = existing("relink")
+	if len(existing("templates")) > 0:
+		if render.RENDERER is None: render.init_renderer(cache_dir=get_cache_dir(root, env['config'], render.COMPILE_CACHE))
+		result = render.render_batch(src, existing("templates"), build_dir, templates, partials)
+
+		# slides that were only re-rendered, and came out the same, are already relinked
+		unchanged = set(existing("templates")) - set(plan["sass"]) - set(result["changed"])
+		relinked = [slide for slide in relinked if slide not in unchanged]
+
+	if len(relinked) > 0:
+		relink.parse_folder([os.path.join(build_dir, slide) for slide in relinked],
+			actions=[relink.pipeline("veev2rel")], parallel=len(relinked) > 1)
+
+def watch(env):
+	watcher = load_tool("watch")
+	render = load_tool("templates")
+
+	root = env['ROOT_DIR']
+	folders = {
+		"source": os.path.join(root, env['SOURCE_DIR']),
+		"globals": os.path.join(root, env['GLOBALS_DIR']),
+		"templates": os.path.join(root, env['TEMPLATES_DIR']),
+		"partials": os.path.join(root, env['PARTIALS_DIR'])
+	}
+
+	# everything stays loaded between rebuilds
+	templates = render.load_html_files(folders["templates"])
+	partials = render.load_html_files(folders["partials"])
+	deps = render.DependencyGraph(folders["source"], folders["templates"], folders["partials"],
+		render.dependency_graph_path(root, env['config'])).refresh()
+	changes = watcher.watcher(list(folders.values()))
+
+	print("👀  %s" % paint.gray("Watching for changes (ctrl-c to stop)..."))
+	sys.stdout.flush()
+
+	while True:
+		try:
+			changed = changes.wait()
+		except KeyboardInterrupt:
+			return
+
+		start = time.time()
+
+		if any([is_inside(path, folders["templates"]) for path in changed]):
+			templates = render.load_html_files(folders["templates"])
+		if any([is_inside(path, folders["partials"]) for path in changed]):
+			partials = render.load_html_files(folders["partials"])
+
+		plan = watcher.affected_slides(changed, folders, deps)
+		deps.save()
+		slides = set().union(*plan.values())
+		if len(slides) == 0: continue
+
+		try:
+			rebuild_slides(env, plan, templates, partials)
+		except Exception as e:
+			print(paint.bold.red("💩  there was an error:"))
+			print(e)
+		else:
+			print("🍕  %s %s" % (paint.gray("Rebuilt %s in %.2fs" % (", ".join(sorted(slides)), time.time() - start)),
+				paint.gray("(%s)" % ", ".join([stage for stage in watcher.WATCH_STAGES if len(plan[stage]) > 0]))))
+		sys.stdout.flush()
+
+# per-slide stages, in build order, that incremental builds can skip slides in
+SLIDE_STAGES = ["locals", "globals", "sass", "templates", "screenshots", "package", "controls"]
+STAGE_NAMES = {
+	ACTION_inline_local: "locals",
+	ACTION_inline_global: "globals",
+	ACTION_render_sass: "sass",
+	ACTION_render_templates: "templates",
+	ACTION_take_screenshots: "screenshots",
+	ACTION_package_slides: "package",
+	ACTION_generate_ctls: "controls"
+}
 
 def doScript():
 	VERBOSE = False
@@ -342,6 +666,16 @@ def doScript():
 	flags = [name for name, value in vars(args).items() if value == True]
 
 	ENV = create_environment(parse_config())	
+	ENV['IN_PROCESS'] = not args.subprocess
+	ENV['LINK'] = args.link
+	ENV['TRANSFER_BATCH'] = args.transfer_batch
+	ENV['TRANSFER_WORKERS'] = args.transfer_workers
+	ENV['FTP_CONNECTIONS'] = args.ftp_connections
+	ENV['FTP_BLOCK_SIZE'] = args.ftp_block_size
+	ENV['DRY_RUN'] = args.dry_run
+
+	if args.incremental and args.subprocess:
+		print(paint.yellow("Incremental builds need in-process tools, doing a full build"))
 
 	### build planner ###
 	def build_planner(flags):
@@ -426,7 +760,7 @@ def doScript():
 		if len(constraints) > 0:
 			depgraph = build.Depgraph(constraints)
 		else:
-			return [[[idx.get(flag)] for flag in flags]]
+			return [[[idx.get(flag)] for flag in flags if idx.get(flag) is not None]]
 
 		build_plan = depgraph.build_plan()
 		return replace_with_function(build_plan)
@@ -447,34 +781,54 @@ def doScript():
 		#print(banner())
 		#print("👉  %s 👈\n" % paint.bold.yellow(ENV['PROJECT_NAME']))
 
+		# in-process actions run in threads so they share the tools already loaded here
+		# (the heavy lifting happens in each tool's own process pool anyway)
+		if env['IN_PROCESS']:
+			Executor = concurrent.futures.ThreadPoolExecutor
+		else:
+			Executor = concurrent.futures.ProcessPoolExecutor
+
+		completed = []
 		try:
-			with concurrent.futures.ProcessPoolExecutor() as executor:
-			# with ProgressBar(max_value=STEPS, 
-			# 		widgets=[Bar(marker="🍕"),Percentage()], 
-			# 		redirect_stdout=True) as progress, concurrent.futures.ProcessPoolExecutor() as executor:
-				
-				# env['progress'] = progress
-
-				i = 0
-				for step in build_plan:
-					if len(step) == 0:
-						i = i + 1
-					elif len(step) == 1:
-						func = step[0][0]
-						func.announce()
-						func(env, i)
-						i = i + 1
-					else:
-						futures = []
-						for func in step:
-							action = func[0]
-							action.announce()
-							futures.append(executor.submit(action, env, i))
-
-						synchronize_and_wait = [f.result() for f in futures]
-						i = i + 1
-
-				# progress.update(STEPS) # finish up
+			try:
+				with Executor() as executor:
+				# with ProgressBar(max_value=STEPS, 
+				# 		widgets=[Bar(marker="🍕"),Percentage()], 
+				# 		redirect_stdout=True) as progress, concurrent.futures.ProcessPoolExecutor() as executor:
+					
+					# env['progress'] = progress
+
+					i = 0
+					for step in build_plan:
+						if len(step) == 0:
+							i = i + 1
+						elif len(step) == 1:
+							func = step[0][0]
+							func.announce()
+							func(env, i)
+							completed.append(STAGE_NAMES.get(func))
+							i = i + 1
+						else:
+							futures = []
+							for func in step:
+								action = func[0]
+								action.announce()
+								futures.append((action, executor.submit(action, env, i)))
+
+							# let every action in the step finish, so the ones that worked get recorded
+							errors = []
+							for action, future in futures:
+								try:
+									future.result()
+									completed.append(STAGE_NAMES.get(action))
+								except Exception as e:
+									errors.append(e)
+							if len(errors) > 0: raise errors[0]
+							i = i + 1
+
+					# progress.update(STEPS) # finish up
+			finally:
+				if env.get('MANIFEST') is not None: record_incremental(env, completed)
 
 			if env['POSTFLIGHT_HOOK'] and os.path.exists(env['POSTFLIGHT_HOOK']): 
 				for out in execute([ENV['POSTFLIGHT_HOOK']]):
@@ -489,10 +843,17 @@ def doScript():
 	
 	#print(flags)
 	plan = build_planner(flags)
+	if args.incremental and ENV['IN_PROCESS']: plan_incremental(plan, ENV)
 	#print(plan)
 	#print(ENV)
 
 	run_build(plan, ENV)
 
+	if args.watch:
+		if ENV['IN_PROCESS']:
+			watch(ENV)
+		else:
+			print(paint.yellow("Watch mode needs in-process tools"))
+
 if __name__ == '__main__':
 	doScript()
\ No newline at end of file
@@ -1,17 +1,17 @@
 #!/usr/bin/env python3
 from __future__ import print_function
 import activate_venv
-from veevutils import banner
+from veevutils import banner, LINK_MODES
+from transfer import transfer, merge_stats, describe, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS
 
 import argparse
 import fnmatch
 import os
-import shutil
 import sys
 import textwrap
-import concurrent.futures
 
-def inject1(root_dir, src_dir, dest_dir, merge=True, filter="*", verbose=False):
+def inject_pairs(root_dir, src_dir, dest_dir, filter="*"):
+	# (source, destination) for every file to inject, plus every folder to create
 	root_dir = os.path.relpath(root_dir)
 	src_dir = os.path.relpath(src_dir)
 	dest_dir = os.path.relpath(dest_dir)
@@ -19,56 +19,71 @@ def inject1(root_dir, src_dir, dest_dir, merge=True, filter="*", verbose=False):
 	abs_src_path = os.path.abspath(os.path.join(root_dir,src_dir))
 	abs_dest_path = os.path.abspath(os.path.join(root_dir,dest_dir))
 
+	pairs = []
+	dirs = []
 
-	s_walk = os.walk(abs_src_path)
-
-	for current_dir_path, dirs, files in s_walk:
+	for current_dir_path, dirs_, files in os.walk(abs_src_path):
 
 		#get current parent dir relative to the src directory
 		relative_current_folder = os.path.relpath(os.path.abspath(current_dir_path), abs_src_path)
+		dirs.append(os.path.normpath(os.path.join(abs_dest_path, relative_current_folder)))
 
-		# see if the relative directory exists inside of the destination
-		dest_folder = os.path.join(abs_dest_path, relative_current_folder)
-		if not os.path.exists(dest_folder):
-			if verbose: print("Creating %s" % dest_folder)
-			os.mkdir(dest_folder)
-
-		# copy each source file
 		for file in files:
 			if fnmatch.fnmatch(file, filter) and not fnmatch.fnmatch(file, "index.htm*"):
-				src_path = os.path.join(current_dir_path, file)
-				dest_path = os.path.join(abs_dest_path, relative_current_folder, file)
+				pairs.append((os.path.join(current_dir_path, file), os.path.join(abs_dest_path, relative_current_folder, file)))
 
-				if verbose: print("Copying %s to %s" % (src_path, dest_path))
+	return pairs, dirs
 
-				shutil.copy2(src_path, dest_path)
+def inject1(root_dir, src_dir, dest_dir, merge=True, filter="*", verbose=False, link="copy"):
+	pairs, dirs = inject_pairs(root_dir, src_dir, dest_dir, filter)
+	return transfer(pairs, link=link, dirs=dirs, workers=1, verbose=verbose)
 
-def inject(root, srcs, dests, verbose=False):
+def inject(root, srcs, dests, verbose=False, link="copy"):
 	if not type(srcs) == list:
 		srcs = [srcs]
 
 	if not type(dests) == list:
 		dests = [dests]
 
+	stats = []
 	for dest in dests:
 		for src in srcs:
 			if verbose: print("Injecting %s to %s" % (src,dest))
-			inject1(root, src, dest, verbose=verbose)
+			stats.append(inject1(root, src, dest, verbose=verbose, link=link))
 
-def inject_async(root, srcs, dests, verbose=False):
+	return merge_stats(stats)
+
+def inject_async(root, srcs, dests, verbose=False, link="copy", batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS):
 	if not type(srcs) == list: srcs = [srcs]
 	if not type(dests) == list: dests = [dests]
 
-	with concurrent.futures.ProcessPoolExecutor() as executor:
-		futures = {}
-		for dest in dests:
-			for src in srcs:
-				futures[executor.submit(inject1, root, src, dest, verbose=verbose)] = src+dest
-		for future in concurrent.futures.as_completed(futures):
-			try:
-				data = future.result()
-			except Exception as e:
-				raise e
+	# one batched transfer for every file going to every slide
+	pairs = []
+	dirs = []
+	for dest in dests:
+		for src in srcs:
+			p, d = inject_pairs(root, src, dest)
+			pairs, dirs = pairs + p, dirs + d
+
+	return transfer(pairs, link=link, dirs=dirs, batch_size=batch_size, workers=workers, verbose=verbose)
+
+def inject_folder(root, src, dest, root_only=False, parallel=True, verbose=False, link="copy", batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS):
+	if not os.path.exists(os.path.join(root,src)):
+		raise IOError("Source %s does not exist!" % os.path.join(root,src))
+
+	if not os.path.exists(os.path.join(root,dest)):
+		os.makedirs(os.path.join(root,dest))
+
+	if root_only:
+		# dump files into the root, or shared assets subfolder
+		dests = dest
+	else:
+		dests = [os.path.join(dest,sd) for sd in next(os.walk(os.path.join(root,dest)))[1]]
+
+	if parallel:
+		return inject_async(root, src, dests, verbose=verbose, link=link, batch_size=batch_size, workers=workers)
+	else:
+		return inject(root, src, dests, verbose=verbose, link=link)
 
 def runScript(ASYNC=False):
 
@@ -83,6 +98,10 @@ def runScript(ASYNC=False):
 	parser.add_argument("--root", nargs=1, help="Project root directory (current directory is used if nont is specified")
 	parser.add_argument("--use-shared", action="store_true", 
 		help="Use Veeva's shared asset feature")
+	parser.add_argument("--link", choices=LINK_MODES, default="copy",
+		help="Hardlink or reflink (copy-on-write) files instead of copying them, falling back to a copy when the filesystem can't (auto tries reflink, then hardlink)")
+	parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Files per copy task (default: %(default)s)")
+	parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Copy threads (default: %(default)s)")
 	parser.add_argument("--verbose", action="store_true", help="Chatty Cathy")
 
 	if len(sys.argv) == 1:
@@ -110,21 +129,9 @@ def runScript(ASYNC=False):
 			print("Source does not exist!")
 			sys.exit(1)
 
-		if not os.path.exists(os.path.join(root,dest)):
-			os.makedirs(os.path.join(root,dest))
-
-		if ROOT_ONLY or VEEVA_SHARED:
-			# dump files into the root, or shared assets subfolder
-			if ASYNC:
-					inject_async(root, src, dest, verbose=VERBOSE)
-			else:
-				inject(root, src, dest, verbose=VERBOSE)
-		else:
-			subdirs = [os.path.join(dest,sd) for sd in next(os.walk(os.path.join(root,dest)))[1]]
-			if ASYNC:
-				inject_async(root, src, subdirs, verbose=VERBOSE)
-			else:
-				inject(root, src, subdirs, verbose=VERBOSE)
+		stats = inject_folder(root, src, dest, root_only=(ROOT_ONLY or VEEVA_SHARED), parallel=ASYNC, verbose=VERBOSE, link=args.link,
+			batch_size=args.batch_size, workers=args.workers)
+		print(describe(stats))
 
 if __name__ == '__main__':
 	sys.exit(runScript())
@@ -1,25 +1,32 @@
 #!/usr/bin/env python3
 import activate_venv
 
-from veevutils import banner, parse_slide, is_slide
+from veevutils import banner, parse_zip_slide, get_cache_dir, CONFIG_FILENAME
+from manifest import hash_file
+from pdfmeta import pdf_meta, pdf_text
 
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from functools import reduce
 from bs4 import BeautifulSoup
 from git import Repo
 from pdfminer.pdfparser import PDFDocument
 from pdfminer.pdfparser import PDFParser
 from libxmp import consts
-from libxmp import XMPFiles
+from libxmp import XMPFiles, XMPError
+from lxml import etree
 
+import concurrent.futures
+import json
 import re
 import os
+import struct
+import tempfile
+import zlib
 import time
 import sys
 import argparse
 import textwrap
 import fnmatch
-import uuid
 
 # def isSlide(filename):
 # 	return parseSlide(filename) is not None
@@ -37,75 +44,362 @@ import uuid
 
 # 	return None
 
-def parse_meta(filename, htmlonly=False):
-	slide_file = parse_slide(filename)
-	if slide_file is None: 
-		return { 'filename': os.path.basename(filename), 
-				 'veeva_title': os.path.splitext(os.path.basename(filename))[0], 
-				 'veeva_description': os.path.splitext(os.path.basename(filename))[0] }
-
+META_CACHE_FILENAME = "index.json"
+META_VERSION = 3 # bump whenever read_meta starts finding different things, so cached metadata gets re-read
+
+def text(value):
+	if isinstance(value, bytes):
+		try:
+			return value.decode('utf-8')
+		except UnicodeDecodeError:
+			return value.decode('latin-1')
+	return value
+
+JPEG_XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+JPEG_EXIF_HEADER = b"Exif\x00\x00"
+
+XMP_NS_RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XMP_NS_XML = "http://www.w3.org/XML/1998/namespace"
+
+EXIF_IMAGE_DESCRIPTION = 0x010E
+EXIF_XP_TITLE = 0x9C9B
+EXIF_XP_SUBJECT = 0x9C9F
+
+def jpeg_app1(f):
+	# APP1 segments from the header of a jpeg stream, stopping before the compressed
+	# image data (SOS), so only the first few KB of the zip entry are ever read
+	read = []
+	def take(n):
+		data = f.read(n)
+		read.append(data)
+		if len(data) < n: raise ValueError("truncated jpeg")
+		return data
+
+	segments = []
+	try:
+		if take(2) != b"\xff\xd8": raise ValueError("not a jpeg")
+
+		while True:
+			marker = take(2)
+			while marker[1:] == b"\xff": marker = marker[1:] + take(1) # fill bytes
+			if marker[0:1] != b"\xff": raise ValueError("bad jpeg marker")
+
+			code = marker[1]
+			if code == 0xDA or code == 0xD9: break # start of scan / end of image
+			if code == 0x01 or 0xD0 <= code <= 0xD7: continue # markers without a length
+
+			length = struct.unpack(">H", take(2))[0]
+			if length < 2: raise ValueError("bad jpeg segment length")
+			payload = take(length - 2)
+			if code == 0xE1: segments.append(payload)
+	except (ValueError, struct.error):
+		return None, b"".join(read)
+
+	return segments, b"".join(read)
+
+def xmp_alt_text(root, namespace, name):
+	for element in root.iter("{%s}%s" % (namespace, name)):
+		items = list(element.iter("{%s}li" % XMP_NS_RDF))
+		for item in items:
+			if item.get("{%s}lang" % XMP_NS_XML, None) == "x-default": return item.text
+		if len(items) > 0: return items[0].text
+		if element.text is not None and element.text.strip() != '': return element.text
+
+	for element in root.iter("{%s}Description" % XMP_NS_RDF):
+		value = element.get("{%s}%s" % (namespace, name), None) # attribute shorthand
+		if value is not None: return value
+
+	return None
+
+def xmp_meta(packet):
+	root = etree.fromstring(packet.strip(b"\x00 \t\r\n"), etree.XMLParser(recover=True, resolve_entities=False))
+	if root is None: return None, None
+	return xmp_alt_text(root, consts.XMP_NS_DC, "title"), xmp_alt_text(root, consts.XMP_NS_DC, "description")
+
+def exif_meta(tiff):
+	order = {b"II": "<", b"MM": ">"}[tiff[0:2]]
+	ifd = struct.unpack(order + "I", tiff[4:8])[0]
+	count = struct.unpack(order + "H", tiff[ifd:ifd+2])[0]
+	SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 7: 1}
+
+	tags = {}
+	for i in range(count):
+		entry = tiff[ifd+2+i*12:ifd+14+i*12]
+		tag, kind, n = struct.unpack(order + "HHI", entry[0:8])
+		if kind not in SIZES: continue
+
+		size = SIZES[kind] * n
+		value = entry[8:8+size] if size <= 4 else tiff[struct.unpack(order + "I", entry[8:12])[0]:][:size]
+		tags[tag] = value
+
+	def ascii(tag):
+		value = tags.get(tag, b"").rstrip(b"\x00").strip()
+		return None if value == b"" else text(value)
+
+	def ucs2(tag): # windows XP* tags are utf-16le whatever the byte order
+		value = tags.get(tag, b"").decode("utf-16-le", "replace").rstrip("\x00").strip()
+		return None if value == "" else value
+
+	return ucs2(EXIF_XP_TITLE), ascii(EXIF_IMAGE_DESCRIPTION) or ucs2(EXIF_XP_SUBJECT)
+
+def jpeg_meta_xmpfiles(data):
+	# odd files exempi can still make sense of
+	fd, tmp_file_name = tempfile.mkstemp(suffix=".jpg")
+	try:
+		with os.fdopen(fd, 'wb') as tf:
+			tf.write(data)
 
-	with ZipFile(filename, 'r') as z:
-		with(z.open(slide_file[0])) as f:
-			slide_type = slide_file[1]
+		xmpfile = XMPFiles(file_path=tmp_file_name)
+		xmp = xmpfile.get_xmp()
+		xmpfile.close_file()
+		if xmp is None: return None, None
 
+		try:
+			title_string = xmp.get_localized_text(consts.XMP_NS_DC, 'title', None, 'x-default')
+		except XMPError:
 			title_string = None
+
+		try:
+			description_string = xmp.get_localized_text(consts.XMP_NS_DC, 'description', None, 'x-default')
+		except XMPError:
 			description_string = None
 
-			if slide_type == ".htm" or slide_type == ".html":
-				soup = BeautifulSoup(f.read(), "lxml")
+		return title_string, description_string
+	finally:
+		os.remove(tmp_file_name)
 
-				title = soup.find('meta', {'name':'veeva_title'})
-				if title is not None:
-					title_string = title.get('content', None)
+def jpeg_meta(f):
+	# XMP dc:title/dc:description, then EXIF, straight from the APP1 segments of the zip entry
+	segments, header = jpeg_app1(f)
+	if segments is None: return jpeg_meta_xmpfiles(header + f.read())
 
-				description = soup.find('meta', {'name':'veeva_description'})
-				if description is not None:
-					description_string = description.get('content', None)
+	title_string, description_string = None, None
+	xmp = [s[len(JPEG_XMP_HEADER):] for s in segments if s.startswith(JPEG_XMP_HEADER)]
+	exif = [s[len(JPEG_EXIF_HEADER):] for s in segments if s.startswith(JPEG_EXIF_HEADER)]
 
-			if slide_type == ".pdf" and not htmlonly:
-				doc = PDFDocument()
-				parser = PDFParser(f)
+	try:
+		if len(xmp) > 0: title_string, description_string = xmp_meta(xmp[0])
+		if len(exif) > 0 and (title_string is None or description_string is None):
+			exif_title, exif_description = exif_meta(exif[0])
+			if title_string is None: title_string = exif_title
+			if description_string is None: description_string = exif_description
+	except (ValueError, KeyError, IndexError, struct.error, etree.LxmlError):
+		return jpeg_meta_xmpfiles(header + f.read())
+
+	return title_string, description_string
+
+def pdfminer_meta(f):
+	doc = PDFDocument()
+	parser = PDFParser(f)
+
+	# omfg this is so janky, there needs to be a better library
+	parser.set_document(doc)
+	doc.set_parser(parser)
+
+	title_string = None
+	description_string = None
+
+	metadata = doc.info
+	if len(metadata) > 0:
+		latest = metadata[-1]
+		try:
+			if latest['Title'] != '': title_string = latest['Title']
+		except KeyError:
+			title_string = None
 
-				# omfg this is so janky, there needs to be a better library
-				parser.set_document(doc)
-				doc.set_parser(parser)
+		try:
+			if latest['Subject'] != '': description_string = latest['Subject']
+		except KeyError:
+			description_string = None
 
-				metadata = doc.info
-				if len(metadata) > 0:
-					latest = metadata[-1]
-					try:
-						if latest['Title'] != '': title_string = latest['Title']
-					except KeyError:
-						title_string = None
+	return title_string, description_string
 
-					try:
-						if latest['Subject'] != '': description_string = latest['Subject']
-					except KeyError:
-						description_string = None
+def pdf_slide_meta(f):
+	# Info Title/Subject (XMP dc:title/dc:description where those are missing) with seeks only,
+	# pdfminer for anything the lazy reader can't follow
+	try:
+		title_string, description_string, xmp = pdf_meta(f)
+		if (not title_string or not description_string) and xmp is not None:
+			xmp_title, xmp_description = xmp_meta(xmp)
+			title_string = title_string or xmp_title
+			description_string = description_string or xmp_description
+	except (ValueError, KeyError, TypeError, AttributeError, IndexError, zlib.error, etree.LxmlError):
+		f.seek(0)
+		return tuple(pdf_text(value) for value in pdfminer_meta(f))
+
+	return title_string or None, description_string or None
+
+def read_meta(f, slide_type, htmlonly=False):
+	title_string = None
+	description_string = None
+
+	if slide_type == ".htm" or slide_type == ".html":
+		soup = BeautifulSoup(f.read(), "lxml")
+
+		title = soup.find('meta', {'name':'veeva_title'})
+		if title is not None:
+			title_string = title.get('content', None)
+
+		description = soup.find('meta', {'name':'veeva_description'})
+		if description is not None:
+			description_string = description.get('content', None)
+
+	if slide_type == ".pdf" and not htmlonly:
+		title_string, description_string = pdf_slide_meta(f)
+
+	if (slide_type == ".jpg" or slide_type == ".jpeg") and not htmlonly:
+		title_string, description_string = jpeg_meta(f)
+
+	return text(title_string), text(description_string)
+
+class MemberWindow:
+	# seekable view of a stored zip member straight on the zip file, where seeking doesn't
+	# mean decompressing (or re-reading) everything up to the new position
+	def __init__(self, path, offset, size):
+		self.fp = open(path, 'rb')
+		self.offset = offset
+		self.size = size
+		self.pos = 0
+
+	def seek(self, pos, whence=0):
+		if whence == 1: pos = self.pos + pos
+		if whence == 2: pos = self.size + pos
+		self.pos = min(max(0, pos), self.size)
+		return self.pos
+
+	def tell(self):
+		return self.pos
+
+	def read(self, size=-1):
+		if size is None or size < 0 or self.pos + size > self.size: size = self.size - self.pos
+		self.fp.seek(self.offset + self.pos)
+		data = self.fp.read(size)
+		self.pos = self.pos + len(data)
+		return data
+
+	def close(self):
+		self.fp.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def open_member(z, name):
+	info = z.getinfo(name)
+	if info.compress_type != ZIP_STORED or info.flag_bits & 0x1 or z.filename is None: return z.open(name)
+
+	with open(z.filename, 'rb') as fp:
+		fp.seek(info.header_offset)
+		header = fp.read(30)
+
+	if header[0:4] != b"PK\x03\x04": return z.open(name)
+	name_length, extra_length = struct.unpack("<HH", header[26:30])
+	return MemberWindow(z.filename, info.header_offset + 30 + name_length + extra_length, info.file_size)
+
+def zip_meta(filename, htmlonly=False):
+	# the name list, the slide file and its metadata all come out of one open zip
+	with ZipFile(filename, 'r') as z:
+		slide_file = parse_zip_slide(z, filename)
+		if slide_file is None:
+			return { 'filename': os.path.basename(filename),
+					 'veeva_title': os.path.splitext(os.path.basename(filename))[0],
+					 'veeva_description': os.path.splitext(os.path.basename(filename))[0],
+					 'is_slide': False }
 
-			if slide_type == ".jpg" or slide_type == ".jpeg" and not htmlonly:
-				tmp_file_name = str(uuid.uuid1()) + ".jpg"
-				with open(tmp_file_name, 'wb') as tf:
-					tf.write(f.read())
+		with open_member(z, slide_file[0]) as f:
+			title_string, description_string = read_meta(f, slide_file[1], htmlonly)
 
-				xmpfile = XMPFiles(file_path=tmp_file_name)
-				xmp = xmpfile.get_xmp()
-				xmpfile.close_file()
+	return {"filename": filename, "veeva_title": title_string, "veeva_description": description_string, "is_slide": True}
 
-				try:
-					title_string = xmp.get_localized_text(consts.XMP_NS_DC, 'title', None, 'x-default')
-				except XMPError:
-					title_string = None
+def parse_meta(filename, htmlonly=False):
+	meta = zip_meta(filename, htmlonly)
+	del meta['is_slide']
+	return meta
+
+class MetaCache:
+	# slide metadata by zip contents, so unchanged zips don't get opened again
+	def __init__(self, path):
+		self.path = path
+		self.zips = {}
+		self.stats = {}
+
+		if os.path.exists(path):
+			try:
+				with open(path) as f:
+					cached = json.load(f)
+				self.zips, self.stats = cached.get("zips", {}), cached.get("stats", {})
+			except ValueError:
+				pass # corrupt cache, every zip gets parsed again
+
+	def key(self, filename, htmlonly=False):
+		# zips that haven't been touched since the last run don't even get hashed
+		filename = os.path.abspath(filename)
+		st = os.stat(filename)
+		recorded = self.stats.get(filename, None)
+
+		if recorded is not None and recorded[0] == st.st_size and recorded[1] == st.st_mtime_ns:
+			sha1 = recorded[2]
+		else:
+			sha1 = hash_file(filename).hexdigest()
+			self.stats[filename] = [st.st_size, st.st_mtime_ns, sha1]
+
+		return "%s:%s:%d" % (sha1, "html" if htmlonly else "all", META_VERSION)
+
+	def get(self, key, filename):
+		meta = self.zips.get(key, None)
+		if meta is None: return None
+
+		meta = dict(meta)
+		if meta['is_slide']: meta['filename'] = filename
+		return meta
+
+	def put(self, key, meta):
+		meta = dict(meta)
+		meta['filename'] = os.path.basename(meta['filename'])
+		self.zips[key] = meta
+
+	def save(self):
+		parent = os.path.dirname(self.path)
+		if parent != '' and not os.path.exists(parent): os.makedirs(parent)
+
+		live = set([stat[2] for filename, stat in self.stats.items() if os.path.exists(filename)])
+		self.stats = dict([(filename, stat) for filename, stat in self.stats.items() if stat[2] in live and os.path.exists(filename)])
+		self.zips = dict([(key, meta) for key, meta in self.zips.items() if key.split(":")[0] in live])
+
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({"zips": self.zips, "stats": self.stats}, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.path)
+
+def collect_meta(filenames, htmlonly=False, cache_dir=None, parallel=True, workers=None):
+	cache = None if cache_dir is None else MetaCache(os.path.join(cache_dir, META_CACHE_FILENAME))
+
+	metas = {}
+	keys = {}
+	for filename in filenames:
+		if cache is None: continue
+		keys[filename] = cache.key(filename, htmlonly)
+		meta = cache.get(keys[filename], filename)
+		if meta is not None: metas[filename] = meta
+
+	misses = [filename for filename in filenames if filename not in metas]
+
+	if parallel and len(misses) > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+			chunksize = max(1, len(misses) // (4 * (workers or os.cpu_count() or 1)))
+			parsed = list(executor.map(zip_meta, misses, [htmlonly] * len(misses), chunksize=chunksize))
+	else:
+		parsed = [zip_meta(filename, htmlonly) for filename in misses]
 
-				try:
-					description_string = xmp.get_localized_text(consts.XMP_NS_DC, 'description', None, 'x-default')
-				except XMPError:
-					description_string = None
+	for filename, meta in zip(misses, parsed):
+		metas[filename] = meta
+		if cache is not None: cache.put(keys[filename], meta)
 
-				os.remove(tmp_file_name)
+	if cache is not None: cache.save()
 
-	return {"filename": filename, "veeva_title": title_string, "veeva_description": description_string}
+	return [metas[filename] for filename in filenames]
 
 def parseCurrentCommit(repo_path):
 	r = Repo(repo_path)
@@ -121,9 +415,9 @@ def parseCurrentVersion(root_path):
 
 	return v
 
-def createRecordString(filename, version=None, email=None, username=None, password=None, htmlonly=False):
+def createRecordString(filename, version=None, email=None, username=None, password=None, htmlonly=False, meta=None):
 
-	meta = parse_meta(filename, htmlonly=htmlonly)
+	if meta is None: meta = parse_meta(filename, htmlonly=htmlonly)
 	pieces = []
 
 	pieces.append("USER="+str(username))
@@ -163,6 +457,7 @@ def parseFolder(src, **kwargs):
 
 	novalidate = kwargs["novalidate"]
 	htmlonly = kwargs["htmlonly"]
+	only = kwargs.get("only", None) # limit to these slide names
 
 	if not os.path.exists(dest_path): os.makedirs(dest_path)
 
@@ -170,26 +465,112 @@ def parseFolder(src, **kwargs):
 	matches = []
 	for root, dirnames, filenames in os.walk(source_path):
 		for filename in fnmatch.filter(filenames, "*.zip"):
-			if novalidate:
-				matches.append(os.path.join(root,filename))
-			else:
-				if is_slide(os.path.join(root,filename)): matches.append(os.path.join(root,filename))
+			if only is not None and os.path.splitext(filename)[0] not in only: continue
+			matches.append(os.path.join(root,filename))
 
+	# validating a zip is a by-product of reading its metadata, so it doesn't cost another open
+	metas = collect_meta(matches, htmlonly=htmlonly, cache_dir=kwargs.get("cache_dir", None),
+		parallel=kwargs.get("parallel", True), workers=kwargs.get("workers", None))
+	if not novalidate:
+		matches, metas = [m for m, meta in zip(matches, metas) if meta['is_slide']], [meta for meta in metas if meta['is_slide']]
 
-	control_files = [createRecordString(m, version=version, username=username, password=password, email=email) for m in matches]
+	control_files = [createRecordString(m, version=version, username=username, password=password, email=email, htmlonly=htmlonly, meta=meta)
+		for m, meta in zip(matches, metas)]
 
 	for control in control_files:
 		with open(os.path.join(dest_path, control['filename']), 'w') as f:
 			f.write(control['record'])
 
+def synthetic_pdf(path, size_mb, title, subject):
+	# a deck of full page grayscale images, with a later incremental update changing the Info dictionary
+	XMP = ('<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?><x:xmpmeta xmlns:x="adobe:ns:meta/">'
+		'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description xmlns:dc="http://purl.org/dc/elements/1.1/">'
+		'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">%s</rdf:li></rdf:Alt></dc:title></rdf:Description></rdf:RDF></x:xmpmeta>'
+		'<?xpacket end="w"?>' % title).encode("utf-8")
+	SIDE = 512
+	pages = max(1, size_mb * 1024 * 1024 // (SIDE * SIDE))
+
+	with open(path, 'wb') as f:
+		offsets = {}
+		def obj(num, body, stream=None):
+			offsets[num] = f.tell()
+			f.write(("%d 0 obj\n" % num).encode("ascii") + body)
+			if stream is not None: f.write(b"\nstream\n" + stream + b"\nendstream")
+			f.write(b"\nendobj\n")
+
+		def xref(nums, trailer):
+			start = f.tell()
+			f.write(b"xref\n")
+			if 0 in nums: f.write(b"0 1\n0000000000 65535 f\r\n")
+			for num in sorted(n for n in nums if n != 0):
+				f.write(("%d 1\n%010d 00000 n\r\n" % (num, offsets[num])).encode("ascii"))
+			f.write(b"trailer\n" + trailer + ("\nstartxref\n%d\n%%%%EOF\n" % start).encode("ascii"))
+			return start
+
+		f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+		kids = " ".join(["%d 0 R" % (5 + 3*i) for i in range(pages)])
+		obj(1, b"<< /Type /Catalog /Pages 2 0 R /Metadata 4 0 R >>")
+		obj(2, ("<< /Type /Pages /Count %d /Kids [%s] >>" % (pages, kids)).encode("ascii"))
+		obj(3, b"<< /Title (Draft) /Producer (VELVEEVA) >>")
+		obj(4, ("<< /Type /Metadata /Subtype /XML /Length %d >>" % len(XMP)).encode("ascii"), XMP)
+
+		for i in range(pages):
+			page, content, image = 5 + 3*i, 6 + 3*i, 7 + 3*i
+			draw = ("q %d 0 0 %d 0 0 cm /Im0 Do Q" % (SIDE, SIDE)).encode("ascii")
+			obj(page, ("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R /Resources << /XObject << /Im0 %d 0 R >> >> >>"
+				% (SIDE, SIDE, content, image)).encode("ascii"))
+			obj(content, ("<< /Length %d >>" % len(draw)).encode("ascii"), draw)
+			obj(image, ("<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray /BitsPerComponent 8 /Length %d >>"
+				% (SIDE, SIDE, SIDE*SIDE)).encode("ascii"), os.urandom(SIDE*SIDE))
+
+		size = 5 + 3*pages
+		first = xref([0] + list(range(1, size)), ("<< /Size %d /Root 1 0 R /Info 3 0 R >>" % size).encode("ascii"))
+
+		obj(3, ("<< /Title (%s) /Subject <FEFF%s> /Producer (VELVEEVA) >>" % (title, subject.encode("utf-16-be").hex())).encode("latin-1"))
+		xref([3], ("<< /Size %d /Root 1 0 R /Info 3 0 R /Prev %d >>" % (size, first)).encode("ascii"))
+
+def benchmark(size=50, pdfs=3):
+	with tempfile.TemporaryDirectory() as tmp:
+		zips = []
+		for n in range(pdfs):
+			slide = "slide_%d" % n
+			pdf = os.path.join(tmp, slide + ".pdf")
+			synthetic_pdf(pdf, size, "Slide %d" % n, "Subject %d \u2013 %dMB" % (n, size))
+
+			zips.append(os.path.join(tmp, slide + ".zip"))
+			with ZipFile(zips[-1], 'w', ZIP_STORED) as z: # packaging stores pdfs
+				z.write(pdf, os.path.join(slide, slide + ".pdf"))
+			os.remove(pdf)
+
+		def with_pdfminer(filename):
+			with ZipFile(filename, 'r') as z:
+				slide_file = parse_zip_slide(z, filename)
+				with z.open(slide_file[0]) as f:
+					return tuple(pdf_text(value) for value in pdfminer_meta(f)) # pdfminer leaves utf-16 strings encoded
+
+		def with_seeks(filename):
+			meta = zip_meta(filename)
+			return meta['veeva_title'], meta['veeva_description']
+
+		results = {}
+		for name, read in [("pdfminer", with_pdfminer), ("seek-only reader", with_seeks)]:
+			start = time.time()
+			results[name] = [read(filename) for filename in zips]
+			print("%s: %.3fs for %d x %dMB pdfs" % (name, time.time() - start, pdfs, size))
+
+		same = results["pdfminer"] == results["seek-only reader"]
+		print("identical output: %s" % same)
+		if not same: print(results)
+		return same
+
 def runScript():
 	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
 		description = banner(subtitle=".ctl File Generator"))
 
-	parser.add_argument("source", nargs=1, help="path to folder containing zip files to process")
-	parser.add_argument("destination", nargs=1, help="path for output ctl files (will be created if it does not exist)")
-	parser.add_argument("--u", metavar="USERNAME", nargs=1, help="Veeva username", required=True)
-	parser.add_argument("--pwd", metavar="PASSWORD", nargs=1, help="Veeva password", required=True)
+	parser.add_argument("source", nargs="?", help="path to folder containing zip files to process")
+	parser.add_argument("destination", nargs="?", help="path for output ctl files (will be created if it does not exist)")
+	parser.add_argument("--u", metavar="USERNAME", nargs=1, help="Veeva username (required)")
+	parser.add_argument("--pwd", metavar="PASSWORD", nargs=1, help="Veeva password (required)")
 	parser.add_argument("--email", nargs=1, help="Optional email for errors", required=False)
 	parser.add_argument("--verbose", action="store_true", help="Chatty Cathy", required=False)
 	parser.add_argument("--root", nargs=1,
@@ -197,12 +578,22 @@ def runScript():
 		 required=False)
 	parser.add_argument("--novalidate", action="store_true", help="Don't check to see if each zip file is a slide")
 	parser.add_argument("--htmlonly", action="store_true", help="Only check for metadata on html files")
+	parser.add_argument("--nocache", action="store_true", help="Read every zip instead of reusing the metadata of unchanged ones")
+	parser.add_argument("--notparallel", action="store_true", help="Read zips one after another")
+	parser.add_argument("--workers", type=int, default=None, help="Processes reading zips (default: one per cpu)")
+	parser.add_argument("--benchmark", nargs="?", type=int, const=50, metavar="MB", help="time pdfminer against the seek-only reader on synthetic pdf slides of this size")
 	if len(sys.argv) == 1:
 		parser.print_help()
 		return 2
 	else:
 		args = parser.parse_args()
 
+	if args.benchmark is not None:
+		return 0 if benchmark(args.benchmark) else 1
+
+	if args.source is None or args.destination is None or args.u is None or args.pwd is None:
+		parser.error("source, destination, --u and --pwd are required")
+
 	email = None
 	if args.email is not None: email = args.email[0]
 	if args.root is None:
@@ -210,10 +601,16 @@ def runScript():
 	else:
 		ROOT = args.root[0]
 
-	SOURCE = args.source[0]
-	DEST = args.destination[0]
+	SOURCE = args.source
+	DEST = args.destination
+
+	cache_dir = None
+	if not args.nocache and os.path.exists(os.path.join(ROOT, CONFIG_FILENAME)):
+		with open(os.path.join(ROOT, CONFIG_FILENAME)) as f:
+			cache_dir = get_cache_dir(ROOT, json.load(f), "ctls")
 
-	parseFolder(SOURCE, out=DEST, root=ROOT, username=args.u[0], password=args.pwd[0], email=email, novalidate=args.novalidate, htmlonly=args.htmlonly)
+	parseFolder(SOURCE, out=DEST, root=ROOT, username=args.u[0], password=args.pwd[0], email=email, novalidate=args.novalidate, htmlonly=args.htmlonly,
+		cache_dir=cache_dir, parallel=not args.notparallel, workers=args.workers)
 
 if __name__ == "__main__":
 	sys.exit(runScript())
\ No newline at end of file
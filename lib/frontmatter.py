@@ -0,0 +1,53 @@
+import re
+
+# a slide or template can start with a block of "key: value" lines between two --- lines:
+#
+#   ---
+#   template: main.html
+#   title: Intro
+#   ---
+#   <h1>...</h1>
+
+DELIMITER = "---\n"
+
+# key: anything but digits, whitespace and colons; value: the rest of the line, starting at its first non-blank.
+# rows are found anywhere in the header, so "my title: x" reads as title = x, like the old pyparsing grammar did
+ROW = re.compile(r"([^0-9\s:]+)[ \t]*:[ \t]*([^\r\n \t][^\r\n]*)")
+
+def parse_config(config):
+	# pyparsing expanded tabs before scanning, values with tabs in them still come out that way
+	return dict([(match.group(1), match.group(2)) for match in ROW.finditer(config.expandtabs())])
+
+def split(src):
+	# (header text or None, everything after the header)
+	if not src.startswith(DELIMITER): return None, src
+
+	end = src.find("\n" + DELIMITER, len(DELIMITER))
+	if end == -1: return None, src
+
+	return src[len(DELIMITER):end], src[end + len(DELIMITER) + 1:]
+
+def parse(src):
+	config, remaining = split(src)
+	if config is None:
+		# no config found, return source
+		return {"context": {}, "src": src}
+
+	return {"context": parse_config(config), "src": remaining}
+
+def read(path):
+	with open(path) as f:
+		return parse(f.read())
+
+def read_header(path):
+	# just the context, reading no further into the file than the closing ---
+	with open(path) as f:
+		if f.readline() != DELIMITER: return {}
+
+		lines = []
+		for line in f:
+			if line == DELIMITER and len(lines) > 0: # the header is at least the newline before the closing ---
+				return parse_config("".join(lines)[:-1])
+			lines.append(line)
+
+	return {} # never closed, so it isn't a header
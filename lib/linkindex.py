@@ -0,0 +1,142 @@
+from veevutils import CONFIG_FILENAME, parse_slide_path, parse_veeva_href, parse_veeva_onclick
+from manifest import hash_file
+
+from bs4 import BeautifulSoup # also requires lxml
+from urllib.parse import urlparse
+
+import fnmatch
+import json
+import os
+import sqlite3
+
+INDEX_FILENAME = "link-index.sqlite"
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha1 TEXT)",
+	"CREATE TABLE IF NOT EXISTS parsed (sha1 TEXT PRIMARY KEY)",
+	"CREATE TABLE IF NOT EXISTS links (sha1 TEXT, kind TEXT, value TEXT, slide TEXT)",
+	"CREATE INDEX IF NOT EXISTS links_slide ON links (slide)",
+	"CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1)"
+]
+
+def default_index_path(root_dir):
+	config_file = os.path.join(root_dir, CONFIG_FILENAME)
+	if not os.path.exists(config_file): return None
+
+	with open(config_file) as f:
+		config = json.load(f)
+
+	return os.path.join(root_dir, config['MAIN']['temp_dir'], INDEX_FILENAME)
+
+def zip_target(args):
+	# gotoSlide(slide.zip) and gotoSlide(slide.zip, presentation) both point at slide
+	if len(args) == 0: return None
+
+	slide_name, extension = os.path.splitext(args[0].strip().strip("'\""))
+	return slide_name if extension == ".zip" else None
+
+def href_target(href):
+	veeva = parse_veeva_href(href)
+	if veeva is not None: return zip_target(veeva.command_args.split(","))
+
+	if urlparse(href).netloc != '': return None
+
+	path = parse_slide_path(href)
+	return None if path is None else path.slide_name
+
+def onclick_target(onclick):
+	try:
+		call = parse_veeva_onclick(onclick)
+	except ValueError:
+		return None # arguments that aren't simple string literals
+
+	return None if call is None else zip_target(call.command_args)
+
+def find_links(src):
+	soup = BeautifulSoup(src, "lxml")
+	links = []
+
+	for item in soup.find_all("a", href=True):
+		links.append(("href", item["href"], href_target(item["href"])))
+
+	for item in soup.find_all(onclick=True):
+		links.append(("onclick", item["onclick"], onclick_target(item["onclick"])))
+
+	return [link for link in links if link[2] is not None]
+
+def in_folders(path, folders):
+	if folders is None: return True
+	if isinstance(folders, str): folders = [folders]
+	return any([path.startswith(os.path.join(os.path.abspath(folder), '')) for folder in folders])
+
+class LinkIndex:
+	def __init__(self, path):
+		parent = os.path.dirname(path)
+		if parent != '' and not os.path.exists(parent): os.makedirs(parent)
+
+		self.path = path
+		self.folders = None # what the last update covered, lookups only answer for those
+		self.db = sqlite3.connect(path)
+		for statement in SCHEMA: self.db.execute(statement)
+
+	def close(self):
+		self.db.close()
+
+	def update(self, folders):
+		if isinstance(folders, str): folders = [folders]
+		self.folders = folders
+
+		seen = set()
+		for folder in folders:
+			for root, dirnames, filenames in os.walk(folder):
+				for filename in fnmatch.filter(filenames, "*.htm*"):
+					path = os.path.abspath(os.path.join(root, filename))
+					seen.add(path)
+					self.update_file(path)
+
+		# files that were deleted (or renamed away) since the last update
+		for folder in folders:
+			prefix = os.path.join(os.path.abspath(folder), '')
+			indexed = self.db.execute("SELECT path FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+			self.db.executemany("DELETE FROM files WHERE path = ?", [row for row in indexed if row[0] not in seen])
+
+		self.db.execute("DELETE FROM links WHERE sha1 NOT IN (SELECT sha1 FROM files)")
+		self.db.execute("DELETE FROM parsed WHERE sha1 NOT IN (SELECT sha1 FROM files)")
+		self.db.commit()
+
+		return self
+
+	def update_file(self, path):
+		st = os.stat(path)
+		row = self.db.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (path,)).fetchone()
+		if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns: return False
+
+		sha1 = hash_file(path).hexdigest()
+		self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, sha1) VALUES (?, ?, ?, ?)",
+			(path, st.st_size, st.st_mtime_ns, sha1))
+
+		# touched, copied or moved files with contents we've already seen don't get parsed again
+		if self.db.execute("SELECT 1 FROM parsed WHERE sha1 = ?", (sha1,)).fetchone() is not None: return False
+
+		with open(path, 'rb') as f:
+			links = find_links(f)
+
+		self.db.execute("INSERT INTO parsed (sha1) VALUES (?)", (sha1,))
+		self.db.executemany("INSERT INTO links (sha1, kind, value, slide) VALUES (?, ?, ?, ?)",
+			[(sha1, kind, value, slide) for kind, value, slide in links])
+		return True
+
+	def links_to(self, slide, folders=None):
+		# the index can hold other trees too (src and build share one), so stick to the folders asked about
+		if folders is None: folders = self.folders
+
+		rows = self.db.execute(
+			"SELECT files.path, links.kind, links.value FROM links JOIN files ON files.sha1 = links.sha1 "
+			"WHERE links.slide = ? ORDER BY files.path", (slide,)).fetchall()
+		return [row for row in rows if in_folders(row[0], folders)]
+
+	def files_linking_to(self, slides, folders=None):
+		files = set()
+		for slide in slides:
+			files.update([path for path, kind, value in self.links_to(slide, folders)])
+		return sorted(files)
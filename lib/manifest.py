@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILENAME = "build-manifest.json"
+BLOCK_SIZE = 1024*1024
+
+def hash_file(path, digest=None):
+	if digest is None: digest = hashlib.sha1()
+
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+			digest.update(block)
+
+	return digest
+
+def hash_tree(path, digest=None):
+	if digest is None: digest = hashlib.sha1()
+	if not os.path.exists(path): return digest
+
+	if os.path.isfile(path): return hash_file(path, digest)
+
+	for root, dirs, files in os.walk(path):
+		dirs.sort() # walk in a stable order
+		for file in sorted(files):
+			full_path = os.path.join(root, file)
+			digest.update(os.path.relpath(full_path, path).encode('utf-8'))
+			hash_file(full_path, digest)
+
+	return digest
+
+def hash_paths(paths, digest=None, relative_to=None):
+	if digest is None: digest = hashlib.sha1()
+
+	for path in paths:
+		name = path if relative_to is None else os.path.relpath(path, relative_to)
+		digest.update(name.encode('utf-8'))
+		hash_tree(path, digest)
+
+	return digest
+
+def stat_tree(path):
+	# cheap signature for build outputs (no file contents are read)
+	if not os.path.exists(path): return None
+
+	digest = hashlib.sha1()
+
+	if os.path.isfile(path):
+		st = os.stat(path)
+		digest.update(("%d:%d" % (st.st_size, st.st_mtime_ns)).encode('utf-8'))
+		return digest.hexdigest()
+
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for file in sorted(files):
+			full_path = os.path.join(root, file)
+			st = os.stat(full_path)
+			digest.update(("%s:%d:%d" % (os.path.relpath(full_path, path), st.st_size, st.st_mtime_ns)).encode('utf-8'))
+
+	return digest.hexdigest()
+
+class BuildManifest:
+	def __init__(self, path):
+		self.path = path
+		self.slides = {}
+
+		if os.path.exists(path):
+			try:
+				with open(path) as f:
+					self.slides = json.load(f).get("slides", {})
+			except ValueError:
+				self.slides = {} # corrupt manifest, everything gets rebuilt
+
+	def get(self, stage, slide):
+		return self.slides.get(slide, {}).get(stage, None)
+
+	def is_dirty(self, stage, slide, inputs, outputs):
+		recorded = self.get(stage, slide)
+		if recorded is None: return True
+
+		return recorded["inputs"] != inputs or not self.is_intact(stage, slide, outputs)
+
+	def is_intact(self, stage, slide, outputs):
+		# outputs are just as they were when last recorded
+		recorded = self.get(stage, slide)
+		return recorded is not None and recorded["outputs"] == stat_tree(outputs)
+
+	def record(self, stage, slide, inputs, outputs):
+		self.slides.setdefault(slide, {})[stage] = {"inputs": inputs, "outputs": stat_tree(outputs)}
+
+	def forget(self, slide, stage=None):
+		if stage is None:
+			self.slides.pop(slide, None)
+		else:
+			self.slides.get(slide, {}).pop(stage, None)
+
+	def save(self):
+		parent = os.path.dirname(self.path)
+		if parent != '' and not os.path.exists(parent): os.makedirs(parent)
+
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({"slides": self.slides}, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.path)
@@ -1,63 +1,302 @@
 #!/usr/bin/env python3
 import activate_venv
 
-from veevutils import banner
+from veevutils import banner, get_cache_dir, CONFIG_FILENAME
 
 import argparse
+import copy
 import glob
+import hashlib
+import json
 import os
+import struct
 import sys
 import textwrap
+import time
 import zipfile
+import zlib
 import functools
 import concurrent.futures
 
-def zip_slides(root_dir, slides, dest, verbose=False):
+BLOCK_SIZE = 1024*1024
+MIN_CACHED_SIZE = 16*1024 # smaller files are deflated in place, they're cheap and rarely shared
+CACHE_MAX_AGE = 30*24*60*60 # seconds a compressed entry stays cached without being used
+
+# already compressed formats, deflating them again burns cpu for next to nothing
+STORED_EXTENSIONS = [".mp4", ".m4v", ".mov", ".webm", ".mp3", ".m4a", ".jpg", ".jpeg", ".png", ".gif", ".webp",
+	".pdf", ".woff", ".woff2", ".zip", ".gz"]
+
+# overridden by the optional "PACKAGE" section of the config file
+DEFAULT_POLICY = {
+	"store": STORED_EXTENSIONS, # extensions that are never deflated
+	"levels": {}, # deflate level per extension, e.g. {".html": 9}
+	"level": 6, # deflate level for everything else
+	"sample": 0, # bytes of each file to test compress first (0 to always deflate)
+	"min_saving": 0.05 # store files whose sample shrinks by less than this
+}
+
+def load_policy(config=None):
+	policy = dict(DEFAULT_POLICY)
+	if config is not None: policy.update(config.get("PACKAGE", {}))
+
+	policy["store"] = [ext.lower() for ext in policy["store"]]
+	policy["levels"] = dict([(ext.lower(), level) for ext, level in policy["levels"].items()])
+	return policy
+
+def worth_compressing(path, level, policy):
+	with open(path, 'rb') as f:
+		sample = f.read(policy["sample"])
+
+	if len(sample) == 0: return False
+	return 1 - len(zlib.compress(sample, level)) / len(sample) >= policy["min_saving"]
+
+def compression_for(path, policy):
+	ext = os.path.splitext(path)[1].lower()
+	level = policy["levels"].get(ext, policy["level"])
+
+	if ext in policy["store"] or level == 0: return zipfile.ZIP_STORED, None
+	if policy["sample"] > 0 and not worth_compressing(path, level, policy): return zipfile.ZIP_STORED, None
+
+	return zipfile.ZIP_DEFLATED, level
+
+def policy_changed(path, zinfo, policy):
+	# would the current policy have packed this entry differently?
+	ext = os.path.splitext(path)[1].lower()
+	level = policy["levels"].get(ext, policy["level"])
+
+	if ext in policy["store"] or level == 0:
+		return zinfo.compress_type != zipfile.ZIP_STORED
+
+	if policy["sample"] > 0:
+		if zinfo.compress_type == zipfile.ZIP_DEFLATED: # the entry's own ratio beats a sample
+			return zinfo.file_size == 0 or 1 - zinfo.compress_size / zinfo.file_size < policy["min_saving"]
+		return worth_compressing(path, level, policy)
+
+	return zinfo.compress_type != zipfile.ZIP_DEFLATED
+
+def zip_slides(root_dir, slides, dest, verbose=False, policy=None, cache_dir=None):
 	if not os.path.exists(os.path.join(root_dir,dest)): os.makedirs(os.path.join(root_dir,dest))
 
-	for slide in slides:
-		zip_one(root_dir, slide, dest, verbose)
+	stats = [zip_one(root_dir, slide, dest, verbose, policy, cache_dir) for slide in slides]
+	prune_cache(cache_dir)
 
-def zip_slides_async(root_dir, slides, dest, verbose=False):
+	return stats
+
+def zip_slides_async(root_dir, slides, dest, verbose=False, policy=None, cache_dir=None):
 
 	if not os.path.exists(os.path.join(root_dir,dest)): os.makedirs(os.path.join(root_dir,dest))
 
 	with concurrent.futures.ProcessPoolExecutor() as executor:
-		futures = {executor.submit(zip_one, root_dir, slide, dest, verbose): slide for slide in slides}
+		futures = {executor.submit(zip_one, root_dir, slide, dest, verbose, policy, cache_dir): slide for slide in slides}
+		stats = []
 
 		for future in concurrent.futures.as_completed(futures):
 			try:
-				data = future.result()
+				stats.append(future.result())
 			except Exception as e:
 				raise e
 
-def zip_one(root_dir, slide, dest, verbose=False):
+	prune_cache(cache_dir)
+	return stats
+
+def file_crc(path):
+	crc = 0
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+			crc = zlib.crc32(block, crc)
+	return crc & 0xffffffff
+
+def is_unchanged(path, zinfo, policy):
+	st = os.stat(path)
+	if zinfo is None or st.st_size != zinfo.file_size: return False
+	if policy_changed(path, zinfo, policy): return False
+
+	# zip timestamps only have 2 second resolution, an edit right after the last build can keep the same one
+	return file_crc(path) == zinfo.CRC
+
+def write_entry_raw(dest, zinfo, src_fp):
+	# write an entry whose compressed bytes are already known (src_fp is positioned at them)
+	entry = copy.copy(zinfo)
+	entry.flag_bits = entry.flag_bits & ~0x08 # sizes and crc go in the local header, no data descriptor
+	entry.header_offset = dest.fp.tell()
+	dest.fp.write(entry.FileHeader())
+
+	remaining = zinfo.compress_size
+	while remaining > 0:
+		block = src_fp.read(min(BLOCK_SIZE, remaining))
+		if len(block) == 0: raise zipfile.BadZipFile("%s is truncated" % zinfo.filename)
+		dest.fp.write(block)
+		remaining = remaining - len(block)
+
+	dest.filelist.append(entry)
+	dest.NameToInfo[entry.filename] = entry
+	dest.start_dir = dest.fp.tell()
+	dest._didModify = True
+
+def copy_entry_raw(src, zinfo, dest):
+	# move the already compressed bytes of an entry from one archive to another
+	src.fp.seek(zinfo.header_offset)
+	header = struct.unpack(zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+	src.fp.seek(zinfo.header_offset + zipfile.sizeFileHeader +
+		header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+	write_entry_raw(dest, zinfo, src.fp)
+
+def hash_and_crc(path):
+	digest = hashlib.sha1()
+	crc = 0
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+			digest.update(block)
+			crc = zlib.crc32(block, crc)
+	return digest.hexdigest(), crc & 0xffffffff
+
+def deflated_entry(cache_dir, path, level):
+	# deflate each distinct file once, the raw stream is kept by content hash for every zip that needs it
+	sha1, crc = hash_and_crc(path)
+	cached = os.path.join(cache_dir, sha1[:2], "%s.%d.deflate" % (sha1, level))
+
+	if os.path.exists(cached):
+		os.utime(cached) # recently used, keeps it from being pruned
+		return cached, crc, True
+
+	if not os.path.exists(os.path.dirname(cached)): os.makedirs(os.path.dirname(cached), exist_ok=True)
+
+	tmp_path = "%s.%d.tmp" % (cached, os.getpid()) # other packaging processes might be writing the same file
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15) # raw deflate, the way zips store it
+	with open(path, 'rb') as f, open(tmp_path, 'wb') as out:
+		for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+			out.write(compressor.compress(block))
+		out.write(compressor.flush())
+
+	os.replace(tmp_path, cached)
+	return cached, crc, False
+
+def write_cached(dest, path, archive_name, level, cache_dir):
+	stream, crc, hit = deflated_entry(cache_dir, path, level)
+
+	zinfo = zipfile.ZipInfo.from_file(path, archive_name)
+	zinfo.compress_type = zipfile.ZIP_DEFLATED
+	zinfo.CRC = crc
+	zinfo.compress_size = os.path.getsize(stream)
+
+	with open(stream, 'rb') as f:
+		write_entry_raw(dest, zinfo, f)
+
+	return hit
+
+def prune_cache(cache_dir, max_age=CACHE_MAX_AGE):
+	if cache_dir is None or not os.path.exists(cache_dir): return
+
+	cutoff = time.time() - max_age
+	for root, dirs, files in os.walk(cache_dir):
+		for file in files:
+			path = os.path.join(root, file)
+			try:
+				if os.stat(path).st_mtime < cutoff: os.remove(path)
+			except FileNotFoundError:
+				pass # pruned by someone else
+
+def read_zip(zip_path):
+	if not os.path.exists(zip_path): return None
+	try:
+		return zipfile.ZipFile(zip_path, 'r')
+	except zipfile.BadZipFile:
+		return None # rebuilt from scratch
+
+def zip_stats(slide, zip_name, changed, infos, cpu, reused=0, cached=0):
+	return {
+		"slide": slide,
+		"zip": zip_name,
+		"changed": changed,
+		"size": sum([zinfo.file_size for zinfo in infos]),
+		"compressed_size": sum([zinfo.compress_size for zinfo in infos]),
+		"deflated": len([zinfo for zinfo in infos if zinfo.compress_type == zipfile.ZIP_DEFLATED]),
+		"stored": len([zinfo for zinfo in infos if zinfo.compress_type == zipfile.ZIP_STORED]),
+		"reused": reused,
+		"cached": cached,
+		"cpu": cpu
+	}
+
+def zip_one(root_dir, slide, dest, verbose=False, policy=None, cache_dir=None):
+	if policy is None: policy = load_policy()
+	start = time.process_time()
+
 	slide_name = os.path.basename(slide)
 	zip_name = slide_name + ".zip"
 	zip_path = os.path.join(root_dir,dest,zip_name)
 
+	entries = []
+	for root, dirs, files in os.walk(os.path.join(root_dir,slide)):
+		for file in files:
+			root_pieces = os.path.join(root_dir, dest).split(os.sep)
+			slide_pieces = root.split(os.sep)
+
+			no_enclosing_folders = os.sep.join(slide_pieces[len(root_pieces)-1:])
+			entries.append((os.path.join(root, file), os.path.join(no_enclosing_folders, file)))
+
+	# compare the slide folder against what's already in the zip
+	existing = read_zip(zip_path)
+	previous = {} if existing is None else dict([(zinfo.filename, zinfo) for zinfo in existing.infolist()])
+	unchanged = set([archive_name for path, archive_name in entries
+		if is_unchanged(path, previous.get(archive_name.replace(os.sep, "/")), policy)])
+
+	if existing is not None and len(unchanged) == len(entries) == len(previous):
+		if verbose: print("%s is up to date" % zip_name)
+		existing.close()
+		return zip_stats(slide, zip_name, False, previous.values(), time.process_time() - start)
+
 	if verbose: print("Creating %s \n======================" % zip_name)
 
-	with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-		for root, dirs, files in os.walk(os.path.join(root_dir,slide)):
-			for file in files:
-				root_pieces = os.path.join(root_dir, dest).split(os.sep)
-				slide_pieces = root.split(os.sep)
+	tmp_path = zip_path + ".tmp"
+	cached = 0
+	try:
+		with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+			for path, archive_name in entries:
+				if archive_name in unchanged:
+					if verbose: print("Reusing %s..." % archive_name)
+					copy_entry_raw(existing, previous[archive_name.replace(os.sep, "/")], zf)
+				else:
+					if verbose: print("Adding %s..." % archive_name)
+					compress_type, level = compression_for(path, policy)
 
-				no_enclosing_folders = os.sep.join(slide_pieces[len(root_pieces)-1:])
-				archive_name = os.path.join(no_enclosing_folders, file)
+					if cache_dir is not None and compress_type == zipfile.ZIP_DEFLATED and os.path.getsize(path) >= MIN_CACHED_SIZE:
+						if write_cached(zf, path, archive_name, level, cache_dir): cached = cached + 1
+					else:
+						zf.write(path, archive_name, compress_type, level)
 
-				if verbose: print("Adding %s..." % archive_name)
+			infos = zf.infolist()
+	finally:
+		if existing is not None: existing.close()
 
-				zf.write(os.path.join(root, file), archive_name)
+	os.replace(tmp_path, zip_path)
+	return zip_stats(slide, zip_name, True, infos, time.process_time() - start, len(unchanged), cached)
 
-def runScript(ASYNC=False):
+def report_stats(stats, per_slide=True):
+	def mb(size): return size / (1024.0*1024.0)
+
+	changed = [stat for stat in stats if stat["changed"]]
+	if per_slide:
+		for stat in sorted(changed, key=lambda stat: stat["zip"]):
+			print("%s: %.1fMB -> %.1fMB (saved %.1fMB), %.2fs cpu, %d deflated, %d stored, %d reused, %d from cache" % (stat["zip"],
+				mb(stat["size"]), mb(stat["compressed_size"]), mb(stat["size"] - stat["compressed_size"]), stat["cpu"],
+				stat["deflated"], stat["stored"], stat["reused"], stat["cached"]))
+
+	print("%d of %d zips rebuilt: saved %.1fMB of %.1fMB with %.2fs cpu" % (len(changed), len(stats),
+		mb(sum([stat["size"] - stat["compressed_size"] for stat in changed])), mb(sum([stat["size"] for stat in changed])),
+		sum([stat["cpu"] for stat in changed])))
 
+def find_slide_folders(root_dir, source):
 	# should use is_slide() to check that a folder is actually a slide folder
 	def okay_to_add(path):
 		IGNORES = ["_zips", "_ctls"]
 		return functools.reduce(lambda acc,current: acc and (current != path), IGNORES, True)
 
+	source_path = os.path.abspath(os.path.join(root_dir,source))
+	return [os.path.join(source,sd) for sd in next(os.walk(source_path))[1] if okay_to_add(sd)]
+
+def runScript(ASYNC=False):
+
 	parser = argparse.ArgumentParser(
 		formatter_class=argparse.RawDescriptionHelpFormatter,
 		description = banner(subtitle="Slide Packager"))
@@ -67,6 +306,7 @@ def runScript(ASYNC=False):
 	parser.add_argument("--root", nargs=1, help="Project root directiory", required=False)
 	parser.add_argument("--verbose", action="store_true", help="Chatty Cathy", required=False)
 	parser.add_argument("--notparallel", action="store_true", help="Run without concurrency", required=False)
+	parser.add_argument("--nocache", action="store_true", help="Deflate every file instead of reusing compressed copies of identical files", required=False)
 	
 	if len(sys.argv) == 1:
 		parser.print_help()
@@ -93,18 +333,26 @@ def runScript(ASYNC=False):
 		DEST = dest
 		ROOT = root_dir
 
-		SOURCE_PATH = os.path.abspath(os.path.join(ROOT,SOURCE))
-
-		srcs = [os.path.join(SOURCE,sd) for sd in next(os.walk(SOURCE_PATH))[1] if okay_to_add(sd)]
+		srcs = find_slide_folders(ROOT, SOURCE)
 
 		if len(srcs) < 1:
 			print("No slides found!")
 			sys.exit(1)
 
+		config = None
+		cache_dir = None
+		if os.path.exists(os.path.join(ROOT, CONFIG_FILENAME)):
+			with open(os.path.join(ROOT, CONFIG_FILENAME)) as f:
+				config = json.load(f)
+			if not args.nocache: cache_dir = get_cache_dir(ROOT, config, "zip-entries")
+		policy = load_policy(config)
+
 		if ASYNC:
-			zip_slides_async(root_dir, srcs, dest, verbose=VERBOSE)
+			stats = zip_slides_async(root_dir, srcs, dest, verbose=VERBOSE, policy=policy, cache_dir=cache_dir)
 		else:
-			zip_slides(root_dir, srcs, dest, verbose=VERBOSE)
+			stats = zip_slides(root_dir, srcs, dest, verbose=VERBOSE, policy=policy, cache_dir=cache_dir)
+
+		report_stats(stats)
 
 
 if __name__ == "__main__": 
@@ -0,0 +1,338 @@
+import collections
+import re
+import zlib
+
+# Reads the document Info dictionary and XMP metadata of a PDF by following startxref,
+# the cross-reference table/stream and the trailer with seeks, so nothing but the few
+# objects involved ever gets read (pdfminer parses far more of a big deck than that).
+
+TAIL_SIZE = 2048 # startxref and %%EOF live at the very end
+CHUNK_SIZE = 4096
+MAX_OBJECT_SIZE = 4*1024*1024
+
+WHITESPACE = b"\x00\t\n\x0c\r "
+DELIMITERS = b"()<>[]{}/%"
+
+Ref = collections.namedtuple('Ref', ['num', 'gen'])
+
+class Name(str):
+	pass
+
+class PDFError(ValueError):
+	pass
+
+class Incomplete(PDFError):
+	pass # ran off the end of the buffer, read more and try again
+
+NUMBER = re.compile(rb"[+-]?(?:\d+\.?\d*|\.\d+)")
+REF = re.compile(rb"(\d+)\s+(\d+)\s+R(?=[\s\x00\x0c()<>\[\]{}/%]|$)")
+OBJ = re.compile(rb"\s*(\d+)\s+(\d+)\s+obj")
+KEYWORD = re.compile(rb"[A-Za-z]+")
+ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"\b", b"f": b"\f", b"(": b"(", b")": b")", b"\\": b"\\"}
+
+def skip_space(buf, pos):
+	while pos < len(buf):
+		if buf[pos] in WHITESPACE:
+			pos = pos + 1
+		elif buf[pos:pos+1] == b"%":
+			while pos < len(buf) and buf[pos] not in b"\r\n": pos = pos + 1
+		else:
+			return pos
+	raise Incomplete("end of buffer")
+
+def parse_literal(buf, pos):
+	out = bytearray()
+	depth = 1
+	pos = pos + 1
+	while pos < len(buf):
+		c = buf[pos:pos+1]
+		if c == b"\\":
+			n = buf[pos+1:pos+2]
+			if n == b"": raise Incomplete("string at end of buffer")
+			if n in ESCAPES:
+				out += ESCAPES[n]
+				pos = pos + 2
+			elif n in b"01234567":
+				octal = re.match(rb"[0-7]{1,3}", buf[pos+1:pos+4]).group(0)
+				out.append(int(octal, 8) & 0xFF)
+				pos = pos + 1 + len(octal)
+			elif n == b"\r":
+				pos = pos + (3 if buf[pos+2:pos+3] == b"\n" else 2) # line continuation
+			elif n == b"\n":
+				pos = pos + 2
+			else:
+				pos = pos + 1 # unknown escapes drop the backslash
+		else:
+			if c == b"(": depth = depth + 1
+			if c == b")":
+				depth = depth - 1
+				if depth == 0: return bytes(out), pos + 1
+			out += c
+			pos = pos + 1
+	raise Incomplete("unterminated string")
+
+def parse_value(buf, pos):
+	pos = skip_space(buf, pos)
+	c = buf[pos:pos+1]
+
+	if buf[pos:pos+2] == b"<<":
+		result = {}
+		pos = pos + 2
+		while True:
+			pos = skip_space(buf, pos)
+			if buf[pos:pos+2] == b">>": return result, pos + 2
+			key, pos = parse_value(buf, pos)
+			if not isinstance(key, Name): raise PDFError("dictionary key is not a name")
+			result[key], pos = parse_value(buf, pos)
+
+	if c == b"[":
+		result = []
+		pos = pos + 1
+		while True:
+			pos = skip_space(buf, pos)
+			if buf[pos:pos+1] == b"]": return result, pos + 1
+			value, pos = parse_value(buf, pos)
+			result.append(value)
+
+	if c == b"<":
+		end = buf.find(b">", pos)
+		if end < 0: raise Incomplete("unterminated hex string")
+		digits = re.sub(rb"[^0-9A-Fa-f]", b"", buf[pos+1:end])
+		if len(digits) % 2 == 1: digits = digits + b"0"
+		return bytes.fromhex(digits.decode("ascii")), end + 1
+
+	if c == b"(": return parse_literal(buf, pos)
+
+	if c == b"/":
+		end = pos + 1
+		while end < len(buf) and buf[end] not in WHITESPACE and buf[end] not in DELIMITERS: end = end + 1
+		if end == len(buf): raise Incomplete("name at end of buffer")
+		name = re.sub(rb"#([0-9A-Fa-f]{2})", lambda m: bytes([int(m.group(1), 16)]), buf[pos+1:end])
+		return Name(name.decode("latin-1")), end
+
+	ref = REF.match(buf, pos)
+	if ref is not None: return Ref(int(ref.group(1)), int(ref.group(2))), ref.end()
+
+	number = NUMBER.match(buf, pos)
+	if number is not None:
+		if number.end() == len(buf): raise Incomplete("number at end of buffer")
+		text = number.group(0)
+		return (float(text) if b"." in text else int(text)), number.end()
+
+	keyword = KEYWORD.match(buf, pos)
+	if keyword is not None:
+		word = keyword.group(0)
+		if word == b"true": return True, keyword.end()
+		if word == b"false": return False, keyword.end()
+		if word == b"null": return None, keyword.end()
+
+	raise PDFError("unexpected %r at %d" % (buf[pos:pos+10], pos))
+
+def png_unpredict(data, columns):
+	# /Predictor 10-15: every row starts with its PNG filter type
+	rows = []
+	previous = bytearray(columns)
+	for i in range(0, len(data), columns + 1):
+		kind, row = data[i], bytearray(data[i+1:i+1+columns])
+		for x in range(len(row)):
+			left = row[x-1] if x > 0 else 0
+			up = previous[x]
+			if kind == 1: row[x] = (row[x] + left) & 0xFF
+			elif kind == 2: row[x] = (row[x] + up) & 0xFF
+			elif kind == 3: row[x] = (row[x] + ((left + up) >> 1)) & 0xFF
+			elif kind == 4:
+				upleft = previous[x-1] if x > 0 else 0
+				p = left + up - upleft
+				pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+				row[x] = (row[x] + (left if pa <= pb and pa <= pc else up if pb <= pc else upleft)) & 0xFF
+			elif kind != 0: raise PDFError("unknown png predictor %d" % kind)
+		rows.append(bytes(row))
+		previous = row
+	return b"".join(rows)
+
+class PDFReader:
+	def __init__(self, f):
+		self.f = f
+		self.sections = [] # newest first: ("table", first, count, position) or ("stream", {num: entry})
+		self.trailer = {}
+		self.objects = {}
+
+		self.f.seek(0, 2)
+		self.size = self.f.tell()
+		self.read_xrefs(self.startxref())
+
+		if "Encrypt" in self.trailer: raise PDFError("encrypted pdf") # the strings would need decrypting
+
+	def read_at(self, pos, size):
+		self.f.seek(pos)
+		return self.f.read(size)
+
+	def parse_at(self, pos, parse):
+		# parse from pos, reading more of the file whenever the parser runs out
+		size = CHUNK_SIZE
+		while True:
+			buf = self.read_at(pos, size)
+			try:
+				return parse(buf, pos + len(buf) >= self.size)
+			except Incomplete:
+				if size >= MAX_OBJECT_SIZE or pos + len(buf) >= self.size: raise
+				size = size * 4
+
+	def startxref(self):
+		tail = self.read_at(max(0, self.size - TAIL_SIZE), TAIL_SIZE)
+		found = re.findall(rb"startxref\s+(\d+)", tail)
+		if len(found) == 0: raise PDFError("no startxref")
+		return int(found[-1])
+
+	def read_xrefs(self, pos):
+		seen = set()
+		while pos is not None and pos not in seen:
+			seen.add(pos)
+			if self.read_at(pos, 4) == b"xref":
+				trailer = self.read_table(pos)
+			else:
+				trailer = self.read_xref_stream(pos)
+
+			for key, value in trailer.items(): self.trailer.setdefault(key, value)
+
+			if "XRefStm" in trailer: self.read_xref_stream(trailer["XRefStm"]) # hybrid files
+			pos = trailer.get("Prev", None)
+
+	def read_table(self, pos):
+		pos = pos + 4
+		while True:
+			def subsection(buf, eof):
+				start = skip_space(buf, 0)
+				if buf[start:start+7] == b"trailer":
+					value, end = parse_value(buf, start + 7)
+					return None, value
+				header = re.match(rb"(\d+)\s+(\d+)[ \t]*(?:\r\n|\r|\n)", buf[start:])
+				if header is None: raise PDFError("bad xref subsection")
+				return (int(header.group(1)), int(header.group(2)), start + header.end()), None
+
+			found, trailer = self.parse_at(pos, subsection)
+			if trailer is not None: return trailer
+
+			first, count, offset = found
+			self.sections.append(("table", first, count, pos + offset))
+			pos = pos + offset + count * 20 # fixed size entries, no need to read them now
+
+	def read_xref_stream(self, pos):
+		values, data = self.read_object(pos)
+		if not isinstance(values, dict) or values.get("Type") != "XRef": raise PDFError("bad xref stream")
+
+		widths = values["W"]
+		index = values.get("Index", [0, values["Size"]])
+		step = sum(widths)
+
+		def field(row, start, width, default):
+			if width == 0: return default
+			return int.from_bytes(row[start:start+width], "big")
+
+		entries = {}
+		row_start = 0
+		for first, count in zip(index[0::2], index[1::2]):
+			for num in range(first, first + count):
+				row = data[row_start:row_start+step]
+				row_start = row_start + step
+				kind = field(row, 0, widths[0], 1)
+				a = field(row, widths[0], widths[1], 0)
+				b = field(row, widths[0] + widths[1], widths[2], 0)
+				entries[num] = (kind, a, b)
+
+		self.sections.append(("stream", entries))
+		return values
+
+	def locate(self, num):
+		for section in self.sections:
+			if section[0] == "table":
+				kind, first, count, pos = section
+				if not first <= num < first + count: continue
+				entry = self.read_at(pos + (num - first) * 20, 20)
+				match = re.match(rb"(\d{10}) (\d{5}) ([nf])", entry)
+				if match is None: raise PDFError("bad xref entry")
+				if match.group(3) == b"f": return None
+				return (1, int(match.group(1)), int(match.group(2)))
+			elif num in section[1]:
+				entry = section[1][num]
+				return None if entry[0] == 0 else entry
+		return None
+
+	def read_object(self, pos):
+		# (value, decoded stream data or None) of the "N G obj" at pos
+		def parse(buf, eof):
+			header = OBJ.match(buf)
+			if header is None: raise PDFError("no object at %d" % pos)
+			value, end = parse_value(buf, header.end())
+			if len(buf) - end < 20 and not eof: raise Incomplete("can't tell if a stream follows")
+			stream = re.match(rb"\s*stream(?:\r\n|\n|\r)", buf[end:end+20])
+			if stream is None: return value, None
+			return value, end + stream.end()
+
+		value, data_start = self.parse_at(pos, parse)
+		if data_start is None: return value, None
+
+		length = self.resolve(value["Length"])
+		return value, self.decode(value, self.read_at(pos + data_start, length))
+
+	def decode(self, values, data):
+		filters = values.get("Filter", [])
+		params = values.get("DecodeParms", {})
+		if not isinstance(filters, list): filters = [filters]
+		if not isinstance(params, list): params = [params] * max(1, len(filters))
+
+		for name, param in zip(filters, params):
+			if name != "FlateDecode": raise PDFError("unsupported filter %s" % name)
+			data = zlib.decompress(data)
+			param = self.resolve(param) or {}
+			if param.get("Predictor", 1) >= 10: data = png_unpredict(data, param.get("Columns", 1))
+			elif param.get("Predictor", 1) != 1: raise PDFError("unsupported predictor")
+
+		return data
+
+	def get(self, num):
+		if num in self.objects: return self.objects[num]
+
+		entry = self.locate(num)
+		if entry is None:
+			result = (None, None)
+		elif entry[0] == 1:
+			result = self.read_object(entry[1])
+		else:
+			result = (self.compressed_object(entry[1], entry[2]), None)
+
+		self.objects[num] = result
+		return result
+
+	def compressed_object(self, stream_num, index):
+		values, data = self.get(stream_num)
+		if data is None: raise PDFError("object stream %d has no data" % stream_num)
+
+		header = [int(n) for n in data[:values["First"]].split()]
+		start = values["First"] + header[index*2 + 1]
+		return parse_value(data + b"\n", start)[0] # a number can end the stream
+
+	def resolve(self, value):
+		while isinstance(value, Ref): value = self.get(value.num)[0]
+		return value
+
+def pdf_text(value):
+	if not isinstance(value, bytes): return value
+	if value.startswith(b"\xfe\xff"): return value[2:].decode("utf-16-be", "replace")
+	if value.startswith(b"\xef\xbb\xbf"): return value[3:].decode("utf-8", "replace")
+	return value.decode("latin-1") # close enough to PDFDocEncoding for titles
+
+def pdf_meta(f):
+	# (title, subject, xmp packet or None) of a seekable pdf file, raises PDFError on anything it can't follow
+	reader = PDFReader(f)
+
+	info = reader.resolve(reader.trailer.get("Info", None)) or {}
+	title = pdf_text(reader.resolve(info.get("Title", None)))
+	subject = pdf_text(reader.resolve(info.get("Subject", None)))
+
+	xmp = None
+	root = reader.resolve(reader.trailer.get("Root", None)) or {}
+	if isinstance(root.get("Metadata", None), Ref):
+		xmp = reader.get(root["Metadata"].num)[1]
+
+	return title, subject, xmp
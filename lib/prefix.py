@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import activate_venv
 
-from veevutils import banner, is_slide, parse_slide, safe_rename
+from veevutils import banner, parse_slide, safe_rename
 from functools import reduce
-from relink import parse_folder, mv_refs
+from relink import parse_folder, pipeline
+from linkindex import LinkIndex, default_index_path
 
 import argparse
 import os
@@ -13,16 +14,9 @@ import textwrap
 import re
 import subprocess
 
-def find_slides(path, cutoff = 1):
-	slides = set([])
-
-	for root, dirnames, filenames in os.walk(path):
-		if root.count(os.sep) <= cutoff:
-			for filename in filenames:
-				parent_path, parent_name = os.path.split(root)
-				if is_slide(filename): slides.add(parent_name)
-
-	return list(slides)
+def find_slides(path):
+	filepaths, dirs = parse_slide_folders(path)
+	return list(set([os.path.basename(d) for d in dirs]))
 
 
 def parse_slide_folders(path):
@@ -77,12 +71,24 @@ def prefix_folder(prefix, path):
 
 		safe_rename(parentdir, new_folder)
 
-def prefix_refs(prefix, slidelist, root):
-	for slide in slidelist:
-		print("Changing all references to slide %s" % slide)
-		sys.stdout.flush()
+def rename_refs(mapping, folders, cutoff=float("inf"), verbose=False, parallel=True, index=None):
+	# one parse per html file no matter how many slides are being renamed
+	for old, new in sorted(mapping.items()):
+		if verbose: print("Changing all references to slide %s to %s" % (old, new))
+	sys.stdout.flush()
 
-		parse_folder(rmv_refsctions=[mv_refs(slide, prefix + slide)], cutoff=1)
+	if index is not None:
+		# only the files that actually link to one of the slides get relinked
+		links = LinkIndex(index).update(folders)
+		folders = links.files_linking_to(mapping.keys())
+		links.close()
+		if len(folders) == 0: return []
+
+	return parse_folder(folders, actions=[pipeline("rename_refs", mapping)], cutoff=cutoff, verbose=verbose, parallel=parallel)
+
+def prefix_refs(prefix, slidelist, root, verbose=False, index=None):
+	print("Changing all references to %d slides" % len(slidelist))
+	return rename_refs(dict([(slide, prefix + slide) for slide in slidelist]), root, verbose=verbose, index=index)
 
 def runScript():
 	## TODO make work with --root flag
@@ -113,8 +119,12 @@ def runScript():
 		if not allExists(folders):
 			return
 
+		# relink every folder at once so links between folders get the prefix too
+		slides = reduce(lambda acc, folder: acc + find_slides(folder), folders, [])
+		index = default_index_path(args.root[0] if args.root else os.getcwd())
+		prefix_refs(the_prefix, slides, folders, verbose=args.verbose, index=index)
+
 		for folder in folders:
-			prefix_refs(the_prefix, find_slides(folder), folder)
 			prefix_folder(the_prefix, folder)
 
 if __name__ == "__main__":
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 import activate_venv
 
-from veevutils import banner, is_slide
+from veevutils import banner, is_slide, get_cache_dir, CONFIG_FILENAME
+from manifest import hash_file
 
-from ftplib import FTP
+from ftplib import FTP, all_errors, error_perm
 from functools import reduce
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
+import queue
+import threading
+import time
 import textwrap
 import fnmatch
+import functools
 import re
 import os
 import sys
@@ -49,74 +57,332 @@ def match_zips_to_ctls(zip_path, ctl_path, novalidate=False):
 
 	return [os.path.join(zip_path, x + ".zip") for x in both], [os.path.join(ctl_path, x + ".ctl") for x in both]
 
-def ftp_publish(**kwargs):
-	ZIP_LOCATION = "/content"
-	CTL_LOCATION = "/ctlfile"
+ZIP_LOCATION = "/content"
+CTL_LOCATION = "/ctlfile"
 
-	server = kwargs['server']
-	username = kwargs['username']
-	password = kwargs['password']
-	zips = kwargs['zips']
-	ctls = kwargs['ctls']
+DEFAULT_PORT = 21
+DEFAULT_CONNECTIONS = 4 # logged in connections uploading zips at once
+DEFAULT_BLOCK_SIZE = 64*1024 # ftplib's default of 8KB means a lot of tiny writes for a big zip
+DEFAULT_RETRIES = 1
+MANIFEST_FILENAME = "manifest.json"
 
-	verbose = kwargs.get('verbose', False)
+def connect(server, username, password, port=DEFAULT_PORT, directory=None):
+	f = FTP()
+	f.connect(server, port)
+	f.login(username, password)
 
-	with FTP(server) as f:
-		if verbose:
-			print("Connecting to %s..." % server)
-			print("Logging in as %s..." % username)
-			sys.stdout.flush()
+	if directory is not None:
+		try:
+			f.cwd(directory)
+		except error_perm:
+			pass # ignore cd into non-existant folder -> upload to home
 
-		f.login(username, password)
-		
-		# per documentation, always upload zip files first
-		# try to cwd into content directory (if there isn't one, then upload to the home directory)
-		if verbose:
-			print("ZIP FILES")
-			sys.stdout.flush()
+	return f
+
+def disconnect(f):
+	try:
+		f.quit()
+	except Exception:
+		f.close() # already dropped by the server
+
+class ConnectionPool:
+	def __init__(self, open_connection, size):
+		self.open_connection = open_connection
+		self.size = size
+		self.idle = queue.Queue()
+		self.opened = 0
+		self.lock = threading.Lock()
+
+	def get(self):
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			pass
+
+		with self.lock:
+			opening = self.opened < self.size
+			if opening: self.opened = self.opened + 1
+
+		if not opening: return self.idle.get()
 
 		try:
-			f.cwd(ZIP_LOCATION)
+			return self.open_connection()
 		except Exception:
-			pass # ignore cd into non-existant folder -> upload to home
+			with self.lock: self.opened = self.opened - 1
+			raise
+
+	def put(self, f):
+		self.idle.put(f)
+
+	def discard(self, f):
+		# broken connections get closed, the next get() opens a fresh one
+		f.close()
+		with self.lock: self.opened = self.opened - 1
+
+	def close(self):
+		while not self.idle.empty(): disconnect(self.idle.get_nowait())
 
+def remote_size(f, filename):
+	try:
+		f.voidcmd("TYPE I") # SIZE is only reliable in binary mode
+		return f.size(filename)
+	except all_errors:
+		return None
+
+def upload(f, path, block_size=DEFAULT_BLOCK_SIZE, resume=False, sending=None):
+	# sending: called once the first block of this file has actually gone out
+	filename = os.path.basename(path)
+	size = os.path.getsize(path)
+	start = time.time()
+
+	def sent(block):
+		if sending is not None: sending()
+
+	# pick up an interrupted upload where the server's copy stops
+	rest = remote_size(f, filename) if resume else None
+	if rest is not None and not 0 < rest < size: rest = None
+
+	with open(path, 'rb') as fp:
+		if rest is None:
+			f.storbinary("STOR " + filename, fp, blocksize=block_size, callback=sent)
+		else:
+			fp.seek(rest)
+			try:
+				f.storbinary("STOR " + filename, fp, blocksize=block_size, callback=sent, rest=rest)
+			except error_perm:
+				rest = None # server won't REST a STOR, send all of it
+				fp.seek(0)
+				f.storbinary("STOR " + filename, fp, blocksize=block_size, callback=sent)
+
+	return {"file": filename, "bytes": size - (rest or 0), "seconds": time.time() - start, "resumed": rest or 0}
+
+def delete_remote(f, filename):
+	try:
+		f.delete(filename)
+	except error_perm:
+		pass # wasn't there
+
+def pooled_upload(pool, path, block_size=DEFAULT_BLOCK_SIZE, retries=DEFAULT_RETRIES, resume=False, started=None, restart=False):
+	# only resume onto the server's copy once it's known to be the start of this very file: a failure before
+	# any bytes went out leaves the previous version there, and appending to that would make a corrupt zip
+	began = [False]
+	def sending():
+		if began[0]: return
+		began[0] = True
+		if started is not None: started()
+
+	for attempt in range(retries + 1):
+		f = pool.get()
 		try:
-			for zip in zips:
-				with open(zip, 'rb') as zipfile:
-					if verbose:
-						print("Uploading %s..." % zip)
-						sys.stdout.flush()
+			if restart and attempt == 0: delete_remote(f, os.path.basename(path))
+			stat = upload(f, path, block_size, resume or began[0], sending)
+		except all_errors:
+			pool.discard(f)
+			if attempt == retries: raise
+		else:
+			pool.put(f)
+			return stat
+
+def ctl_digest(path):
+	# the password and the version (a new commit every time) don't make a slide worth sending again
+	digest = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for line in f:
+			if line.startswith(b"PASSWORD=") or line.startswith(b"Slide_Version_vod__c="): continue
+			digest.update(line)
+	return digest.hexdigest()
+
+class PublishManifest:
+	# what has been uploaded to which server as which user, by content hash
+	def __init__(self, path, server, username, port=DEFAULT_PORT):
+		self.path = path
+		self.key = "%s@%s:%d" % (username, server, port)
+		self.servers = {}
+		self.lock = threading.Lock()
+
+		if path is not None and os.path.exists(path):
+			try:
+				with open(path) as f:
+					self.servers = json.load(f).get("servers", {})
+			except ValueError:
+				self.servers = {} # corrupt manifest, everything gets sent again
+
+		self.files = self.servers.setdefault(self.key, {})
+
+	def state(self, location, filename, sha1, size=None):
+		recorded = self.files.get(location + "/" + filename, None)
+		if recorded is None or recorded["sha1"] != sha1: return None
+		if size is not None and recorded.get("size", size) != size: return None
+		return recorded["state"]
+
+	def stale_partial(self, location, filename, sha1, size):
+		# a half sent upload of something other than this file
+		recorded = self.files.get(location + "/" + filename, None)
+		return recorded is not None and recorded["state"] == "partial" and self.state(location, filename, sha1, size) is None
+
+	def mark(self, location, filename, sha1, state, size=None):
+		with self.lock:
+			self.files[location + "/" + filename] = {"sha1": sha1, "state": state}
+			if size is not None: self.files[location + "/" + filename]["size"] = size
+			self.save()
+
+	def save(self):
+		if self.path is None: return
+
+		parent = os.path.dirname(self.path)
+		if parent != '' and not os.path.exists(parent): os.makedirs(parent)
+
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({"servers": self.servers}, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.path)
+
+def default_manifest_path(root_dir):
+	config_file = os.path.join(root_dir, CONFIG_FILENAME)
+	if not os.path.exists(config_file): return None # no project, no memory of what was sent
+
+	with open(config_file) as f:
+		return os.path.join(get_cache_dir(root_dir, json.load(f), "publish"), MANIFEST_FILENAME)
+
+def plan_publish(zips, ctls, manifest=None, force=False):
+	# (uploads, unchanged): a slide goes up again, zip and ctl, if either of them changed
+	ctl_for = dict([(os.path.splitext(os.path.basename(ctl))[0], ctl) for ctl in ctls])
+
+	uploads = []
+	unchanged = []
+	for zip in zips:
+		ctl = ctl_for.get(os.path.splitext(os.path.basename(zip))[0], None)
+		job = {"zip": zip, "ctl": ctl, "zip_sha1": hash_file(zip).hexdigest(), "zip_size": os.path.getsize(zip),
+			"ctl_sha1": None if ctl is None else ctl_digest(ctl), "resume": False, "restart": False}
+
+		if manifest is not None:
+			zip_state = manifest.state(ZIP_LOCATION, os.path.basename(zip), job["zip_sha1"], job["zip_size"])
+			ctl_state = None if ctl is None else manifest.state(CTL_LOCATION, os.path.basename(ctl), job["ctl_sha1"])
+
+			if not force and zip_state == "sent" and (ctl is None or ctl_state == "sent"):
+				unchanged.append(job)
+				continue
+
+			job["resume"] = zip_state == "partial" # started on this exact zip last time
+			job["restart"] = manifest.stale_partial(ZIP_LOCATION, os.path.basename(zip), job["zip_sha1"], job["zip_size"])
+
+		uploads.append(job)
+
+	# biggest first, so one large zip doesn't end up going last on its own
+	uploads.sort(key=lambda job: os.path.getsize(job["zip"]), reverse=True)
+	return uploads, unchanged
+
+def describe_plan(uploads, unchanged):
+	for job in uploads:
+		print("%s (%.1fMB%s)%s" % (os.path.basename(job["zip"]), os.path.getsize(job["zip"]) / (1024.0*1024.0),
+			", resuming" if job["resume"] else (", replacing a partial upload" if job["restart"] else ""),
+			"" if job["ctl"] is None else " + " + os.path.basename(job["ctl"])))
+	print("%d slides to upload, %d unchanged" % (len(uploads), len(unchanged)))
+	sys.stdout.flush()
+
+def describe(stat):
+	return "%s: %.1fMB in %.2fs (%.1fMB/s)" % (stat["file"], stat["bytes"] / (1024.0*1024.0), stat["seconds"],
+		stat["bytes"] / (1024.0*1024.0) / max(stat["seconds"], 0.001))
+
+def report_stats(stats, seconds=None, per_file=True):
+	if per_file:
+		for stat in stats: print(describe(stat))
+
+	total = sum([stat["bytes"] for stat in stats])
+	if seconds is None: seconds = sum([stat["seconds"] for stat in stats])
+	print("%d files, %.1fMB in %.2fs (%.1fMB/s)" % (len(stats), total / (1024.0*1024.0), seconds,
+		total / (1024.0*1024.0) / max(seconds, 0.001)))
+	sys.stdout.flush()
 
-					filename = os.path.split(zip)[-1]
+def ftp_publish(**kwargs):
+	server = kwargs['server']
+	username = kwargs['username']
+	password = kwargs['password']
+	zips = kwargs['zips']
+	ctls = kwargs['ctls']
 
-					f.storbinary("STOR " + filename, zipfile)
-		except Exception as e:
-			# bail on any ftp errors (TODO FIX THIS LOL)
-			raise Exception('Error in uploading zip files: ' + str(e))
+	port = kwargs.get('port', DEFAULT_PORT)
+	connections = max(1, kwargs.get('connections', DEFAULT_CONNECTIONS))
+	block_size = kwargs.get('block_size', DEFAULT_BLOCK_SIZE)
+	retries = kwargs.get('retries', DEFAULT_RETRIES)
+	verbose = kwargs.get('verbose', False)
 
-		if verbose:
-			print("CONTROL FILES")
-			sys.stdout.flush()
+	manifest = PublishManifest(kwargs.get('manifest', None), server, username, port)
+	uploads, unchanged = plan_publish(zips, ctls, manifest, kwargs.get('force', False))
+
+	if kwargs.get('dry_run', False):
+		describe_plan(uploads, unchanged)
+		return []
+
+	if verbose and len(unchanged) > 0: print("Skipping %d unchanged slides" % len(unchanged))
+	if len(uploads) == 0: return []
+
+	if verbose:
+		print("Connecting to %s..." % server)
+		print("Logging in as %s..." % username)
+		sys.stdout.flush()
 
+	def control_connection():
+		f = connect(server, username, password, port)
 		try:
 			f.cwd(CTL_LOCATION)
 		except Exception as e:
+			disconnect(f)
 			raise Exception('Error in accessing control file directory: ' + str(e))
+		return f
 
-		try:
-			for ctl in ctls:
-				with open(ctl, 'rb') as ctlfile:
-					if verbose:
-						print("Uploading %s..." % ctl)
-						sys.stdout.flush()
-
-					filename = os.path.split(ctl)[-1]
+	# control files go up one at a time on their own connection, checked before any zip is sent
+	control = control_connection()
 
-					f.storbinary("STOR " + filename, ctlfile)
-		except Exception as e:
-			#bail
-			raise Exception('Error in uploading control files: ' + str(e))
+	pool = ConnectionPool(lambda: connect(server, username, password, port, ZIP_LOCATION), connections)
+	stats = []
+	errors = []
 
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(connections, len(uploads))) as executor:
+			futures = {}
+			for job in uploads:
+				# recorded once the zip's first bytes are out, so an interrupted run knows a partial zip on the server is this one
+				started = functools.partial(manifest.mark, ZIP_LOCATION, os.path.basename(job["zip"]), job["zip_sha1"], "partial", job["zip_size"])
+				futures[executor.submit(pooled_upload, pool, job["zip"], block_size, retries, job["resume"], started, job["restart"])] = job
+
+			for future in concurrent.futures.as_completed(futures):
+				job = futures[future]
+				zip, ctl = job["zip"], job["ctl"]
+				try:
+					stats.append(future.result())
+				except Exception as e:
+					errors.append('Error in uploading zip file %s: %s' % (os.path.basename(zip), e))
+					continue # no control file for a slide that isn't there
+
+				manifest.mark(ZIP_LOCATION, os.path.basename(zip), job["zip_sha1"], "sent", job["zip_size"])
+				if verbose: print(describe(stats[-1]))
+
+				# per documentation, a slide's control file only goes up once its zip is uploaded
+				if ctl is None: continue
+
+				try:
+					try:
+						stats.append(upload(control, ctl, block_size))
+					except all_errors:
+						# sitting idle while big zips upload can get the connection timed out
+						control.close()
+						control = control_connection()
+						stats.append(upload(control, ctl, block_size))
+				except Exception as e:
+					errors.append('Error in uploading control file %s: %s' % (os.path.basename(ctl), e))
+					continue
+
+				manifest.mark(CTL_LOCATION, os.path.basename(ctl), job["ctl_sha1"], "sent")
+				if verbose: print(describe(stats[-1]))
+				sys.stdout.flush()
+	finally:
+		pool.close()
+		disconnect(control)
+
+	if len(errors) > 0: raise Exception("\n".join(errors))
+
+	return stats
 
 def runScript(verbose=False):
 	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -130,6 +396,11 @@ def runScript(verbose=False):
 	parser.add_argument("--root", nargs=1, help="Project root folder", required=False)
 	parser.add_argument("--verbose", action="store_true", help="Chatty Cathy")
 	parser.add_argument("--novalidate", action="store_true", help="Don't check to see if zip files are slides")
+	parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="FTP port (default: %(default)s)")
+	parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="Zips uploaded at once, each over its own connection (default: %(default)s)")
+	parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="Bytes sent per write (default: %(default)s)")
+	parser.add_argument("--dry-run", action="store_true", help="List the slides that would be uploaded without connecting")
+	parser.add_argument("--force", action="store_true", help="Upload every slide, even ones the publish manifest says are already on the server")
 
 	if len(sys.argv) == 1:
 		parser.print_help()
@@ -139,8 +410,14 @@ def runScript(verbose=False):
 
 	zips, ctls = match_zips_to_ctls(args.zip[0], args.ctl[0], args.novalidate)
 
+	root = args.root[0] if args.root else os.getcwd()
+	manifest = default_manifest_path(root)
+
 	try:
-		ftp_publish(zips=zips, ctls=ctls, username=args.u[0], password=args.pwd[0], server=args.host[0], verbose=args.verbose)
+		start = time.time()
+		stats = ftp_publish(zips=zips, ctls=ctls, username=args.u[0], password=args.pwd[0], server=args.host[0], verbose=args.verbose,
+			port=args.port, connections=args.connections, block_size=args.block_size, manifest=manifest, dry_run=args.dry_run, force=args.force)
+		if not args.dry_run: report_stats(stats, time.time() - start, per_file=False)
 	except Exception as e:
 		print(e)
 		sys.stdout.flush()
@@ -1,29 +1,41 @@
 #!/usr/bin/env python3
 import activate_venv
-from veevutils import banner, VALID_SLIDE_EXTENSIONS, parse_slide_name_from_href, veeva_composer, path_composer, CONFIG_FILENAME
+from veevutils import banner, VALID_SLIDE_EXTENSIONS, parse_slide_name_from_href, parse_veeva_href, parse_veeva_onclick, get_path_regex, veeva_composer, path_composer, break_link, CONFIG_FILENAME
 
-from bs4 import BeautifulSoup # also requires lxml
-from functools import reduce
+from linkindex import LinkIndex, default_index_path
+
+from bs4 import BeautifulSoup, Doctype, Tag # also requires lxml
+from functools import partial, reduce
+from itertools import repeat
 from pymonad import *
 from urllib.parse import urlparse
 
 import argparse
+import concurrent.futures
 import fnmatch
 import os
+import pickle
 import re
 import sys
+import tempfile
 import textwrap
+import time
 import json
 
 @curry
-def action(name, selector, action_closure, composer, source):
+def action(name, selector, action_closure, composer, soup):
 
 	@State
 	def closure(old_state):
-		b = BeautifulSoup(source, "lxml")
-		transformer_(b, selector, action_closure(composer))
+		transformer_(soup, selector, action_closure(composer))
 		
-		return (str(b), old_state + 1)
+		return (soup, old_state + 1)
+	return closure
+
+def reparsed(act):
+	# old behaviour: every action worked on a fresh parse of the previous action's output
+	def closure(soup):
+		return act(BeautifulSoup(str(soup), "lxml"))
 	return closure
 
 def transformer_(soup, selector, transform):
@@ -138,42 +150,72 @@ def fix_rel_2_veev(composer, href):
 	return fix_hyperlink_protocol(composer, fix_relative_path(composer, href))
 
 @curry
-def mv_rel(old_slide_name, new_slide_name):
+def mv_rel(mapping, composer, href):
+	if urlparse(href).netloc != '': return href
 
-	@curry
-	def closure(composer, href):
-		if urlparse(href).netloc == '':
-			old_slide = parse_slide_path(href, slide_name=old_slide_name)
-			if old_slide is not None:
-				#return old_slide.parent_path + new_slide_name + "/" + new_slide_name + old_slide.extension
-				return composer(new_slide_name, old_slide.extension)
-			else:
-				return href
-		else:
-			return href
+	match = re.match(get_path_regex(), href)
+	if match is None: return href
 
-	return closure
+	parent_path, slide_name, extension = match.group(1), match.group(2), match.group(3)
+	if slide_name not in mapping: return href
+	if parent_path != '' and not parent_path.endswith("/"): return href # ../xslide/slide.html isn't slide
+
+	return path_composer(parent_path, mapping[slide_name], extension) + href[match.end():]
 
 @curry
-def mv_veev(old_slide_name, new_slide_name):
+def mv_veev(mapping, composer, href):
+	match = parse_veeva_href(href)
+	if match is None: return href
 
-	@curry
-	def closure(composer, href):
-		old_slide = parse_veeva_href(href, command_args=old_slide_name+".zip")
+	# gotoSlide(slide.zip) or gotoSlide(slide.zip, presentation)
+	args = match.command_args.split(",")
+	slide_name, extension = os.path.splitext(args[0].strip())
+	if extension != ".zip" or slide_name not in mapping: return href
 
-		if old_slide is not None:
-			return composer(old_slide.command_name, new_slide_name+".zip")
-		else:
-			return href
+	return composer(match.command_name, [mapping[slide_name] + extension] + args[1:])
 
-	return closure
+def load_mapping(path):
+	# either a json object {"old": "new", ...} or one "old new" (or "old,new") pair per line
+	with open(path) as f:
+		if os.path.splitext(path)[1].lower() == ".json": return json.load(f)
 
-def run_actions(actions, src):
-	return reduce(lambda prev, new: prev >> new, actions, unit(State, src)).getResult(-1)
+		mapping = {}
+		for line in f:
+			line = line.split("#")[0].strip()
+			if line == '': continue
 
-@curry
-def integrate_all(composer, src):
-	actions = [
+			pair = re.split("\\s*,\\s*|\\s+", line)
+			if len(pair) != 2: raise ValueError("%s: can't read slide mapping from '%s'" % (path, line))
+			mapping[pair[0]] = pair[1]
+
+		return mapping
+
+def is_stable(soup):
+	# lxml reads its own output back into the same tree, except for broken documents
+	# (text before <html>, several root elements, doctypes in the middle of the page)
+	roots = [node for node in soup.contents if isinstance(node, Tag)]
+	if len(roots) > 1: return False
+
+	root = roots[0] if len(roots) > 0 else None
+	for node in soup.contents:
+		if node is root: break
+		if isinstance(node, Doctype) and node is soup.contents[0]: continue
+		return False
+
+	doctypes = soup.find_all(string=lambda text: isinstance(text, Doctype))
+	return len([d for d in doctypes if d is not soup.contents[0]]) == 0
+
+def run_actions(actions, src, reparse=False):
+	soup = BeautifulSoup(src, "lxml")
+
+	# parse once, run every transform against the same DOM, and serialize once. Broken
+	# documents keep the one parse per action they always had, so the output doesn't change
+	if reparse or not is_stable(soup): actions = actions[:1] + [reparsed(act) for act in actions[1:]]
+
+	return str(reduce(lambda prev, new: prev >> new, actions, unit(State, soup)).getResult(-1))
+
+def integrate_all_actions(composer):
+	return [
 		action(
 			"stylesheets",
 			lambda soup: soup.find_all("link", rel="stylesheet"),
@@ -216,22 +258,25 @@ def integrate_all(composer, src):
 			veeva_composer("veeva:"))
 	]
 
-	return run_actions(actions, src)
-
 @curry
-def veev2rel(composer,src):
-	actions = [
+def integrate_all(composer, src):
+	return run_actions(integrate_all_actions(composer), src)
+
+def veev2rel_actions(composer):
+	return [
 		action(
 			"veeva to relative",
 			lambda soup: soup.find_all("a", href=True),
 			attribute_transform("href", fix_veev_2_rel),
 			path_composer("../"))
 	]
-	return run_actions(actions, src)
 
 @curry
-def rel2veev(composer, src):
-	actions = [
+def veev2rel(composer,src):
+	return run_actions(veev2rel_actions(composer), src)
+
+def rel2veev_actions(composer):
+	return [
 		action(
 			"expand trailing slash", 
 			lambda soup: soup.find_all("a", href=True), 
@@ -248,28 +293,39 @@ def rel2veev(composer, src):
 			attribute_transform("href", fix_rel_2_veev),
 			composer)
 	]
-	return run_actions(actions, src)
 
 @curry
-def mv_refs(old_slide_name, new_slide_name, src):
-	actions = [
+def rel2veev(composer, src):
+	return run_actions(rel2veev_actions(composer), src)
+
+def rename_refs_actions(mapping):
+	# every slide in the mapping is renamed in the same pass, so swaps (a -> b, b -> a) work too
+	return [
 		action(
-			"old rel to old rel",
+			"old rel to new rel",
 			lambda soup: soup.find_all("a", href=True),
-			attribute_transform("href", mv_rel(old_slide_name, new_slide_name)),
+			attribute_transform("href", mv_rel(mapping)),
 			veeva_composer("veeva:")),
 		action(
 			"old veeva to new veeva",
 			lambda soup: soup.find_all("a", href=True),
-			attribute_transform("href", mv_veev(old_slide_name, new_slide_name)),
+			attribute_transform("href", mv_veev(mapping)),
 			veeva_composer("veeva:"))
 	]
 
-	return run_actions(actions, src)
+@curry
+def rename_refs(mapping, src):
+	return run_actions(rename_refs_actions(mapping), src)
+
+def mv_refs_actions(old_slide_name, new_slide_name):
+	return rename_refs_actions({old_slide_name: new_slide_name})
 
 @curry
-def share_assets(globals_dir, composer, src):
-	actions = [
+def mv_refs(old_slide_name, new_slide_name, src):
+	return run_actions(mv_refs_actions(old_slide_name, new_slide_name), src)
+
+def share_assets_actions(globals_dir, composer):
+	return [
 		action(
 			"stylesheets",
 			lambda soup: soup.find_all("link", {"rel": "stylesheet"}),
@@ -321,25 +377,132 @@ def share_assets(globals_dir, composer, src):
 			add_meta(charset="utf-8"),
 			veeva_composer("veeva:"))
 	]
-	return run_actions(actions, src)
 
-def parse_folder(path, **kwargs):
+@curry
+def share_assets(globals_dir, composer, src):
+	return run_actions(share_assets_actions(globals_dir, composer), src)
+
+# curried actions can't be pickled, so pipelines that need to cross into a worker process
+# are shipped by name and built again on the other side
+PIPELINES = {
+	"integrate_all": lambda: integrate_all_actions(veeva_composer("veeva:")),
+	"veev2rel": lambda: veev2rel_actions(veeva_composer("veeva:")),
+	"rel2veev": lambda: rel2veev_actions(veeva_composer("veeva:")),
+	"mv_refs": lambda old_slide_name, new_slide_name: mv_refs_actions(old_slide_name, new_slide_name),
+	"rename_refs": lambda mapping: rename_refs_actions(mapping),
+	"share_assets": lambda globals_dir: share_assets_actions(globals_dir, veeva_composer("veeva:"))
+}
+
+def run_pipeline(name, args, src):
+	return run_actions(PIPELINES[name](*args), src)
+
+def pipeline(name, *args):
+	return partial(run_pipeline, name, args)
+
+def relink_file(filename, actions):
+	if len(actions) == 0: return False # nothing to do, and nothing to turn the bytes back into text
+
+	with open(filename, 'rb') as f:
+		original = f.read()
+
+	# every action works on the previous one's output in memory, the file is written at most once
+	clean = reduce(lambda src, action: action(src), actions, original).encode('utf-8')
+	if clean == original: return False
+
+	break_link(filename, keep_contents=False)
+	with open(filename, 'wb') as f:
+		f.write(clean)
+	return True
+
+def find_html(paths, cutoff=float("inf")):
+	matches = []
+	for path in paths:
+		if os.path.isfile(path):
+			matches.append(path)
+			continue
+
+		for root, dirnames, filenames in os.walk(path):
+			if root.count(os.sep) <= cutoff:
+				for filename in fnmatch.filter(filenames, "*.htm*"):
+					matches.append(os.path.join(root, filename))
+
+	return sorted(set(matches), key=matches.index) # overlapping folders only get relinked once
+
+def picklable(obj):
+	try:
+		pickle.dumps(obj)
+		return True
+	except (pickle.PicklingError, AttributeError, TypeError):
+		return False
+
+def parse_folder(paths, **kwargs):
 	actions = kwargs.get("actions", [])
 	CUTOFF = kwargs.get("cutoff", float("inf"))
 	verbose = kwargs.get("verbose", False)
+	parallel = kwargs.get("parallel", False)
+	workers = kwargs.get("workers", None)
 
-	matches = []
-	for root, dirnames, filenames in os.walk(path):
-		if root.count(os.sep) <= CUTOFF:
-			for filename in fnmatch.filter(filenames, "*.htm*"):
-				matches.append(os.path.join(root, filename))
-
-	for filename in matches:
-		if verbose: print("Re-linking %s" % filename)
-		for action in actions:
-			clean = action(open(filename, 'rb'))
-			with open(filename, 'wb') as f:
-				f.write(clean.encode('utf-8'))
+	if isinstance(paths, str): paths = [paths]
+	matches = find_html(paths, CUTOFF)
+
+	if parallel and len(matches) > 1 and not picklable(actions):
+		if verbose: print("Relink actions can't be sent to worker processes, relinking serially (use relink.pipeline)")
+		parallel = False
+
+	if parallel and len(matches) > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+			chunksize = max(1, len(matches) // (4 * (workers or os.cpu_count() or 1)))
+			changed = executor.map(relink_file, matches, repeat(actions), chunksize=chunksize)
+			results = list(zip(matches, changed))
+	else:
+		results = [(filename, relink_file(filename, actions)) for filename in matches]
+
+	if verbose:
+		for filename, changed in results:
+			print("Re-linking %s%s" % (filename, "" if changed else " (unchanged)"))
+
+	return [filename for filename, changed in results if changed]
+
+def benchmark(slides=500, globals_dir="global"):
+	SLIDE = textwrap.dedent('''\
+		<!DOCTYPE html>
+		<html>
+		<head>
+		<meta name="veeva_title" content="Slide %(n)d">
+		<link rel="stylesheet" href="../../%(g)s/css/main.css">
+		<link rel="stylesheet" href="slide.css">
+		<script src="../../%(g)s/js/lib.js"></script>
+		</head>
+		<body style="background-image: url('../%(g)s/img/bg.png')">
+		<header><img src="../%(g)s/img/logo.png"><h1>Slide %(n)d</h1></header>
+		%(body)s
+		<nav><a href="../%(prev)s/%(prev)s.html">prev</a> <a href="../%(next)s/%(next)s.html">next</a>
+		<a href="veeva:gotoSlide(%(next)s.zip)">veeva</a> <a href="http://example.com/x">external</a></nav>
+		</body>
+		</html>
+		''')
+	PARAGRAPH = '<p>Lorem <b>ipsum</b> dolor sit amet &amp; <a href="../slide_%d/">more</a></p>\n'
+
+	def name(n): return "slide_%d" % (n % slides)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		files = []
+		for n in range(slides):
+			os.makedirs(os.path.join(tmp, name(n)))
+			files.append(os.path.join(tmp, name(n), name(n) + ".html"))
+			with open(files[-1], 'w') as f:
+				f.write(SLIDE % {'n': n, 'g': globals_dir, 'prev': name(n-1), 'next': name(n+1),
+					'body': "".join([PARAGRAPH % ((n + i) % slides) for i in range(20)])})
+
+		composer = veeva_composer("veeva:")
+		results = {}
+		for reparse in [True, False]:
+			start = time.time()
+			results[reparse] = [run_actions(share_assets_actions(globals_dir, composer), open(f, 'rb'), reparse=reparse) for f in files]
+			print("%s: %.2fs" % ("one parse per action" if reparse else "single parse", time.time() - start))
+
+		print("identical output: %s" % (results[True] == results[False]))
+		return results[True] == results[False]
 
 def runScript():
 	## TODO: make work with --root flag
@@ -357,13 +520,16 @@ def runScript():
 
 	parser.add_argument("--root", nargs=1, help="Project root folder", required=False)
 	parser.add_argument("--verbose", action="store_true", required=False, help="Chatty Cathy")
+	parser.add_argument("--notparallel", action="store_true", required=False, help="Relink files one at a time")
 
 	group = parser.add_mutually_exclusive_group()
-	group.add_argument("--mv", nargs=3, metavar=("old_name", "new_name", "source"), help="recursively rename references to an old slide name with a new slide name")
+	group.add_argument("--mv", nargs="+", metavar="arg", help="recursively rename references to slides: either old_name new_name source, or mapping_file source [source ...] (json object or one 'old new' pair per line)")
 	group.add_argument("--veev2rel", nargs="+", metavar="source", help="recursively replace veeva links with relative links")
 	group.add_argument("--rel2veev", nargs="+", metavar="source", help="recursively replace relative links with veeva link")
 	group.add_argument("--integrate-all", nargs="+", metavar="source", help="recursively resolve relative links and replace hrefs with veeva")
 	group.add_argument("--share-assets", nargs="+", metavar="source", help="recursively replace links to global assets with veeva ../shared/ prefix")
+	group.add_argument("--who-links-to", nargs="+", metavar=("slide", "source"), help="list the files that link to a slide (sources default to the project's source folder)")
+	group.add_argument("--benchmark", nargs="?", type=int, const=500, metavar="slides", help="time single-parse against one-parse-per-action relinking on a synthetic deck")
 
 	if len(sys.argv) == 1:
 		parser.print_help()
@@ -371,43 +537,56 @@ def runScript():
 
 	args = parser.parse_args()
 	verbose = args.verbose
+	parallel = not args.notparallel
 
-	composer = veeva_composer("veeva:")
+	if args.benchmark is not None:
+		return 0 if benchmark(args.benchmark) else 1
 
-	if args.mv is not None:
-		old, new, folder = args.mv
-		if not all_exists([folder]): 
+	if args.who_links_to is not None:
+		veeva_root = args.root[0] if args.root else os.getcwd()
+		index_path = default_index_path(veeva_root)
+		if index_path is None:
+			print("Relink.py: could not load config file", file=sys.stderr)
 			return 128
-		else:
-			return parse_folder(folder, actions=[mv_refs(composer, old, new)], verbose=verbose)
 
-	if args.veev2rel is not None:
-		folders = args.veev2rel
-		if not all_exists(folders):
-			return 128
-		else:
-			for folder in folders:
-				parse_folder(folder, actions=[veev2rel(composer)], verbose=verbose)
-			return
+		slide = args.who_links_to[0]
+		folders = args.who_links_to[1:]
+		if len(folders) == 0:
+			with open(os.path.join(veeva_root, CONFIG_FILENAME)) as f:
+				folders = [os.path.join(veeva_root, json.load(f)['MAIN']['source_dir'])]
+		if not all_exists(folders): return 128
 
-	if args.rel2veev is not None:
-		folders = args.rel2veev
-		if not all_exists(folders):
-			return 128
+		index = LinkIndex(index_path).update(folders)
+		for path, kind, value in index.links_to(slide):
+			print("%s\t%s=\"%s\"" % (os.path.relpath(path), kind, value))
+		index.close()
+		return
+
+	if args.mv is not None:
+		if os.path.isfile(args.mv[0]) and len(args.mv) >= 2:
+			mapping = load_mapping(args.mv[0])
+			folders = args.mv[1:]
+		elif len(args.mv) == 3:
+			mapping = {args.mv[0]: args.mv[1]}
+			folders = args.mv[2:]
 		else:
-			for folder in folders:
-				parse_folder(folder, actions=[rel2veev(composer)], verbose=verbose)
-			return
+			parser.error("--mv takes old_name new_name source, or mapping_file source [source ...]")
 
-	if args.integrate_all is not None:
-		folders = args.integrate_all
 		if not all_exists(folders):
 			return 128
 		else:
-			for folder in folders:
-				parse_folder(folder, actions=[integrate_all(composer)], verbose=verbose)
+			parse_folder(folders, actions=[pipeline("rename_refs", mapping)], verbose=verbose, parallel=parallel)
 			return
 
+	for name in ["veev2rel", "rel2veev", "integrate_all"]:
+		folders = getattr(args, name)
+		if folders is not None:
+			if not all_exists(folders):
+				return 128
+			else:
+				parse_folder(folders, actions=[pipeline(name)], verbose=verbose, parallel=parallel)
+				return
+
 	if args.share_assets is not None:
 		if args.root:
 			veeva_root = args.root[0]
@@ -429,8 +608,7 @@ def runScript():
 		if not all_exists(folders):
 			return 128
 		else:
-			for folder in folders:
-				parse_folder(folder, actions=[share_assets(global_assets,composer)], verbose=verbose)
+			parse_folder(folders, actions=[pipeline("share_assets", global_assets)], verbose=verbose, parallel=parallel)
 
 
 if __name__ == "__main__": 
@@ -2,13 +2,14 @@
 import activate_venv
 
 from veevutils import banner, safe_rename, is_slide, parse_slide
-from relink import parse_folder, mv_refs
+from prefix import rename_refs
+from linkindex import default_index_path
 
 import argparse
 import sys
 import os
 
-def rename_slide(old, new, root=None, relink=True, verbose=False):
+def rename_slide(old, new, root=None, relink=True, verbose=False, index=None):
 	THUMB_NAME = "-thumb.jpg"
 	FULL_NAME = "-full.jpg"
 
@@ -29,8 +30,7 @@ def rename_slide(old, new, root=None, relink=True, verbose=False):
 
 	#relink first so we don't have to worry about adjusting file paths
 	if relink:
-		renamer = mv_refs(old_slide_name, new_slide_name)
-		parse_folder(root, actions=[renamer], verbose=verbose)
+		rename_refs({old_slide_name: new_slide_name}, root, verbose=verbose, parallel=False, index=index)
 
 
 	#rename inner file
@@ -80,7 +80,8 @@ def runScript():
 	if not os.path.exists(old): raise IOError("%s does not exist" % old)
 	if os.path.exists(new): raise IOError("%s already exists" % new)
 
-	rename_slide(old, new, root=ROOT, relink=(not args.norelink), verbose=args.verbose)
+	rename_slide(old, new, root=ROOT, relink=(not args.norelink), verbose=args.verbose,
+		index=default_index_path(ROOT if ROOT is not None else '.'))
 
 
 if __name__ == '__main__': 
@@ -1,91 +1,149 @@
 #!/usr/bin/env python3
 import activate_venv
 
-from veevutils import banner, is_slide, CONFIG_FILENAME
+from veevutils import banner, is_slide, get_cache_dir, break_link, CONFIG_FILENAME
 from prefix import parse_slide_folders
+from manifest import hash_file
 
+from bs4 import BeautifulSoup # also requires lxml
 from selenium import webdriver
 from contextlib import closing
 from PIL import Image
+from urllib.parse import unquote, urlparse
 
 import argparse
 import concurrent.futures
+import hashlib
 import multiprocessing as mp
 import re
 import io
+import itertools
 import json
 import os
+import queue
 import shutil
+import signal
 import sys
 import textwrap
+import time
 
-def ss_(url, dest, sizes, filename, driver, verbose=False):
-	BACKGROUND_COLOR = (255, 255, 255)
+DEFAULT_TIMEOUT = 60 # seconds per page load
+DEFAULT_RETRIES = 1
+DEFAULT_MAX_PAGES = 50 # pages before a browser is restarted
+DRIVER_MEMORY = 300*1024*1024 # guess until a browser has been measured
+MEMORY_RESERVE = 512*1024*1024
+CACHE_MAX_AGE = 30*24*60*60 # seconds a capture stays cached without being used
 
-	def __snap(driver, w, h, fname, suffix=None):
-
-		splitter = re.compile(r'([^.]+)(.+)')
+def shot_filenames(dest, sizes, filename):
+	splitter = re.compile(r'([^.]+)(.+)')
 
+	def __fname(w, h, suffix=None):
 		if suffix is None: 
 			suffix = ""
 		elif suffix == "[dimensions]":
 			suffix = str(w) + "x" + str(h)
 
+		pieces = list(splitter.search(filename).groups())
+		return os.path.join(dest, pieces[0] + suffix + "".join(pieces[1:]))
+
+	return [(int(x['width']), int(x['height']), __fname(x['width'], x['height'], x.get('suffix', None))) for x in sizes]
+
+def ss_(url, dest, sizes, filename, driver, verbose=False):
+	BACKGROUND_COLOR = (255, 255, 255)
+
+	# don't override user provided thumbs
+	shots = [shot for shot in shot_filenames(dest, sizes, filename) if not os.path.exists(shot[2])]
+	if len(shots) == 0: return {'url': url, 'load': 0.0, 'capture': 0.0}
+
+	# load and capture once at the biggest viewport, every other size is scaled down from that
+	width = max([shot[0] for shot in shots])
+	height = max([shot[1] for shot in shots])
+
+	start = time.time()
+	driver.set_window_size(width, height)
+	driver.get(url)
+	loaded = time.time()
+
+	img = Image.open(io.BytesIO(driver.get_screenshot_as_png()))
+	img.load()
+	captured = time.time()
+
+	for w, h, new_fname in shots:
 		if verbose: print(url + ": " + str(w)+"x"+str(h))
 
-		try:
-			driver.set_window_size(int(w), int(h))
-			driver.get(url)
+		cropped = img.resize((w, h), Image.BILINEAR)
 
-			pieces = list(splitter.search(fname).groups())
-			new_fname = os.path.join(dest, pieces[0] + suffix + "".join(pieces[1:]))
+		bg = Image.new('RGB', cropped.size, BACKGROUND_COLOR)
+		bg.paste(cropped, mask=cropped.split()[3])
+		bg.save(new_fname, 'jpeg')
 
-			png = io.BytesIO(driver.get_screenshot_as_png())
-			img = Image.open(png)
-			cropped = img.resize((int(w), int(h)), Image.BILINEAR)
+	timing = {'url': url, 'load': loaded - start, 'capture': captured - loaded}
+	if verbose: print("%s: loaded in %.2fs, captured in %.2fs" % (url, timing['load'], timing['capture']))
 
-			bg = Image.new('RGB', cropped.size, BACKGROUND_COLOR)
-			bg.paste(cropped, mask=cropped.split()[3])
-		
-			if not os.path.exists(new_fname): # don't override user provided thumbs
-				bg.save(new_fname, 'jpeg')
-		except Exception as e:
-			raise e
-	
-	[__snap(driver, x['width'], x['height'], filename, x.get('suffix', None)) for x in sizes]
+	return timing
+
+def new_driver(timeout=None):
+	driver = webdriver.PhantomJS()
+	if timeout is not None: driver.set_page_load_timeout(timeout)
+	return driver
 
-def ss_q(q, verbose=False):
+def quit_driver(driver):
+	if driver is None: return
 	try:
-		driver = webdriver.PhantomJS()
+		driver.quit()
+	except Exception:
+		pass # already gone
 
-		while True:
-			job = q.get()
-			if job is None: break
+def driver_pid(driver):
+	try:
+		return driver.service.process.pid
+	except AttributeError:
+		return None
 
-			try:
-				ss_(job[0], job[1], job[2], job[3], driver, verbose)
-				q.task_done()
-			except exception as e:
-				q.task_done()
-				raise e
+def ss_q(wid, jobs, results, verbose=False, timeout=None, max_pages=None, stop=None):
+	# talks to the supervisor in take_screenshots_async through the results queue:
+	# ("ready", wid, browser pid), ("start", wid, job), ("done", wid, job, timing), ("failed", wid, job, error)
+	# setting stop retires this worker before its next job, without waiting for the queue to drain
+	driver = None
+	pages = 0
 
-		driver.quit()
-	
-	except Exception as e:
-		#empty the queue so it doesn't deadlock
-		while True:
-			job = q.get()
+	try:
+		while stop is None or not stop.is_set():
+			job = jobs.get()
 			if job is None: break
 
-			q.task_done()
-		
-		raise e
+			job_id, args = job
+			results.put(("start", wid, job_id))
+
+			try:
+				if driver is None:
+					driver = new_driver(timeout)
+					pages = 0
+					results.put(("ready", wid, driver_pid(driver)))
+
+				timing = ss_(*args, driver=driver, verbose=verbose)
+				pages = pages + 1
+				results.put(("done", wid, job_id, timing))
+			except Exception as e:
+				results.put(("failed", wid, job_id, "%s: %s" % (type(e).__name__, str(e).strip())))
+
+				# the browser might be what broke, start the next job with a fresh one
+				quit_driver(driver)
+				driver = None
+
+			if max_pages is not None and pages >= max_pages:
+				quit_driver(driver) # phantomjs leaks memory over long runs
+				driver = None
+	finally:
+		quit_driver(driver)
 
 def ss(url, dest, sizes, filename, verbose=False):
 	driver = webdriver.PhantomJS()
-	ss_(url, dest, sizes, filename, driver, verbose)
+	timing = ss_(url, dest, sizes, filename, driver, verbose)
 	driver.quit()
 
+	return timing
+
 def ss_conc(configs, executor):
 	procs = []
 
@@ -173,32 +231,343 @@ def local_slide_name(path):
 	newname = os.path.splitext(os.path.basename(path))[0] + ".jpg"
 	return newname
 
-def take_screenshots_async(source_folder, config_path, verbose=False):
+def available_memory():
+	try:
+		with open("/proc/meminfo") as f:
+			for line in f:
+				if line.startswith("MemAvailable:"): return int(line.split()[1]) * 1024
+	except (IOError, ValueError):
+		pass
+
+	try:
+		return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+	except (ValueError, OSError, AttributeError):
+		return None # no idea, don't limit on memory
+
+def process_memory(pid):
+	try:
+		with open("/proc/%d/status" % pid) as f:
+			for line in f:
+				if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+	except (IOError, ValueError, TypeError):
+		return None
+
+def auto_workers(jobs, driver_memory=DRIVER_MEMORY):
+	count = mp.cpu_count()
+
+	available = available_memory()
+	if available is not None:
+		count = min(count, int((available - MEMORY_RESERVE) // driver_memory))
+
+	return max(1, min(count, jobs))
+
+def kill_worker(worker):
+	if worker['proc'].is_alive():
+		worker['proc'].terminate()
+		worker['proc'].join(1)
+
+	if worker['browser'] is not None:
+		try:
+			os.kill(worker['browser'], signal.SIGKILL) # orphaned when its worker is terminated
+		except (OSError, TypeError):
+			pass
+
+def run_pool(shots, verbose=False, workers=None, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, max_pages=DEFAULT_MAX_PAGES):
+	jobs = mp.Queue()
+	manager = mp.Manager()
+	results = manager.Queue() # puts go straight through, nothing is lost in a buffer when a worker dies
+
+	for job_id, shot in enumerate(shots): jobs.put((job_id, tuple(shot)))
+
+	remaining = set(range(len(shots)))
+	attempts = dict([(job_id, 0) for job_id in remaining])
+	timings = []
+	failures = {}
+
+	# phantomjs' own page load timeout should fire first, this catches browsers that hang outright
+	hard_timeout = None if timeout is None else timeout * 2 + 10
+	driver_memory = DRIVER_MEMORY
+
+	pool = {}
+	wids = itertools.count()
+
+	def spawn():
+		wid = next(wids)
+		stop = mp.Event()
+		proc = mp.Process(target=ss_q, args=(wid, jobs, results, verbose, timeout, max_pages, stop))
+		pool[wid] = {'proc': proc, 'stop': stop, 'browser': None, 'job': None, 'started': None}
+		proc.start()
+
+	def memory_allows():
+		available = available_memory()
+		return available is None or available - MEMORY_RESERVE >= driver_memory
+
+	def fail(job_id, error):
+		attempts[job_id] = attempts[job_id] + 1
+
+		if attempts[job_id] <= retries:
+			if verbose: print("Retrying %s (%s)" % (shots[job_id][0], error))
+			jobs.put((job_id, tuple(shots[job_id])))
+		else:
+			failures[job_id] = error
+			remaining.discard(job_id)
+
+	if workers is None: workers = auto_workers(len(shots))
+	if verbose: print("Taking screenshots with %d workers" % workers)
+	for i in range(workers): spawn()
+
+	last_message = time.time()
+	while len(remaining) > 0:
+		try:
+			message = results.get(timeout=0.5)
+		except queue.Empty:
+			message = None
+
+		if message is not None and message[1] in pool:
+			last_message = time.time()
+			kind, worker = message[0], pool[message[1]]
+
+			if kind == "ready":
+				worker['browser'] = message[2]
+			elif kind == "start":
+				worker['job'], worker['started'] = message[2], time.time()
+			elif kind == "done":
+				worker['job'] = None
+				timings.append(message[3])
+				remaining.discard(message[2])
+
+				# measure what a browser really costs, and shed workers when memory runs low
+				used = process_memory(worker['browser'])
+				if used is not None: driver_memory = max(driver_memory, used)
+				running = [w for w in pool.values() if not w['stop'].is_set()]
+				if len(running) > 1 and not memory_allows():
+					if verbose: print("Low on memory, dropping a screenshot worker")
+					worker['stop'].set() # it exits cleanly instead of taking another job
+			elif kind == "failed":
+				worker['job'] = None
+				fail(message[2], message[3])
+
+		for wid, worker in list(pool.items()):
+			hung = worker['job'] is not None and hard_timeout is not None and time.time() - worker['started'] > hard_timeout
+			if not hung and worker['proc'].is_alive(): continue
+
+			crashed = hung or worker['proc'].exitcode != 0
+			if worker['job'] is not None:
+				fail(worker['job'], "timed out after %ds" % hard_timeout if hung else "worker died (exit code %s)" % worker['proc'].exitcode)
+
+			if crashed: kill_worker(worker)
+			del pool[wid]
+			last_message = time.time() # give the replacement time to pick up its first job
+
+			if crashed and len(remaining) > 0 and (len(pool) == 0 or memory_allows()): spawn()
+
+		if len(pool) == 0 and len(remaining) > 0: spawn()
+
+		# a worker that died between taking a job and announcing it loses that job
+		idle = all([worker['job'] is None for worker in pool.values()])
+		if idle and hard_timeout is not None and time.time() - last_message > hard_timeout:
+			for job_id in list(remaining): fail(job_id, "lost by a crashed worker")
+			last_message = time.time()
+
+	for worker in pool.values():
+		worker['stop'].set()
+		jobs.put(None) # wakes workers already waiting on an empty queue
+	for worker in pool.values():
+		worker['proc'].join(hard_timeout)
+		if worker['proc'].is_alive(): kill_worker(worker)
+	manager.shutdown()
+
+	failed = [(shots[job_id][0], attempts[job_id], error) for job_id, error in sorted(failures.items())]
+	return timings, failed
+
+def report_failures(failures):
+	if len(failures) == 0: return
+
+	print("%d screenshot%s failed:" % (len(failures), "" if len(failures) == 1 else "s"), file=sys.stderr)
+	for url, tries, error in failures:
+		print("  %s (%d attempt%s): %s" % (url, tries, "" if tries == 1 else "s", error), file=sys.stderr)
+
+URL_MATCHER = re.compile(r"""url\(\s*['"]?([^'")]+)['"]?\s*\)""")
+
+def local_refs(html, base):
+	# files a page pulls in: src attributes, stylesheets, inline and <style> url()s
+	with open(html, 'rb') as f:
+		soup = BeautifulSoup(f, "lxml")
+
+	refs = [tag["src"] for tag in soup.find_all(src=True)]
+	refs = refs + [tag["href"] for tag in soup.find_all("link", href=True)]
+	refs = refs + [tag["poster"] for tag in soup.find_all(poster=True)]
+	for tag in soup.find_all(style=True): refs = refs + URL_MATCHER.findall(tag["style"])
+	for tag in soup.find_all("style"): refs = refs + URL_MATCHER.findall(tag.get_text())
+
+	return local_paths(refs, base)
+
+def local_paths(refs, base):
+	paths = []
+	for ref in refs:
+		parsed = urlparse(ref.strip())
+		if parsed.scheme != '' or parsed.netloc != '' or parsed.path == '': continue
+		paths.append(os.path.normpath(os.path.join(base, unquote(parsed.path))))
+	return paths
+
+def screenshot_fingerprint(url, sizes):
+	digest = hashlib.sha1()
+	digest.update(json.dumps(sizes, sort_keys=True).encode('utf-8'))
+	hash_file(url, digest)
+
+	seen = set([os.path.abspath(url)])
+	pending = local_refs(url, os.path.dirname(url))
+	while len(pending) > 0:
+		path = pending.pop(0)
+		if os.path.abspath(path) in seen: continue
+		seen.add(os.path.abspath(path))
+
+		digest.update(os.path.relpath(path, os.path.dirname(url)).encode('utf-8'))
+		if not os.path.isfile(path):
+			digest.update(b"missing")
+			continue
+
+		hash_file(path, digest)
+		if path.endswith(".css"): # images and fonts the stylesheet pulls in
+			with open(path, encoding='utf-8', errors='replace') as f:
+				pending = pending + local_paths(URL_MATCHER.findall(f.read()), os.path.dirname(path))
+
+	return digest.hexdigest()
+
+class ScreenshotCache:
+	def __init__(self, path):
+		self.path = path
+		self.index_path = os.path.join(path, "index.json")
+		self.generated = set() # hashes of every jpeg we've written, anything else was made by hand
+
+		if os.path.exists(self.index_path):
+			try:
+				with open(self.index_path) as f:
+					self.generated = set(json.load(f).get("generated", []))
+			except ValueError:
+				pass
+
+	def is_generated(self, path):
+		return hash_file(path).hexdigest() in self.generated
+
+	def entry(self, fingerprint):
+		return os.path.join(self.path, fingerprint[:2], fingerprint)
+
+	def restore(self, fingerprint, files):
+		entry = self.entry(fingerprint)
+		cached = [os.path.join(entry, os.path.basename(f)) for f in files]
+		if not all([os.path.exists(c) for c in cached]): return False
+
+		for src, dst in zip(cached, files):
+			break_link(dst, keep_contents=False)
+			shutil.copyfile(src, dst)
+		os.utime(entry) # recently used, keeps it from being pruned
+		return True
+
+	def store(self, fingerprint, files):
+		entry = self.entry(fingerprint)
+		if not os.path.exists(entry): os.makedirs(entry)
+
+		for f in files:
+			shutil.copyfile(f, os.path.join(entry, os.path.basename(f)))
+			self.generated.add(hash_file(f).hexdigest())
+		os.utime(entry)
+
+	def prune(self, thumbs, max_age=CACHE_MAX_AGE):
+		# only hashes of thumbs that are still around matter, captures go once nobody has asked for them in a while
+		self.generated = self.generated & set([hash_file(f).hexdigest() for f in thumbs if os.path.exists(f)])
+		if not os.path.exists(self.path): return
+
+		cutoff = time.time() - max_age
+		for bucket in os.listdir(self.path):
+			bucket_path = os.path.join(self.path, bucket)
+			if not os.path.isdir(bucket_path): continue
+
+			for fingerprint in os.listdir(bucket_path):
+				entry = os.path.join(bucket_path, fingerprint)
+				try:
+					if os.stat(entry).st_mtime < cutoff: shutil.rmtree(entry)
+				except FileNotFoundError:
+					pass # pruned by someone else
+
+			if len(os.listdir(bucket_path)) == 0: os.rmdir(bucket_path)
+
+	def save(self):
+		if not os.path.exists(self.path): os.makedirs(self.path)
+
+		tmp_path = self.index_path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({"generated": sorted(self.generated)}, f)
+		os.replace(tmp_path, self.index_path)
+
+def cached_shots(shots, cache, verbose=False):
+	# put back the thumbs of unchanged slides, and get stale ones out of the way so they're taken again
+	misses = []
+	for shot in shots:
+		url, dest, sizes, filename = shot
+		fingerprint = screenshot_fingerprint(url, sizes)
+		files = [f for w, h, f in shot_filenames(dest, sizes, filename)]
+
+		ours = [f for f in files if not os.path.exists(f) or cache.is_generated(f)]
+		if len(ours) == 0: continue # all user provided
+
+		if cache.restore(fingerprint, ours):
+			if verbose: print("%s: unchanged, using cached screenshots" % url)
+			continue
+
+		for f in ours:
+			if os.path.exists(f): os.remove(f)
+		misses.append((shot, fingerprint, ours))
+
+	return misses
+
+def take_screenshots_async(source_folder, config_path, verbose=False, only=None, workers=None, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, max_pages=DEFAULT_MAX_PAGES, cache_dir=None):
 	sizes = load_ss_config(config_path)
 	slides = parse_slide_folders(source_folder)
 
-	dests = [slide[0] for slide in slides[0]]
-	urls = [os.path.join(slide[0],slide[1]) for slide in slides[0]]
+	found = [slide for slide in slides[0] if only is None or os.path.basename(slide[0]) in only]
+
+	dests = [slide[0] for slide in found]
+	urls = [os.path.join(slide[0],slide[1]) for slide in found]
 
 	shots = list(gen_configs(urls, dests, sizes, local_slide_name))
 
-	q = mp.JoinableQueue()
-	procs = []
+	if cache_dir is not None:
+		cache = ScreenshotCache(cache_dir)
+		misses = cached_shots(shots, cache, verbose)
+		shots = [shot for shot, fingerprint, files in misses]
+
+	timings, failures = [], []
+	if len(shots) > 0: timings, failures = run_pool(shots, verbose, workers, timeout, retries, max_pages)
 
-	for i in range(mp.cpu_count()*2):
-		p = mp.Process(target=ss_q, args=(q,verbose))
-		procs.append(p)
-		p.start()
+	if cache_dir is not None:
+		failed = set([url for url, tries, error in failures])
+		for shot, fingerprint, files in misses:
+			if shot[0] not in failed:
+				cache.store(fingerprint, [f for f in files if os.path.exists(f)])
+			else:
+				for f in files: # half done, would look hand made next time
+					if os.path.exists(f): os.remove(f)
 
-	for item in shots:
-		q.put(tuple(item))
+		# every slide's thumbs count, not just the ones in this run
+		everything = gen_configs([os.path.join(slide[0], slide[1]) for slide in slides[0]], [slide[0] for slide in slides[0]],
+			sizes, local_slide_name)
+		cache.prune([f for shot in everything for w, h, f in shot_filenames(*shot[1:])])
+		cache.save()
 
-	q.join()
+	if verbose: report_timings(timings)
+	report_failures(failures)
 
-	for i in range(mp.cpu_count()*2):
-		q.put(None)
+	return timings, failures
 
-	for proc in procs: proc.join()
+def report_timings(timings):
+	if len(timings) == 0: return
+
+	for timing in sorted(timings, key=lambda t: t['load'] + t['capture'], reverse=True):
+		print("%6.2fs load %6.2fs capture  %s" % (timing['load'], timing['capture'], timing['url']))
+
+	print("%d slides: %.2fs loading, %.2fs capturing" % (len(timings),
+		sum([t['load'] for t in timings]), sum([t['capture'] for t in timings])))
 
 def fake_shared_assets(config_path, root_dir):
 	if not os.path.exists(config_path): raise Exception('Config file not found!')
@@ -247,6 +616,20 @@ def cleanup_fake_shared_assets(config_path, root_dir):
 			if not files and not dir_names:
 				shutil.rmtree(dir_path)
 
+def take_screenshots(source_path, config_path, root_dir, shared_assets=False, verbose=False, only=None, cache=True, **pool):
+	# fake Veeva shared assets for the screenshots
+	if shared_assets: fake_shared_assets(config_path, root_dir)
+
+	cache_dir = None
+	if cache:
+		with open(config_path) as f:
+			cache_dir = get_cache_dir(root_dir, json.load(f), "screenshots")
+
+	try:
+		return take_screenshots_async(source_path, config_path, verbose, only=only, cache_dir=cache_dir, **pool)
+	finally:
+		if shared_assets: cleanup_fake_shared_assets(config_path, root_dir)
+
 def runScript():
 	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
 		description = banner(subtitle="Screenshot Generator"))
@@ -256,6 +639,11 @@ def runScript():
 	parser.add_argument("--root", nargs=1, help="Project root folder", required=False)
 	parser.add_argument("--verbose", action="store_true", help="Chatty Cathy", required=False)
 	parser.add_argument("--shared-assets", action="store_true", help="Use Veeva shared assets", required=False)
+	parser.add_argument("--nocache", action="store_true", help="Retake every screenshot instead of reusing the ones of unchanged slides", required=False)
+	parser.add_argument("--workers", type=int, help="Number of browsers to run at once (default: based on cpus and free memory)", required=False)
+	parser.add_argument("--timeout", type=int, default=DEFAULT_TIMEOUT, help="Seconds to wait for a slide to load (default: %(default)s)", required=False)
+	parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Times to retry a failed slide (default: %(default)s)", required=False)
+	parser.add_argument("--pages-per-driver", type=int, default=DEFAULT_MAX_PAGES, help="Restart each browser after this many slides (default: %(default)s)", required=False)
 
 
 	if len(sys.argv) == 1:
@@ -281,12 +669,10 @@ def runScript():
 	config_path = os.path.join(root_dir, config_file_name)
 	source_path = os.path.join(root_dir, args.source[0])
 
-	# fake Veeva shared assets for the screenshots
-	if args.shared_assets: fake_shared_assets(config_path, root_dir)
-
-	take_screenshots_async(source_path, config_path, VERBOSE)
+	timings, failures = take_screenshots(source_path, config_path, root_dir, shared_assets=args.shared_assets, verbose=VERBOSE,
+		cache=(not args.nocache), workers=args.workers, timeout=args.timeout, retries=args.retries, max_pages=args.pages_per_driver)
 
-	if args.shared_assets: cleanup_fake_shared_assets(config_path, root_dir)
+	return 1 if len(failures) > 0 else 0
 
 if __name__ == "__main__":
 	sys.exit(runScript())
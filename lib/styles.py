@@ -21,7 +21,7 @@ def rename_one(file):
 
 	os.rename(file, renamed)
 
-def compile_sass(dir, remove_source=False, async=False):
+def compile_sass(dir, remove_source=False, parallel=False):
 	builder.build_directory(dir, dir)
 	#compiled = glob.glob(os.path.join(dir,"*.scss.css"))
 	compiled = []
@@ -31,7 +31,7 @@ def compile_sass(dir, remove_source=False, async=False):
 			if fnmatch.fnmatch(file, "*.scss.css"):
 				compiled.append(os.path.join(root,file))
 
-	if async:
+	if parallel:
 		with concurrent.futures.ProcessPoolExecutor() as e:
 			for file in compiled:
 				e.submit(rename_one, file)
@@ -62,7 +62,7 @@ def runScript(ASYNC=False):
 		return 2
 	else:
 		args = parser.parse_args()
-		compile_sass(args.source[0], remove_source=args.remove, async=(not args.notparallel))
+		compile_sass(args.source[0], remove_source=args.remove, parallel=(not args.notparallel))
 
 if __name__ == '__main__': 
 	sys.exit(runScript(ASYNC=True))
\ No newline at end of file
@@ -3,6 +3,9 @@ import activate_venv
 
 from veevutils import banner
 from veevutils import parse_slide
+from veevutils import get_cache_dir, is_inside, CONFIG_FILENAME
+
+import frontmatter
 
 import argparse
 import glob
@@ -10,11 +13,24 @@ import os
 import shutil
 import sys
 import textwrap
+import filecmp
 import fnmatch
+import hashlib
+import json
 import pyparsing as pp
 import re
 import eco
+import networkx as nx
+import execjs
 import concurrent.futures
+import queue
+import subprocess
+import tempfile
+import time
+
+COMPILE_CACHE = "eco" # compiled templates, under the project's cache folder
+DEPENDENCY_CACHE = "template-deps"
+DEPENDENCY_GRAPH_FILENAME = "graph.json"
 
 def load_html_files(dir):
 	html_dict = {}
@@ -28,10 +44,10 @@ def load_html_files(dir):
 	return html_dict
 
 def parse_header(file):
-	src = ""
-	with open(file) as f:
-		src = f.read()
+	return frontmatter.read(file)
 
+def pyparsing_header(src):
+	# the grammar parse_header used to build for every file, kept to benchmark against
 	config_reader = re.compile("^(?:---\n)(.*)(?:\n---\n)(.*)", flags=re.DOTALL)
 	pieces = config_reader.match(src)
 
@@ -61,7 +77,376 @@ def parse_header(file):
 
 	return {"context": dict, "src": remaining}
 
-def render_slide(file, templates, partials):
+PARTIAL_MATCHER = re.compile("@partial\\s*[\\[(]\\s*[\"']([^\"']+)[\"']")
+
+def find_partials(src, partials):
+	names = set(PARTIAL_MATCHER.findall(src))
+
+	if len(names) == 0 and "@partial" in src:
+		# partial looked up dynamically, so it could be any of them
+		return sorted(partials)
+
+	return sorted([name for name in names if name in partials])
+
+class DependencyGraph:
+	# slide file -> template -> partials (slides without a template -> partials), saved between runs
+	# and only re-scanned for the files whose size or mtime changed since. sticks to the networkx
+	# calls that 1.x and later share, the per-file scan details live next to the graph in self.scanned
+	def __init__(self, src, templates_dir, partials_dir, path=None):
+		self.src = src
+		self.templates_dir = templates_dir
+		self.partials_dir = partials_dir
+		self.path = path
+		self.graph = nx.DiGraph()
+		self.scanned = {} # path -> kind, stat (and slide, for slide files) as of the last scan
+		self.partials = None
+
+		if path is not None and os.path.exists(path):
+			try:
+				with open(path) as f:
+					data = json.load(f)
+				self.graph.add_nodes_from(data["nodes"])
+				self.graph.add_edges_from([tuple(edge) for edge in data["edges"]])
+				self.scanned = data["scanned"]
+				self.partials = data["partials"]
+			except (ValueError, KeyError, TypeError):
+				# corrupt (or from an older version), everything gets scanned again
+				self.graph = nx.DiGraph()
+				self.scanned = {}
+				self.partials = None
+
+	def slides(self):
+		return next(os.walk(self.src))[1]
+
+	def files(self):
+		found = {}
+		for slide in self.slides():
+			for file in slide_html_files(self.src, slide):
+				found[os.path.abspath(file)] = {"kind": "slide", "slide": slide}
+		for kind, folder in [("template", self.templates_dir), ("partial", self.partials_dir)]:
+			for file in glob.glob(os.path.join(folder, '*.htm*')):
+				found[os.path.abspath(file)] = {"kind": kind}
+		return found
+
+	def dependencies(self, file, kind):
+		if kind == "partial": return [] # partials go in as plain strings, they can't pull in anything else
+
+		partial_paths = lambda src: [os.path.abspath(os.path.join(self.partials_dir, name)) for name in find_partials(src, self.partials)]
+
+		if kind == "slide":
+			template_name = frontmatter.read_header(file).get("template", None)
+			if template_name is not None:
+				# depend on it even while it doesn't exist, so the slide re-renders once it does
+				template_path = os.path.abspath(os.path.join(self.templates_dir, template_name))
+				if os.path.exists(template_path): return [template_path] # slide source is only bound to "contents"
+				return [template_path] + partial_paths(parse_header(file)["src"])
+			return partial_paths(parse_header(file)["src"])
+
+		with open(file) as f:
+			return partial_paths(f.read())
+
+	def refresh(self):
+		files = self.files()
+
+		# which partials exist decides what find_partials matches, so a new or deleted one means scanning everything
+		partials = sorted([os.path.basename(path) for path, attrs in files.items() if attrs["kind"] == "partial"])
+		rescan = partials != self.partials
+		self.partials = partials
+
+		stats = {}
+		for path in files:
+			st = os.stat(path)
+			stats[path] = [st.st_size, st.st_mtime_ns]
+
+		stale = set([path for path in files if rescan or self.scanned.get(path, {}).get("stat", None) != stats[path]])
+		gone = [path for path in self.scanned if path not in files]
+
+		# a template appearing or disappearing changes what the slides naming it depend on
+		for path in [path for path in stale if path not in self.scanned] + gone:
+			if self.graph.has_node(path): stale.update([user for user in self.graph.predecessors(path) if user in files])
+
+		for path in gone:
+			del self.scanned[path]
+			if self.graph.has_node(path): self.graph.remove_edges_from(list(self.graph.out_edges(path)))
+
+		for path in stale:
+			self.scanned[path] = dict(files[path], stat=stats[path])
+			self.graph.add_node(path)
+			self.graph.remove_edges_from(list(self.graph.out_edges(path)))
+			self.graph.add_edges_from([(path, dep) for dep in self.dependencies(path, files[path]["kind"])])
+
+		# files that are gone and that nothing depends on any more
+		self.graph.remove_nodes_from([path for path in self.graph.nodes() if path not in files and self.graph.in_degree(path) == 0])
+
+		return self
+
+	def slide_files(self, slide):
+		return [path for path, attrs in self.scanned.items() if attrs.get("slide", None) == slide]
+
+	def slide_dependencies(self, slide):
+		# every template and partial a slide renders with, including ones it names that don't exist (yet)
+		deps = set()
+		for path in self.slide_files(slide):
+			if self.graph.has_node(path): deps.update(nx.descendants(self.graph, path))
+		return sorted(deps)
+
+	def slides_using(self, paths):
+		slides = set()
+		for path in [os.path.abspath(path) for path in paths]:
+			if is_inside(path, self.src):
+				slides.add(os.path.relpath(path, os.path.abspath(self.src)).split(os.sep)[0]) # anything in a slide's own folder
+
+			if self.graph.has_node(path):
+				users = nx.ancestors(self.graph, path) | set([path])
+				slides.update([self.scanned[user]["slide"] for user in users if "slide" in self.scanned.get(user, {})])
+
+		return slides & set(self.slides())
+
+	def changed_slides(self, paths):
+		# edges from before the refresh catch slides that stopped using a changed (or deleted) file,
+		# edges from after it catch the ones that just started
+		before = self.slides_using(paths)
+		return before | self.refresh().slides_using(paths)
+
+	def save(self):
+		if self.path is None: return
+
+		parent = os.path.dirname(self.path)
+		if parent != '' and not os.path.exists(parent): os.makedirs(parent)
+
+		tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+		with open(tmp_path, 'w') as f:
+			json.dump({"partials": self.partials, "scanned": self.scanned, "nodes": sorted(self.graph.nodes()),
+				"edges": sorted(self.graph.edges())}, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.path)
+
+def dependency_graph_path(root_dir, config):
+	return os.path.join(get_cache_dir(root_dir, config, DEPENDENCY_CACHE), DEPENDENCY_GRAPH_FILENAME)
+
+def template_key(src):
+	return hashlib.sha1((eco.version() + "\0" + src).encode("utf-8")).hexdigest()
+
+def compile_templates(srcs, cache_dir=None):
+	# {key: compiled js} for eco sources, compiling the ones that aren't cached on disk yet
+	# in a single runtime session (eco.compile starts a new one, CoffeeScript compiler and all, every time)
+	compiled = {}
+	missing = {}
+
+	for src in srcs:
+		key = template_key(src)
+		if key in compiled or key in missing: continue
+
+		cached = None if cache_dir is None else os.path.join(cache_dir, key[:2], key + ".js")
+		if cached is not None and os.path.exists(cached):
+			with open(cached) as f:
+				compiled[key] = f.read()
+		else:
+			missing[key] = src
+
+	if len(missing) == 0: return compiled
+
+	keys = sorted(missing.keys())
+	compiler = execjs.compile(eco.source.combined_contents +
+		";\nfunction precompileAll(srcs) { return srcs.map(function(src) { return eco.precompile(src); }); }")
+
+	for key, js in zip(keys, compiler.call("precompileAll", [missing[key] for key in keys])):
+		compiled[key] = js
+		if cache_dir is None: continue
+
+		cached = os.path.join(cache_dir, key[:2], key + ".js")
+		os.makedirs(os.path.dirname(cached), exist_ok=True)
+		tmp_path = "%s.%d.tmp" % (cached, os.getpid())
+		with open(tmp_path, 'w') as f:
+			f.write(js)
+		os.replace(tmp_path, cached)
+
+	return compiled
+
+class Renderer:
+	# compiled templates plus the runtime contexts built from them, kept for the life of a process
+	# so every slide a worker renders reuses them, and each batch of slides is rendered in one call
+	def __init__(self, compiled=None, cache_dir=None):
+		self.compiled = dict(compiled or {})
+		self.cache_dir = cache_dir
+		self.contexts = {}
+		self.timings = [] # seconds spent rendering each job of the last render_many
+
+	def context(self, keys):
+		keys = tuple(sorted(set(keys)))
+		if keys not in self.contexts:
+			self.contexts[keys] = execjs.compile("var templates = {};\n" +
+				"".join(["templates[%s] = %s;\n" % (json.dumps(key), self.compiled[key]) for key in keys]) +
+				"function renderMany(jobs) { return jobs.map(function(job) {" +
+				" var start = new Date().getTime(); var html = templates[job[0]](job[1]);" +
+				" return [html, new Date().getTime() - start]; }); }")
+		return self.contexts[keys]
+
+	def run(self, jobs):
+		# jobs: [template key, locals] pairs -> [html, ms] pairs
+		return self.context([key for key, locals in jobs]).call("renderMany", jobs)
+
+	def render_many(self, jobs):
+		# jobs: (eco source, locals) pairs
+		if len(jobs) == 0: return []
+
+		keys = [template_key(src) for src, locals in jobs]
+		missing = [src for (src, locals), key in zip(jobs, keys) if key not in self.compiled]
+		if len(missing) > 0: self.compiled.update(compile_templates(missing, self.cache_dir))
+
+		results = self.run([[key, locals] for key, (src, locals) in zip(keys, jobs)])
+		self.timings = [ms / 1000.0 for html, ms in results]
+		return [html for html, ms in results]
+
+	def render(self, src, locals):
+		return self.render_many([(src, locals)])[0]
+
+	def close(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+DEFAULT_RUNTIMES = min(4, os.cpu_count() or 1) # persistent js processes rendering at once
+DEFAULT_RENDER_BATCH = 16 # slides per message to a runtime
+
+# reads one json message per line from stdin and answers each with one line on stdout:
+# {"load": {key: compiled template}, "render": [[key, locals], ...]} -> {"results": [{"html", "ms"} or {"error"}, ...]}
+RUNTIME_WORKER = """
+var templates = {};
+console.log = console.info = console.error; // stdout is the protocol, keep template logging off it
+require("readline").createInterface({input: process.stdin, terminal: false}).on("line", function(line) {
+	var message = JSON.parse(line), reply = {results: []};
+	try {
+		for (var key in message.load || {}) templates[key] = eval("(" + message.load[key] + ")");
+	} catch (e) {
+		reply.error = String(e && e.stack || e);
+	}
+	(message.render || []).forEach(function(job) {
+		var start = process.hrtime();
+		try {
+			var html = templates[job[0]](job[1]), elapsed = process.hrtime(start);
+			reply.results.push({html: html, ms: elapsed[0] * 1e3 + elapsed[1] / 1e6});
+		} catch (e) {
+			reply.results.push({error: String(e && e.stack || e)});
+		}
+	});
+	process.stdout.write(JSON.stringify(reply) + "\\n");
+});
+"""
+
+def node_binary():
+	# the persistent workers talk to node directly, so only when PyExecJS would be using node anyway
+	if os.environ.get("EXECJS_RUNTIME", "Node") not in ("", "Node"): return None
+	return shutil.which("nodejs") or shutil.which("node")
+
+class RuntimeWorker:
+	def __init__(self, binary):
+		self.process = subprocess.Popen([binary, "-e", RUNTIME_WORKER], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			universal_newlines=True, encoding="utf-8")
+		self.loaded = set()
+
+	def request(self, message):
+		# node reads the whole line before answering, so writing it all and then reading can't deadlock
+		self.process.stdin.write(json.dumps(message) + "\n")
+		self.process.stdin.flush()
+
+		line = self.process.stdout.readline()
+		if line == "": raise RuntimeError("JS runtime exited unexpectedly (status %s)" % self.process.wait())
+		return json.loads(line)
+
+	def render(self, compiled, jobs):
+		load = dict([(key, compiled[key]) for key, locals in jobs if key not in self.loaded])
+		reply = self.request({"load": load, "render": jobs})
+		if "error" in reply: raise execjs.ProgramError(reply["error"])
+		self.loaded.update(load.keys())
+
+		for result in reply["results"]:
+			if "error" in result: raise execjs.ProgramError(result["error"])
+		return [[result["html"], result["ms"]] for result in reply["results"]]
+
+	def alive(self):
+		return self.process.poll() is None
+
+	def close(self):
+		try:
+			self.process.stdin.close() # node exits once stdin runs dry
+			self.process.wait(timeout=5)
+		except (OSError, subprocess.TimeoutExpired):
+			self.process.kill()
+
+class RuntimePool(Renderer):
+	# a few long-lived node processes, each loading a template once and then rendering slides
+	# streamed to it in batches, instead of PyExecJS starting a fresh runtime for every call
+	def __init__(self, compiled=None, cache_dir=None, size=DEFAULT_RUNTIMES, batch_size=DEFAULT_RENDER_BATCH, binary=None):
+		Renderer.__init__(self, compiled, cache_dir)
+		self.binary = binary or node_binary()
+		self.size = max(1, size)
+		self.batch_size = max(1, batch_size)
+		self.idle = queue.Queue()
+		self.workers = []
+
+	def replace(self, worker):
+		worker.close()
+		fresh = RuntimeWorker(self.binary)
+		self.workers[self.workers.index(worker)] = fresh
+		return fresh
+
+	def run_batch(self, batch):
+		worker = self.idle.get()
+		try:
+			if not worker.alive(): worker = self.replace(worker)
+
+			try:
+				return worker.render(self.compiled, batch)
+			except (OSError, ValueError, RuntimeError):
+				# it died mid-batch, or its pipe is out of step with it (a template throwing is an execjs.ProgramError
+				# and leaves the runtime fine), rendering has no side effects so start the batch over on a fresh one
+				worker = self.replace(worker)
+				return worker.render(self.compiled, batch)
+		finally:
+			self.idle.put(worker) # a dead one gets replaced the next time it's picked up
+
+	def run(self, jobs):
+		batches = [jobs[i:i+self.batch_size] for i in range(0, len(jobs), self.batch_size)]
+
+		while len(self.workers) < min(self.size, len(batches)):
+			worker = RuntimeWorker(self.binary)
+			self.workers.append(worker)
+			self.idle.put(worker)
+
+		if len(self.workers) == 1: return [result for batch in batches for result in self.run_batch(batch)]
+
+		# every worker pulls the next batch as soon as it's done with one
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.workers)) as executor:
+			return [result for results in executor.map(self.run_batch, batches) for result in results]
+
+	def close(self):
+		for worker in self.workers: worker.close()
+		self.workers = []
+		self.idle = queue.Queue()
+
+def new_renderer(compiled=None, cache_dir=None, runtimes=None):
+	# persistent node workers when node is around (runtimes=0 turns them off), otherwise whatever runtime PyExecJS finds
+	if runtimes != 0 and node_binary() is not None:
+		return RuntimePool(compiled, cache_dir, DEFAULT_RUNTIMES if runtimes is None else runtimes)
+	return Renderer(compiled, cache_dir)
+
+RENDERER = None # one per process, so worker processes reuse their runtime contexts across slides
+
+def init_renderer(compiled=None, cache_dir=None, runtimes=None):
+	global RENDERER
+	if RENDERER is not None: RENDERER.close()
+	RENDERER = new_renderer(compiled, cache_dir, runtimes)
+
+def default_renderer():
+	if RENDERER is None: init_renderer()
+	return RENDERER
+
+def slide_job(file, templates, partials):
+	# (eco source, locals) to render a slide file with
 	header = parse_header(file)
 	slide_src = header["src"]
 	template_name = header.get("context", {}).get("template", None)
@@ -72,38 +457,100 @@ def render_slide(file, templates, partials):
 	if template_src is not None:
 		# bind to contents variable
 		template_config["contents"] = slide_src
-		eco_ctx = eco.context_for(template_src)
-	else:
-		eco_ctx = eco.context_for(slide_src)
 
 	# merge with header context dictionary
-	return eco_ctx.call("render", dict(template_config, **header["context"]))
+	return (slide_src if template_src is None else template_src), dict(template_config, **header["context"])
 
-def render_one(src, slide, dest, templates, partials, verbose=False):
-	html_files = glob.glob(os.path.join(src, slide, "*.htm*"))
+def slide_html_files(src, slide):
+	return [file for file in glob.glob(os.path.join(src, slide, "*.htm*")) if not fnmatch.fnmatch(file, "*/index.htm*")]
 
-	if not os.path.exists(os.path.join(dest,slide)):
-		os.makedirs(os.path.join(dest,slide))
+def prepare_templates(src, slides, templates, cache_dir=None):
+	# compile every template in use, and every slide without one, before rendering anything
+	srcs = []
+	for slide in slides:
+		for file in slide_html_files(src, slide):
+			header = parse_header(file)
+			srcs.append(templates.get(header.get("context", {}).get("template", None), header["src"]))
+
+	return compile_templates(srcs, cache_dir)
+
+def render_slide(file, templates, partials, renderer=None):
+	if renderer is None: renderer = default_renderer()
+	return renderer.render(*slide_job(file, templates, partials))
+
+def write_if_changed(path, contents):
+	# leave identical output alone so its mtime (and everything downstream keyed on it) stays put,
+	# and swap changed output in whole, which never writes through a link to the source either
+	try:
+		with open(path, newline='') as f:
+			if f.read() == contents: return False
+	except (OSError, UnicodeDecodeError):
+		pass # missing, or not something we wrote
+
+	tmp_path = "%s.%d.tmp" % (path, os.getpid())
+	with open(tmp_path, 'w', newline='') as f: # no newline translation, so it reads back exactly as compared
+		f.write(contents)
+	os.replace(tmp_path, path)
+	return True
+
+def copy_if_changed(src, dest):
+	if os.path.isfile(dest) and filecmp.cmp(src, dest, shallow=False): return False
+
+	tmp_path = "%s.%d.tmp" % (dest, os.getpid())
+	shutil.copy2(src, tmp_path)
+	os.replace(tmp_path, dest)
+	return True
+
+def render_batch(src, slides, dest, templates, partials, verbose=False, renderer=None):
+	# returns the seconds each file spent in its template, and the slides whose output actually changed
+	if renderer is None: renderer = default_renderer()
+
+	outputs = []
+	jobs = []
+	for slide in slides:
+		if not os.path.exists(os.path.join(dest,slide)):
+			os.makedirs(os.path.join(dest,slide))
 
-	for file in html_files:
-		if not fnmatch.fnmatch(file, "*/index.htm*"):
+		for file in slide_html_files(src, slide):
 			if verbose: print("Rendering %s" % file)
-			html_basename = os.path.basename(file)
-			if verbose: print(os.path.join(dest,slide,html_basename))
-			rendered = render_slide(file, templates, partials)
+			outputs.append(os.path.join(dest,slide,os.path.basename(file)))
+			jobs.append(slide_job(file, templates, partials))
 
-			html_path = os.path.join(dest,slide,html_basename)
-			with open(html_path, 'w') as f:
-				f.write(rendered)
+	timings = {}
+	changed = set()
+	for html_path, rendered, seconds in zip(outputs, renderer.render_many(jobs), renderer.timings):
+		if verbose: print("%s (%.1fms)" % (html_path, seconds * 1000))
+		timings[html_path] = seconds
+		if write_if_changed(html_path, rendered): changed.add(os.path.basename(os.path.dirname(html_path)))
 
 	# make sure non-html slides get "rendered" too
-	slide_info = parse_slide(os.path.join(src,slide))
-	if slide_info is not None:
-		if slide_info.extension != ".htm" and slide_info.extension != ".html":
-			shutil.copy2(slide_info.full_path, os.path.join(dest,slide))
-			
+	for slide in slides:
+		slide_info = parse_slide(os.path.join(src,slide))
+		if slide_info is not None:
+			if slide_info.extension != ".htm" and slide_info.extension != ".html":
+				if copy_if_changed(slide_info.full_path, os.path.join(dest, slide, os.path.basename(slide_info.full_path))): changed.add(slide)
+
+	return {"timings": timings, "changed": sorted(changed)}
 
-def render_slides(src, dest, templates_dir, partials_dir, verbose=True):
+def render_one(src, slide, dest, templates, partials, verbose=False, renderer=None):
+	return render_batch(src, [slide], dest, templates, partials, verbose, renderer)
+
+def merge_results(results):
+	merged = {"timings": {}, "changed": []}
+	for result in results:
+		merged["timings"].update(result["timings"])
+		merged["changed"] = sorted(set(merged["changed"]) | set(result["changed"]))
+	return merged
+
+def report_timings(timings, slowest=5):
+	if len(timings) == 0: return "Rendered 0 files"
+
+	total = sum(timings.values())
+	report = "Rendered %d files, %.1fms in templates (%.1fms/file)" % (len(timings), total * 1000, total * 1000 / len(timings))
+	ranked = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:slowest]
+	return report + "\nSlowest:\n" + "\n".join(["  %8.1fms  %s" % (seconds * 1000, path) for path, seconds in ranked])
+
+def render_slides(src, dest, templates_dir, partials_dir, verbose=True, only=None, cache_dir=None):
 	if verbose: print("Loading templates...")
 	templates = load_html_files(templates_dir)
 
@@ -112,10 +559,13 @@ def render_slides(src, dest, templates_dir, partials_dir, verbose=True):
 
 
 	slides = next(os.walk(src))[1] # (root, dirs, files)
-	for slide in slides:
-		render_one(src, slide, dest, templates, partials, verbose)
+	if only is not None: slides = [slide for slide in slides if slide in only]
+
+	if verbose: print("Compiling templates...")
+	with new_renderer(prepare_templates(src, slides, templates, cache_dir), cache_dir, runtimes=1) as renderer:
+		return render_batch(src, slides, dest, templates, partials, verbose, renderer)
 			
-def render_slides_async(src, dest, templates_dir, partials_dir, verbose=True):
+def render_slides_async(src, dest, templates_dir, partials_dir, verbose=True, only=None, cache_dir=None, workers=None, runtimes=None):
 	if verbose: print("Loading templates...")
 	templates = load_html_files(templates_dir)
 
@@ -123,27 +573,73 @@ def render_slides_async(src, dest, templates_dir, partials_dir, verbose=True):
 	partials = load_html_files(partials_dir)
 
 	slides = next(os.walk(src))[1] # (root, dirs, files)
-	with concurrent.futures.ProcessPoolExecutor() as executor:
-		futures = {executor.submit(render_one, src, slide, dest, templates, partials, verbose): slide for slide in slides}
+	if only is not None: slides = [slide for slide in slides if slide in only]
+
+	if verbose: print("Compiling templates...")
+	compiled = prepare_templates(src, slides, templates, cache_dir)
+
+	renderer = new_renderer(compiled, cache_dir, runtimes)
+	if isinstance(renderer, RuntimePool):
+		# the node workers render concurrently on their own, no need for extra python processes
+		with renderer:
+			return render_batch(src, slides, dest, templates, partials, verbose, renderer)
+
+	# one batch of slides per worker, every worker rendering its whole batch in a single runtime call
+	if workers is None: workers = os.cpu_count() or 1
+	batches = [slides[i::workers] for i in range(min(workers, len(slides)))]
+
+	results = []
+	with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, len(batches)), initializer=init_renderer, initargs=(compiled, cache_dir, 0)) as executor:
+		futures = {executor.submit(render_batch, src, batch, dest, templates, partials, verbose): batch for batch in batches}
 
 		for future in concurrent.futures.as_completed(futures):
-			try:
-				data = future.result()
-			except Exception as e:
-				raise e
-		
+			results.append(future.result())
+
+	return merge_results(results)
+
+def benchmark(count=5000, body_size=20*1024):
+	# time the old per-file pyparsing grammar against the precompiled scanner on synthetic slides
+	with tempfile.TemporaryDirectory() as tmp:
+		files = []
+		for n in range(count):
+			files.append(os.path.join(tmp, "slide_%d.html" % n))
+			with open(files[-1], 'w') as f:
+				f.write("---\ntemplate: template_%d.html\ntitle : Slide %d\t of %d\nsubject:\tSection %d \nbad key: x\n---\n" % (n % 7, n, count, n % 12))
+				f.write(("<p>Slide %d</p>\n" % n) * (body_size // 16))
+
+		def with_pyparsing(file):
+			with open(file) as f:
+				return pyparsing_header(f.read())["context"]
+
+		readers = [("pyparsing", with_pyparsing), ("frontmatter.read", lambda file: frontmatter.read(file)["context"]),
+			("frontmatter.read_header", frontmatter.read_header)]
+
+		results = {}
+		for name, read in readers:
+			start = time.time()
+			results[name] = [read(file) for file in files]
+			seconds = time.time() - start
+			print("%s: %.3fs for %d headers (%.1fus each)" % (name, seconds, count, seconds * 1e6 / count))
+
+		same = all([results[name] == results["pyparsing"] for name, read in readers])
+		print("identical output: %s" % same)
+		return same
 
 def runScript(ASYNC=False):
 	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
 		description = banner(subtitle="Template Renderer"))
 
-	parser.add_argument("source", nargs=1, help="Source folder")
-	parser.add_argument("destination", nargs=1, help="Destination folder")
-	parser.add_argument("templates", nargs=1, help="Templates folder")
-	parser.add_argument("partials", nargs=1, help="Partials folder")
+	parser.add_argument("source", nargs="?", help="Source folder")
+	parser.add_argument("destination", nargs="?", help="Destination folder")
+	parser.add_argument("templates", nargs="?", help="Templates folder")
+	parser.add_argument("partials", nargs="?", help="Partials folder")
 	parser.add_argument("--notparallel", action="store_true", help="Run without concurrency")
 	parser.add_argument("--root", nargs=1, help="Project root folder", required=False)
 	parser.add_argument("--verbose", action="store_true", help="Chatty Cathy", required=False)
+	parser.add_argument("--nocache", action="store_true", help="Compile every template and scan every slide for dependencies instead of reusing what's in the project's temp folder", required=False)
+	parser.add_argument("--changed", nargs="+", metavar="FILE", help="Only render the slides that use these files (slide sources, templates or partials)", required=False)
+	parser.add_argument("--runtimes", nargs=1, type=int, help="Persistent node processes to render with (default: %d, 0 starts a runtime per call through PyExecJS)" % DEFAULT_RUNTIMES, required=False)
+	parser.add_argument("--benchmark", nargs="?", type=int, const=5000, metavar="N", help="time the front matter parsers against each other on N synthetic slides", required=False)
 
 	if len(sys.argv) == 1:
 		parser.print_help()
@@ -151,13 +647,19 @@ def runScript(ASYNC=False):
 	else:
 		args = parser.parse_args()
 
+		if args.benchmark is not None:
+			return 0 if benchmark(args.benchmark) else 1
+
+		if args.partials is None:
+			parser.error("source, destination, templates and partials folders are required")
+
 		VERBOSE = args.verbose
 		ASYNC = (not args.notparallel)
 
-		SOURCE = args.source[0]
-		DEST = args.destination[0]
-		TEMPS = args.templates[0]
-		PARTS = args.partials[0]
+		SOURCE = args.source
+		DEST = args.destination
+		TEMPS = args.templates
+		PARTS = args.partials
 
 		if args.root is not None:
 			ROOT = args.root[0]
@@ -167,10 +669,36 @@ def runScript(ASYNC=False):
 			PARTS = os.path.join(ROOT,PARTS)
 
 
+		ROOT = os.getcwd() if args.root is None else args.root[0]
+		cache_dir = None
+		graph_path = None
+		if not args.nocache and os.path.exists(os.path.join(ROOT, CONFIG_FILENAME)):
+			with open(os.path.join(ROOT, CONFIG_FILENAME)) as f:
+				config = json.load(f)
+			cache_dir = get_cache_dir(ROOT, config, COMPILE_CACHE)
+			graph_path = dependency_graph_path(ROOT, config)
+
+		# keep the saved graph current on every run, so a later --changed knows what the slides used to depend on
+		graph = DependencyGraph(SOURCE, TEMPS, PARTS, graph_path)
+		only = None
+		if args.changed is not None:
+			only = graph.changed_slides(args.changed)
+			print("%d slides use the changed files%s" % (len(only), "" if len(only) == 0 else ": " + ", ".join(sorted(only))))
+		elif graph_path is not None:
+			graph.refresh()
+		graph.save()
+
+		if only is not None and len(only) == 0: return 0
+
 		if ASYNC:
-			render_slides_async(SOURCE, DEST, TEMPS, PARTS, VERBOSE)
+			result = render_slides_async(SOURCE, DEST, TEMPS, PARTS, VERBOSE, only=only, cache_dir=cache_dir,
+				runtimes=None if args.runtimes is None else args.runtimes[0])
 		else:
-			render_slides(SOURCE, DEST, TEMPS, PARTS, VERBOSE)
+			result = render_slides(SOURCE, DEST, TEMPS, PARTS, VERBOSE, only=only, cache_dir=cache_dir)
+
+		print(report_timings(result["timings"]))
+		print("%d slides changed%s" % (len(result["changed"]), "" if len(result["changed"]) == 0 else ": " + ", ".join(result["changed"])))
+		return 0
 
 if __name__ == '__main__': 
 	sys.exit(runScript())
\ No newline at end of file
@@ -0,0 +1,58 @@
+from veevutils import link_or_copy
+
+import concurrent.futures
+import os
+import time
+
+DEFAULT_BATCH_SIZE = 64 # files per task
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4) # copies are i/o bound, threads are plenty
+
+def copy_batch(batch, link="copy", verbose=False):
+	size = 0
+	for src, dest in batch:
+		if verbose: print("Copying %s to %s" % (src, dest))
+		link_or_copy(src, dest, link)
+		size = size + os.path.getsize(dest)
+
+	return len(batch), size
+
+def transfer(pairs, link="copy", dirs=None, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, verbose=False):
+	# copies (or links, see veevutils.LINK_MODES) (source, destination) pairs in batches, a later pair wins a shared destination
+	start = time.time()
+
+	targets = dict([(dest, src) for src, dest in pairs])
+	pairs = [(src, dest) for dest, src in targets.items()]
+
+	# every folder gets made once, up front, instead of checked for before each file
+	folders = set([os.path.dirname(dest) for dest in targets.keys()])
+	if dirs is not None: folders.update(dirs)
+	for folder in sorted(folders):
+		if folder != '': os.makedirs(folder, exist_ok=True)
+
+	batches = [pairs[i:i+batch_size] for i in range(0, len(pairs), max(1, batch_size))]
+	files, size = 0, 0
+
+	if workers > 1 and len(batches) > 1:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [executor.submit(copy_batch, batch, link, verbose) for batch in batches]
+			for future in concurrent.futures.as_completed(futures):
+				done, copied = future.result()
+				files, size = files + done, size + copied
+	else:
+		for batch in batches:
+			done, copied = copy_batch(batch, link, verbose)
+			files, size = files + done, size + copied
+
+	return {"files": files, "bytes": size, "seconds": time.time() - start}
+
+def merge_stats(stats):
+	return {
+		"files": sum([stat["files"] for stat in stats]),
+		"bytes": sum([stat["bytes"] for stat in stats]),
+		"seconds": sum([stat["seconds"] for stat in stats])
+	}
+
+def describe(stats):
+	seconds = max(stats["seconds"], 0.001)
+	return "%d files, %.1fMB in %.2fs (%d files/s, %.1fMB/s)" % (stats["files"], stats["bytes"] / (1024.0*1024.0),
+		stats["seconds"], stats["files"] / seconds, stats["bytes"] / (1024.0*1024.0) / seconds)
@@ -1,8 +1,12 @@
 import textwrap
 from painter import paint
 import collections
+import ctypes
+import ctypes.util
+import errno
 import math
 import os
+import sys
 import zipfile
 import re
 import git
@@ -16,6 +20,9 @@ paint.enabled = True
 
 VALID_SLIDE_EXTENSIONS = ['.html', '.htm', '.pdf', '.jpg', '.jpeg', '.mp4'] #todo make regex deal with nested .htm(l) in extensions
 CONFIG_FILENAME = "VELVEEVA-config.json"
+CACHE_DIRNAME = "cache" # inside temp_dir, survives nuke and clean
+LINK_MODES = ["copy", "hardlink", "reflink", "auto"] # how sources are put into the build tree
+FICLONE = 0x40049409 # linux ioctl for copy-on-write clones (btrfs, xfs, ...)
 
 def get_extension_regex(exts=VALID_SLIDE_EXTENSIONS):
 	return "(%s)" % "|".join(exts)
@@ -152,6 +159,78 @@ def safe_delete(p):
 		else:
 			os.remove(p)
 
+def reflink(src, dest):
+	if sys.platform.startswith("linux"):
+		import fcntl
+		with open(src, 'rb') as s, open(dest, 'wb') as d:
+			fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+	elif sys.platform == "darwin":
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		if libc.clonefile(os.fsencode(src), os.fsencode(dest), 0) != 0:
+			raise OSError(ctypes.get_errno(), "clonefile failed", dest)
+	else:
+		raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform", dest)
+
+	shutil.copystat(src, dest)
+
+def link_or_copy(src, dest, mode="copy"):
+	# never write through whatever is already there, it might be linked to a source file
+	if os.path.isfile(dest) or os.path.islink(dest): os.remove(dest)
+
+	if mode in ["reflink", "auto"]:
+		try:
+			reflink(src, dest)
+			return "reflink"
+		except (OSError, IOError):
+			if os.path.exists(dest): os.remove(dest)
+
+	if mode in ["hardlink", "auto"]:
+		try:
+			os.link(src, dest)
+			return "hardlink"
+		except OSError:
+			pass # other filesystem, or links not supported
+
+	shutil.copy2(src, dest)
+	return "copy"
+
+def break_link(path, keep_contents=True):
+	# hardlinked build files share their contents with the source, so they have to be
+	# unshared before anything edits them in place (reflinks are copy-on-write already)
+	try:
+		if os.stat(path).st_nlink < 2: return
+	except FileNotFoundError:
+		return
+
+	if keep_contents:
+		tmp_path = path + ".unlinked"
+		shutil.copy2(path, tmp_path)
+		os.replace(tmp_path, path)
+	else:
+		os.remove(path) # about to be rewritten from scratch
+
+def parse_zip_slide(z, zip_path):
+	# parse_slide for a zip that's already open, so callers reading from it only open it once
+	EXTENSION_REGEX = get_extension_regex(VALID_SLIDE_EXTENSIONS)
+	PATH_REGEX = "(?:.*%(slide_name)s%(os_sep)s)((?:%(slide_name)s|index)%(extension_regex)s)$"
+	Result = collections.namedtuple('Result', ['full_path', 'extension'])
+
+	slide_name = os.path.splitext(os.path.basename(zip_path))[0]
+	pattern = PATH_REGEX % {'slide_name': slide_name, 'extension_regex': EXTENSION_REGEX, 'os_sep': os.sep}
+	matcher = re.compile(pattern)
+
+	files_sharing_parent_name = []
+
+	for file in z.namelist():
+		match = matcher.match(file)
+		if match is not None:
+			results_tuple = Result(match.group(0), match.group(2))
+			files_sharing_parent_name.append(results_tuple)
+	if len(files_sharing_parent_name) > 0:
+		return files_sharing_parent_name[0]
+	else:
+		return None
+
 def parse_slide(folder_path):
 	EXTENSION_REGEX = get_extension_regex(VALID_SLIDE_EXTENSIONS)
 	PATH_REGEX = "(?:.*%(slide_name)s%(os_sep)s)((?:%(slide_name)s|index)%(extension_regex)s)$"
@@ -169,23 +248,8 @@ def parse_slide(folder_path):
 	base_name = os.path.basename(folder_path)
 
 	if is_zip(folder_path):
-		slide_name = os.path.splitext(base_name)[0]
-		pattern = PATH_REGEX % {'slide_name': slide_name, 'extension_regex': EXTENSION_REGEX, 'os_sep': os.sep}
-		matcher = re.compile(pattern)
-
 		with zipfile.ZipFile(folder_path, 'r') as z:
-			files_in_zip = z.namelist()
-			files_sharing_parent_name = []
-
-			for file in files_in_zip:
-				match = matcher.match(file)
-				if match is not None:
-					results_tuple = Result(match.group(0), match.group(2))
-					files_sharing_parent_name.append(results_tuple)
-			if len(files_sharing_parent_name) > 0:
-				return files_sharing_parent_name[0]
-			else:
-				return None
+			return parse_zip_slide(z, folder_path)
 	else:
 		slide_name = os.path.basename(folder_path)
 		pattern = PATH_REGEX % {'slide_name': slide_name, 'extension_regex': EXTENSION_REGEX, 'os_sep': os.sep}
@@ -257,7 +321,7 @@ def veeva_composer(prefix, command, args):
 def path_composer(parent_path, slide_name, extension):
 	if parent_path is None: parent_path = ''
 
-	if len(parent_path > 0):
+	if len(parent_path) > 0:
 		if parent_path[-1] != "/": parent_path = parent_path + "/"
 
 	return parent_path + slide_name + "/" + slide_name + extension
@@ -265,6 +329,14 @@ def path_composer(parent_path, slide_name, extension):
 def identity_composer(*args):
 	return args
 
+def is_inside(path, folder):
+	path = os.path.abspath(path)
+	folder = os.path.abspath(folder)
+	return os.path.commonprefix([path + os.sep, folder + os.sep]) == folder + os.sep
+
+def get_cache_dir(root_dir, config, name):
+	return os.path.join(root_dir, config['MAIN']['temp_dir'], CACHE_DIRNAME, name)
+
 def banner(type="normal",subtitle=None):
 	WIDTH_IN_CHARS = 38
 	LINE_FILLER = "~"
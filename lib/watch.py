@@ -0,0 +1,111 @@
+from veevutils import is_inside
+
+import os
+import time
+
+try:
+	import inotify_simple
+except (ImportError, AttributeError, OSError):
+	inotify_simple = None # not on linux, fall back to polling
+
+# stages a watch rebuild can run for a slide, in build order
+WATCH_STAGES = ["locals", "globals", "sass", "templates", "relink"]
+
+class PollingWatcher:
+	def __init__(self, folders, interval=0.25):
+		self.folders = folders
+		self.interval = interval
+		self.snapshot = self.scan()
+
+	def scan(self):
+		found = {}
+		for folder in self.folders:
+			for root, dirs, files in os.walk(folder):
+				for file in files:
+					path = os.path.join(root, file)
+					try:
+						st = os.stat(path)
+					except FileNotFoundError:
+						continue
+					found[path] = (st.st_size, st.st_mtime_ns)
+		return found
+
+	def wait(self):
+		while True:
+			time.sleep(self.interval)
+			current = self.scan()
+			changed = set([path for path in set(current) | set(self.snapshot)
+				if current.get(path) != self.snapshot.get(path)])
+			self.snapshot = current
+
+			if len(changed) > 0: return changed
+
+class InotifyWatcher:
+	def __init__(self, folders, debounce=100):
+		f = inotify_simple.flags
+		self.mask = f.CLOSE_WRITE | f.CREATE | f.DELETE | f.MOVED_TO | f.MOVED_FROM
+		self.debounce = debounce # ms to wait for the rest of an editor's save burst
+		self.inotify = inotify_simple.INotify()
+		self.dirs = {}
+
+		for folder in folders: self.add_tree(folder)
+
+	def add_tree(self, folder):
+		found = []
+		for root, dirs, files in os.walk(folder):
+			self.dirs[self.inotify.add_watch(root, self.mask)] = root
+			found = found + [os.path.join(root, file) for file in files]
+		return found
+
+	def wait(self):
+		while True:
+			changed = set()
+
+			for event in self.inotify.read(read_delay=self.debounce):
+				parent = self.dirs.get(event.wd, None)
+				if parent is None or event.name == '': continue
+
+				path = os.path.join(parent, event.name)
+				if event.mask & inotify_simple.flags.ISDIR:
+					if event.mask & (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO):
+						changed.update(self.add_tree(path)) # files written before the watch was added
+				else:
+					changed.add(path)
+
+			if len(changed) > 0: return changed
+
+def watcher(folders):
+	folders = [folder for folder in folders if os.path.isdir(folder)]
+
+	if inotify_simple is not None:
+		return InotifyWatcher(folders)
+	else:
+		return PollingWatcher(folders)
+
+def affected_slides(changed, folders, deps):
+	# stage name -> slides to re-run it for, given the changed paths and each slide's template dependencies
+	plan = dict([(stage, set()) for stage in WATCH_STAGES])
+
+	def rebuild(slides, first_stage):
+		for stage in WATCH_STAGES[WATCH_STAGES.index(first_stage):]:
+			plan[stage].update(slides)
+
+	# one refresh for the whole batch of changes; an edited template might pull in different partials now,
+	# and new (or deleted) files only show up in the dependencies on one side of it
+	shared = [path for path in changed if is_inside(path, folders["templates"]) or is_inside(path, folders["partials"])]
+	rebuild(deps.changed_slides(shared), "templates")
+
+	for path in changed:
+		if is_inside(path, folders["source"]):
+			slide = os.path.relpath(os.path.abspath(path), os.path.abspath(folders["source"])).split(os.sep)[0]
+			if slide == os.path.basename(path): continue # loose file next to the slide folders
+
+			if os.path.exists(path) and os.path.splitext(path)[1].startswith(".htm"):
+				rebuild([slide], "templates")
+			else:
+				rebuild([slide], "locals") # the slide folder is rebuilt from scratch
+
+		elif is_inside(path, folders["globals"]):
+			rebuild(deps.slides(), "globals")
+
+	return plan
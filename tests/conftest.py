@@ -0,0 +1,6 @@
+import os
+import sys
+
+# lib tools import each other by bare module name, same as when go.py loads them
+LIB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib")
+if LIB_DIR not in sys.path: sys.path.insert(0, LIB_DIR)
@@ -0,0 +1,41 @@
+from linkindex import LinkIndex
+from prefix import rename_refs
+
+import os
+
+def write_slides(folder):
+	for slide, html in [("a", '<a href="veeva:gotoSlide(b.zip)">b</a>'), ("b", "<p>b</p>")]:
+		os.makedirs(os.path.join(folder, slide))
+		with open(os.path.join(folder, slide, slide + ".html"), 'w') as f:
+			f.write(html)
+
+def read(path):
+	with open(path) as f:
+		return f.read()
+
+def test_lookups_stay_inside_updated_folders(tmpdir):
+	src, build = str(tmpdir.join("src")), str(tmpdir.join("build"))
+	write_slides(src)
+	write_slides(build)
+
+	index = LinkIndex(str(tmpdir.join("links.sqlite")))
+	index.update([src, build])
+	assert len(index.links_to("b")) == 2
+
+	index.update([build])
+	assert [path for path, kind, value in index.links_to("b")] == [os.path.join(build, "a", "a.html")]
+	assert index.files_linking_to(["b"], folders=[src]) == [os.path.join(src, "a", "a.html")]
+	index.close()
+
+def test_rename_only_touches_requested_tree(tmpdir):
+	src, build = str(tmpdir.join("src")), str(tmpdir.join("build"))
+	write_slides(src)
+	write_slides(build)
+	index_path = str(tmpdir.join("links.sqlite"))
+
+	LinkIndex(index_path).update([src]).close() # src has been indexed before
+
+	rename_refs({"b": "x_b"}, [build], parallel=False, index=index_path)
+
+	assert "x_b.zip" in read(os.path.join(build, "a", "a.html"))
+	assert "x_b" not in read(os.path.join(src, "a", "a.html"))
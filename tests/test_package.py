@@ -0,0 +1,18 @@
+from package import zip_slides
+
+import os
+import zipfile
+
+def test_quick_edit_is_repackaged(tmpdir):
+	root = str(tmpdir)
+	page = os.path.join(root, "slide", "index.html")
+	os.makedirs(os.path.dirname(page))
+
+	# same size and, within the zip's 2 second timestamps, the same time
+	with open(page, "w") as f: f.write("aaaa")
+	zip_slides(root, ["slide"], "zips")
+	with open(page, "w") as f: f.write("bbbb")
+	zip_slides(root, ["slide"], "zips")
+
+	with zipfile.ZipFile(os.path.join(root, "zips", "slide.zip")) as z:
+		assert z.read("slide/index.html") == b"bbbb"
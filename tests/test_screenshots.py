@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("selenium")
+pytest.importorskip("bs4")
+pytest.importorskip("PIL")
+
+import multiprocessing as mp
+import os
+import screenshots
+import time
+
+# workers only see the fakes below when they are forked from this process
+needs_fork = pytest.mark.skipif(mp.get_start_method() != "fork", reason="needs fork")
+
+def fake_shot(url, dest, sizes, filename, driver, verbose=False):
+	time.sleep(0.05)
+	return {'url': url, 'pid': os.getpid()}
+
+@needs_fork
+def test_low_memory_drops_a_worker(monkeypatch):
+	monkeypatch.setattr(screenshots, "ss_", fake_shot)
+	monkeypatch.setattr(screenshots, "new_driver", lambda timeout=None: None)
+	monkeypatch.setattr(screenshots, "available_memory", lambda: 0)
+
+	shots = [("page%d.html" % i, "dest", [], "shot.jpg") for i in range(30)]
+	timings, failed = screenshots.run_pool(shots, workers=2, timeout=None)
+
+	assert failed == []
+	assert len(timings) == 30
+
+	# one worker is retired after the first page, long before the queue runs dry
+	pids = [timing['pid'] for timing in timings]
+	assert len(set(pids)) == 2
+	assert len(set(pids[5:])) == 1
+
+def test_cache_prunes_unused_captures(tmpdir):
+	cache = screenshots.ScreenshotCache(str(tmpdir.join("cache")))
+	kept, gone = str(tmpdir.join("kept.jpg")), str(tmpdir.join("gone.jpg"))
+	with open(kept, "w") as f: f.write("kept")
+	with open(gone, "w") as f: f.write("gone")
+
+	cache.store("aa01", [kept])
+	cache.store("bb02", [gone])
+	stale = time.time() - screenshots.CACHE_MAX_AGE - 60
+	os.utime(cache.entry("bb02"), (stale, stale))
+	os.remove(gone)
+
+	cache.prune([kept, gone])
+
+	assert cache.is_generated(kept)
+	assert len(cache.generated) == 1
+	assert os.path.exists(cache.entry("aa01"))
+	assert not os.path.exists(os.path.dirname(cache.entry("bb02")))
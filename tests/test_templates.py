@@ -0,0 +1,96 @@
+from templates import DependencyGraph, RuntimePool, node_binary
+from watch import affected_slides
+
+import os
+import pytest
+
+GREET = {"greet": "function(locals) { return 'hi ' + locals.name; }"}
+
+needs_node = pytest.mark.skipif(node_binary() is None, reason="needs node")
+
+@needs_node
+def test_dead_runtime_is_replaced():
+	pool = RuntimePool(GREET, size=1)
+	try:
+		assert pool.run([["greet", {"name": "a"}]])[0][0] == "hi a"
+
+		dead = pool.workers[0]
+		dead.process.kill()
+		dead.process.wait()
+
+		assert pool.run([["greet", {"name": "b"}]])[0][0] == "hi b"
+		assert pool.workers[0] is not dead
+	finally:
+		pool.close()
+
+@needs_node
+def test_runtime_dying_mid_batch_is_retried():
+	pool = RuntimePool(GREET, size=1)
+	try:
+		pool.run([["greet", {"name": "a"}]])
+		pool.workers[0].process.kill() # not reaped yet, so it still looks alive when the batch is sent
+
+		assert [html for html, ms in pool.run([["greet", {"name": "b"}], ["greet", {"name": "c"}]])] == ["hi b", "hi c"]
+	finally:
+		pool.close()
+
+@needs_node
+def test_template_errors_keep_the_runtime():
+	pool = RuntimePool(dict(GREET, broken="function(locals) { return locals.missing.name; }"), size=1)
+	try:
+		worker = pool.run([["greet", {"name": "a"}]]) and pool.workers[0]
+		with pytest.raises(Exception):
+			pool.run([["broken", {}]])
+		assert pool.workers[0] is worker
+		assert pool.run([["greet", {"name": "b"}]])[0][0] == "hi b"
+	finally:
+		pool.close()
+
+def write(path, contents):
+	if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+	with open(path, 'w') as f:
+		f.write(contents)
+	os.utime(path, None)
+
+def make_project(tmpdir):
+	folders = dict([(name, str(tmpdir.join(name))) for name in ["source", "globals", "templates", "partials"]])
+	write(os.path.join(folders["templates"], "main.html"), '<%- @partial["nav.html"] %><%- @contents %>')
+	write(os.path.join(folders["partials"], "nav.html"), "<nav></nav>")
+	write(os.path.join(folders["partials"], "foot.html"), "<footer></footer>")
+	write(os.path.join(folders["source"], "a", "a.html"), "---\ntemplate: main.html\n---\n<p>a</p>")
+	write(os.path.join(folders["source"], "b", "b.html"), '<%- @partial["foot.html"] %>')
+	os.makedirs(folders["globals"])
+	return folders
+
+def graph(folders, path=None):
+	return DependencyGraph(folders["source"], folders["templates"], folders["partials"], path)
+
+def test_graph_follows_templates_to_partials(tmpdir):
+	folders = make_project(tmpdir)
+	deps = graph(folders).refresh()
+
+	assert deps.slide_dependencies("a") == sorted([os.path.join(folders["templates"], "main.html"), os.path.join(folders["partials"], "nav.html")])
+	assert deps.slide_dependencies("b") == [os.path.join(folders["partials"], "foot.html")]
+	assert deps.slides_using([os.path.join(folders["partials"], "nav.html")]) == set(["a"])
+
+def test_saved_graph_sees_slides_that_stopped_using_a_file(tmpdir):
+	folders = make_project(tmpdir)
+	path = str(tmpdir.join("cache", "graph.json"))
+	graph(folders, path).refresh().save()
+
+	nav = os.path.join(folders["partials"], "nav.html")
+	write(os.path.join(folders["templates"], "main.html"), '<%- @partial["foot.html"] %><%- @contents %>')
+	write(nav, "<nav>changed</nav>")
+
+	assert graph(folders, path).changed_slides([nav]) == set(["a"]) # used it before the template changed
+	assert graph(folders, path).refresh().slides_using([nav]) == set()
+
+def test_watch_plans_with_the_graph(tmpdir):
+	folders = make_project(tmpdir)
+	deps = graph(folders).refresh()
+
+	plan = affected_slides([os.path.join(folders["partials"], "foot.html")], folders, deps)
+	assert plan["templates"] == set(["b"]) and plan["locals"] == set()
+
+	plan = affected_slides([os.path.join(folders["globals"], "site.css")], folders, deps)
+	assert plan["globals"] == set(["a", "b"])